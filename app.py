@@ -1,18 +1,45 @@
 ########################################
 ## Imports and setup
+import time
+startup_profile = []
+startup_time = time.perf_counter()
+
 import os
+import sys
 import json
-import psycopg2
-import pickle
-import joblib
-import pandas as pd
 import datetime
 import math
-from flask import Flask, jsonify, request
+import hashlib
+import hmac
+import atexit
+import contextlib
+import threading
+from flask import Flask, Response, jsonify, request, stream_with_context
 from peewee import  *
-from playhouse.shortcuts import model_to_dict
-from playhouse.db_url import connect
+from utils.db_pool import connect_database
+from utils.json_field import JSONField, parse_legacy
+from utils.metrics import StageHistograms
+from utils.micro_batcher import MicroBatcher
+from utils.model_registry import ModelRegistry, LoadedModel, DEFAULT as DEFAULT_MODEL
+from utils.ndjson_stream import NDJSONBatches, LineTooLong
 from loguru import logger
+from utils.prediction_cache import PredictionCache
+from utils.profiler import RequestProfiler
+from utils.quality_metrics import counter_deltas, is_positive, summarize
+from utils.shadow import ShadowScorer
+from utils.validation import ObservationValidator
+from utils.write_behind import WriteBehindQueue
+
+# pandas, joblib, sklearn and utils.custom_transformers are imported when the
+# model is loaded, see `load_model`
+
+def profile_stage(name):
+    global startup_time
+    now = time.perf_counter()
+    startup_profile.append((name, now - startup_time))
+    startup_time = now
+
+profile_stage('imports')
 
 ## End imports
 ########################################
@@ -25,8 +52,47 @@ try:
 except:
     DATABASE_URL = 'sqlite:///predictions.db' 
     
-db = connect(DATABASE_URL)
-db.connect()    
+# SQLite pragmas applied to every new connection. The production profile uses
+# WAL so that readers never block the writer, and synchronous=NORMAL, which
+# only syncs at checkpoints: a power loss may drop the last commits but never
+# corrupts the file. Each pragma can be overridden with SQLITE_<PRAGMA>
+SQLITE_PROFILES = {
+    'default': {},
+    'production': {'journal_mode': 'wal',
+                   'synchronous': 'normal',
+                   'cache_size': -64000,
+                   'mmap_size': 268435456,
+                   'busy_timeout': 5000},
+}
+
+def sqlite_pragmas():
+    pragmas = dict(SQLITE_PROFILES[os.environ.get('SQLITE_PROFILE', 'default')])
+    for pragma in ['journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'busy_timeout']:
+        value = os.environ.get('SQLITE_' + pragma.upper())
+        if value is not None:
+            pragmas[pragma] = value
+    return pragmas
+
+database_params = {}
+if DATABASE_URL.startswith('sqlite'):
+    database_params['pragmas'] = sqlite_pragmas()
+elif DATABASE_URL.startswith('postgres'):
+    # JSON columns (see utils/json_field.py) are binary JSON on Postgres
+    database_params['field_types'] = {'JSON': 'JSONB'}
+
+# Connections come from a pool and are held for the duration of a request,
+# see the request hooks below
+DATABASE_POOL = os.environ.get('DATABASE_POOL', '1') != '0'
+if DATABASE_POOL:
+    db = connect_database(DATABASE_URL,
+                          max_connections=int(os.environ.get('DATABASE_MAX_CONNECTIONS', 20)),
+                          pool_size=int(os.environ.get('DATABASE_POOL_SIZE', 10)),
+                          stale_timeout=int(os.environ.get('DATABASE_STALE_TIMEOUT', 300)),
+                          timeout=int(os.environ.get('DATABASE_POOL_TIMEOUT', 10)),
+                          pre_ping=os.environ.get('DATABASE_PRE_PING', '0') == '1',
+                          **database_params)
+else:
+    db = connect_database(DATABASE_URL, pool=False, **database_params)
 
 class BaseModel(Model):
     class Meta:
@@ -34,20 +100,41 @@ class BaseModel(Model):
 
 class Prediction(BaseModel):
     admission_id = IntegerField(unique=True)
-    observation = TextField()
+    # Compact JSON, e.g. json_extract(observation, '$.age') on SQLite
+    observation = JSONField()
     prediction = TextField()
     probability = FloatField()
     true_class = TextField(null=True)
-    created_date = DateTimeField(default=datetime.datetime.now)
+    created_date = DateTimeField(default=datetime.datetime.now, index=True)
     modified_date = DateTimeField(null=True)
+    model_version = TextField(null=True)
         
 class Request(BaseModel):
     request = TextField()
     response = TextField()
     status = TextField()
     endpoint = TextField()
+    created_date = DateTimeField(default=datetime.datetime.now, index=True)
+    
+class ShadowPrediction(BaseModel):
+    # Probabilities of the candidate model, see the shadow scoring section
+    admission_id = IntegerField(index=True)
+    model_version = TextField()
+    prediction = TextField()
+    probability = FloatField()
     created_date = DateTimeField(default=datetime.datetime.now)
+
+class QualityCounter(BaseModel):
+    # Model quality counters per prediction day and model version, see the
+    # model quality section
+    day = DateField()
+    model_version = TextField()
+    name = TextField()
+    count = IntegerField(default=0)
     
+    class Meta:
+        indexes = ((('day', 'model_version', 'name'), True),)
+
 class Data(BaseModel):
     created_date = DateTimeField(default=datetime.datetime.now)
     modified_date = DateTimeField(null=True)
@@ -86,7 +173,97 @@ class Data(BaseModel):
     diabetesMed = TextField(null=True)
     readmitted = TextField(null=True)
 
-db.create_tables([Prediction, Request, Data], safe = True)
+def add_missing_columns(model):
+    # create_tables leaves existing tables alone: columns added to a model
+    # since its table was created are added here (they must be nullable)
+    from playhouse.migrate import SchemaMigrator, migrate
+    table = model._meta.table_name
+    existing = {column.name for column in db.get_columns(table)}
+    for field in model._meta.sorted_fields:
+        if field.column_name not in existing:
+            try:
+                migrate(SchemaMigrator.from_database(db).add_column(table, field.column_name, field))
+                logger.info("Added column {}.{}".format(table, field.column_name))
+            except (OperationalError, ProgrammingError):
+                # Another worker added it first
+                db.rollback()
+                if field.column_name not in {column.name for column in db.get_columns(table)}:
+                    raise
+
+def migrate_observations(batch_size=1000):
+    # Rewrites the observations stored as Python reprs (str() of the dict,
+    # before Prediction.observation was a JSON column) as compact JSON,
+    # `batch_size` rows per transaction. Rows already in JSON are left alone,
+    # so it can be stopped and run again. On Postgres the text column then
+    # becomes JSONB. Returns (rows rewritten, column bytes before, after)
+    raw = Cast(Prediction.observation, 'TEXT')
+    size = lambda: Prediction.select(fn.SUM(fn.LENGTH(raw))).scalar() or 0
+    before = size()
+    migrated = 0
+    last_id = 0
+    while True:
+        rows = list(Prediction.select(Prediction.id, raw).where(Prediction.id > last_id)
+                    .order_by(Prediction.id).limit(batch_size).tuples())
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        legacy = []
+        for _id, text in rows:
+            try:
+                json.loads(text)
+            except ValueError:
+                legacy.append((_id, parse_legacy(text)))
+        with db.atomic():
+            for _id, observation in legacy:
+                Prediction.update(observation=observation).where(Prediction.id == _id).execute()
+        migrated += len(legacy)
+    if isinstance(db, PostgresqlDatabase):
+        column = {column.name: column for column in db.get_columns(Prediction._meta.table_name)}['observation']
+        if column.data_type.lower() != 'jsonb':
+            db.execute_sql('ALTER TABLE {0} ALTER COLUMN observation TYPE JSONB USING observation::jsonb'
+                           .format(Prediction._meta.table_name))
+    return migrated, before, size()
+
+with db.connection_context():
+    # Seeded from the labels already stored, see the model quality section
+    quality_counters_created = not QualityCounter.table_exists()
+    db.create_tables([Prediction, Request, ShadowPrediction, QualityCounter, Data], safe = True)
+    add_missing_columns(Prediction)
+
+# Forked workers must not inherit the connections opened at import time
+if DATABASE_POOL:
+    db.close_all()
+
+# Write-behind mode, off unless WRITE_BEHIND_QUEUE_SIZE is set
+writer = WriteBehindQueue(db,
+                          max_size=int(os.environ.get('WRITE_BEHIND_QUEUE_SIZE', 0)),
+                          batch_size=int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 100)),
+                          flush_interval=float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', 0.5)))
+atexit.register(writer.close)
+
+def save_request(observation, response, endpoint):
+    if writer.enabled:
+        writer.put(Request, {'request': observation, 'response': response, 'endpoint': endpoint,
+                             'status': 'error', 'created_date': datetime.datetime.now()})
+    else:
+        r = Request(request=observation, response=response, endpoint=endpoint, status='error')
+        r.save()
+
+def reserve_admission_id(_id):
+    # Write-behind mode: True if the id is neither waiting in the queue nor stored
+    if not writer.reserve(_id):
+        return False
+    try:
+        exists = Prediction.select().where(Prediction.admission_id == _id).exists()
+    except Exception:
+        writer.release(_id)
+        raise
+    if exists:
+        writer.release(_id)
+        return False
+    return True
+
+profile_stage('database')
 
 # End database setup
 ########################################
@@ -95,13 +272,123 @@ db.create_tables([Prediction, Request, Data], safe = True)
 ########################################
 # Unpickle the previously-trained model
 
-with open('columns.json') as fh:
-    columns = json.load(fh)
-
-with open('dtypes.pickle', 'rb') as fh:
-    dtypes = pickle.load(fh)
-
-pipeline = joblib.load('pipeline.pickle')
+# The model is loaded on first use, or up front by `load_model()` (the gunicorn
+# master calls it before forking the workers), so that importing the app and
+# serving requests that do not score stay fast.
+#
+# Model versions come from the registry in MODEL_REGISTRY_DIR, see
+# utils/model_registry.py. A new version is loaded and warmed up in the
+# background and then replaces `active_model` in a single assignment; the
+# version it replaced is kept in `previous_model` for rollbacks
+
+registry = ModelRegistry(os.environ.get('MODEL_REGISTRY_DIR', 'models'),
+                         poll_interval=float(os.environ.get('MODEL_POLL_INTERVAL', 5)))
+
+active_model = None
+previous_model = None
+model_lock = threading.Lock()
+model_switch = {'name': None, 'state': None, 'error': None}
+
+def read_model(name):
+    global startup_time
+    
+    # Only the first load is part of the startup profile
+    profile = active_model is None
+    def stage(label):
+        if profile:
+            profile_stage(label)
+    if profile:
+        startup_time = time.perf_counter()
+    
+    path = registry.path(name)
+    import pickle
+    import joblib
+    stage('model: import joblib')
+    
+    with open(os.path.join(path, 'columns.json')) as fh:
+        model_columns = json.load(fh)
+    with open(os.path.join(path, 'dtypes.pickle'), 'rb') as fh:
+        model_dtypes = pickle.load(fh)
+    stage('model: dtypes.pickle')
+    
+    model_pipeline = joblib.load(os.path.join(path, 'pipeline.pickle'))
+    with open(os.path.join(path, 'pipeline.pickle'), 'rb') as fh:
+        digest = hashlib.sha1(fh.read()).hexdigest()[:12]
+    stage('model: pipeline.pickle')
+    
+    # The /predict schema is compiled once from columns.json and dtypes.pickle.
+    # The default version is named after its pipeline.pickle hash
+    validator = ObservationValidator(model_columns, model_dtypes)
+    scorer = load_scorer(model_pipeline, model_columns, model_dtypes, validator, stage)
+    loaded = LoadedModel(name, digest if name == DEFAULT_MODEL else name, path,
+                         model_columns, model_dtypes, model_pipeline, validator, scorer)
+    warm_up(loaded)
+    stage('model: warm up')
+    return loaded
+
+def warm_up(loaded):
+    # One prediction through the request path before the version serves traffic
+    for observation in sample_observations():
+        if loaded.validator.validate(observation)[0]:
+            if batcher.enabled:
+                # What the batcher runs, without starting its thread in the
+                # gunicorn master
+                probability = model_probabilities([observation], loaded)[0]
+            else:
+                probability = model_probability(observation, loaded)
+            if not 0 <= probability <= 1:
+                raise ValueError("Model {} returned {} on a sample observation".format(loaded.version, probability))
+            return
+    logger.warning("Model {} not warmed up, no sample observation is valid for it".format(loaded.version))
+
+def activate(loaded):
+    global active_model, previous_model
+    if active_model is not None and active_model.name != loaded.name:
+        previous_model = active_model
+    active_model = loaded
+    logger.info("Model {} ({}) active".format(loaded.name, loaded.version))
+
+def load_model():
+    # The active model, read on first use from the version the registry names
+    if active_model is None:
+        with model_lock:
+            if active_model is None:
+                activate(read_model(registry.active_name()))
+    return active_model
+
+def switch_model(name, publish=True):
+    # Loads `name` (or takes it back from `previous_model`) and swaps it in.
+    # With `publish` the registry pointer is updated, so that the other
+    # workers follow
+    with model_lock:
+        model_switch.update(name=name, state='loading', error=None)
+        try:
+            if active_model is None or active_model.name != name:
+                if previous_model is not None and previous_model.name == name:
+                    activate(previous_model)
+                else:
+                    activate(read_model(name))
+            if publish:
+                registry.set_active(name)
+        except Exception as e:
+            logger.error("Model {} not loaded: {}".format(name, e))
+            model_switch.update(state='failed', error=str(e))
+            return False
+        model_switch['state'] = 'active'
+        return True
+
+def start_model_switch(name, publish=True):
+    thread = threading.Thread(target=switch_model, args=(name, publish), name='model-switch', daemon=True)
+    thread.start()
+    return thread
+
+def follow_model_pointer():
+    # Another worker published a new version: load it in the background
+    if active_model is None or model_lock.locked():
+        return
+    name = registry.poll()
+    if name is not None and name != active_model.name:
+        start_model_switch(name, publish=False)
 
 # End model un-pickling
 ########################################
@@ -118,107 +405,6 @@ def check_request_id(request):
 
     return True, ""
 
-def check_valid_column(observation):
-    
-    valid_columns = {'admission_id',
-                     'patient_id', 
-                     'race', 
-                     'gender', 
-                     'age', 
-                     'weight',
-                     'admission_type_code', 
-                     'discharge_disposition_code',
-                     'admission_source_code', 
-                     'time_in_hospital', 
-                     'payer_code',
-                     'medical_specialty',
-                     'has_prosthesis',
-                     'complete_vaccination_status',
-                     'num_lab_procedures', 
-                     'num_procedures', 
-                     'num_medications',
-                     'number_outpatient', 
-                     'number_emergency', 
-                     'number_inpatient', 
-                     'diag_1',
-                     'diag_2', 
-                     'diag_3', 
-                     'number_diagnoses', 
-                     'blood_type',
-                     'hemoglobin_level',
-                     'blood_transfusion', 
-                     'max_glu_serum', 
-                     'A1Cresult',
-                     'diuretics', 
-                     'insulin', 
-                     'change', 
-                     'diabetesMed'
-                    }
-    
-    keys = set(observation.keys())
-    
-    if len(valid_columns - keys) > 0: 
-        missing = valid_columns - keys
-        error_description = "Missing columns: {}".format(missing)
-        error_type = "failure"
-        return False, error_description, error_type
-    
-    if len(keys - valid_columns) > 0: 
-        extra = keys - valid_columns
-        error_description = "Unrecognized columns provided: {}".format(extra)
-        error_type = "warning"
-        return False, error_description , error_type   
-
-    return True, "",""
-
-def check_column_types(observation):
-
-    valid_column_types = {
-                     'admission_id':[1, 1.0],
-                     'patient_id':[1, 1.0], 
-                     'race':["" ,1.0, None], 
-                     'gender':["" ,1.0, None], 
-                     'age':["" ,1.0, None], 
-                     'weight':["" ,1.0, None],
-                     'admission_type_code':[1.0,1, None], 
-                     'discharge_disposition_code':[1.0, 1,None],
-                     'admission_source_code':[1.0, 1,None], 
-                     'time_in_hospital':[1,1.0, None], 
-                     'payer_code':["",1.0, None],
-                     'medical_specialty':["",1.0,None],
-                     'has_prosthesis':[True,1, 1.0, None],
-                     'complete_vaccination_status':["",1.0, None],
-                     'num_lab_procedures':[1.0,1,None], 
-                     'num_procedures':[1,1.0, None],
-                     'num_medications':[1,1.0, None],
-                     'number_outpatient':[1,1.0, None],
-                     'number_emergency':[1,1.0, None],
-                     'number_inpatient':[1,1.0, None],
-                     'diag_1':["",1.0, None], 
-                     'diag_2':["",1.0, None], 
-                     'diag_3':["",1.0, None], 
-                     'number_diagnoses':[1,1.0, None],
-                     'blood_type':["",1.0,None], 
-                     'hemoglobin_level':[1.0,1,None], 
-                     'blood_transfusion':[True,1,1.0, None], 
-                     'max_glu_serum':["",1.0,None], 
-                     'A1Cresult':["",1.0,None], 
-                     'diuretics':["",1.0,None], 
-                     'insulin':["",1.0,None], 
-                     'change':["",1.0,None], 
-                     'diabetesMed':["",1.0,None], 
-    }
-    for key, valid_columns in valid_column_types.items():
-        if key in observation:
-            value = observation[key]
-            if type(value).__name__ not in [type(x).__name__ for x in valid_columns]:
-                error = "Invalid datatype provided for '{}': '{}'. Allowed datatypes are: {}".format(
-                    key, type(value).__name__, ",".join(["'{}'".format(type(v).__name__) for v in valid_columns]))
-                return False, error
-                    
-    return True, ""
-
-
 def check_admission_id(observation):
     value = observation['admission_id']
     
@@ -231,535 +417,6 @@ def check_admission_id(observation):
     
     return True, ''
 
-def check_patient_id(observation):
-    value = observation['patient_id']
-    
-    if type(value).__name__ != type(1).__name__:
-        if value.is_integer():
-            observation['patient_id'] = int(observation['patient_id'])
-        else:
-            error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'patient_id', type(observation['patient_id']).__name__,(type(1).__name__))
-            return False, error      
-    
-    return True, ''
-
-def check_age(observation):
-    
-    #valid_values = [None,"","?","[70-80)","[60-70)","[50-60)","[80-90)","[40-50)","[30-40)","[90-100)","[20-30)","[10-20)","[0-10)"]
-    
-    if observation['age']:
-        if type(observation['age']).__name__ == type("").__name__:
-            observation['age'] = observation['age'].strip()
-        elif type(observation['age']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['age']):
-                observation['age'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'age', type(observation['age']).__name__,(type(None).__name__))
-                return False, error
-            #if observation['age'].strip() not in valid_values:
-            #error = "Invalid value provided for '{}': '{}'. Allowed values are: {}".format( 'age' , observation['age'], ",".join(["'{}'".format(v) for v in valid_values]))
-            #return False, error      
-    
-    return True, ''
-
-def check_weight(observation):
-    #valid_values = [None,"","?","[75-100)","[50-75)","[100-125)","[125-150)","[25-50)","[0-25)","[150-175)","[175-200)",">200"]
-    
-    if observation['weight']:
-        if type(observation['weight']).__name__ == type("").__name__:
-            observation['weight'] = observation['weight'].strip()
-        elif type(observation['weight']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['weight']):
-                observation['weight'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'weight', type(observation['weight']).__name__,(type(None).__name__))
-                return False, error
-        #if observation['weight'].strip() not in valid_values:
-            #error = "Invalid value provided for '{}': '{}'. Allowed values are: {}".format( 'weight' , observation['weight'], ",".join(["'{}'".format(v) for v in valid_values]))
-            #return False, error      
-    
-    return True, ''
-
-
-def check_gender(observation):
-    valid_values = [None,"","?","male","female","unknown/invalid"]
-    
-    if observation['gender']:
-        if type(observation['gender']).__name__ == type("").__name__:
-            observation['gender'] = observation['gender'].strip()
-        elif type(observation['gender']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['gender']):
-                observation['gender'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'gender', type(observation['gender']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-
-def check_payer_code(observation):
-    if observation['payer_code']:
-        if type(observation['payer_code']).__name__ == type("").__name__:
-            observation['payer_code'] = observation['payer_code'].strip()
-        elif type(observation['payer_code']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['payer_code']):
-                observation['payer_code'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'payer_code', type(observation['payer_code']).__name__,(type(None).__name__))
-                return False, error
-    return True, ''
-
-def check_medical_specialty(observation):
-    if observation['medical_specialty']:
-        if type(observation['medical_specialty']).__name__ == type("").__name__:
-            observation['medical_specialty'] = observation['medical_specialty'].strip()
-        elif type(observation['medical_specialty']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['medical_specialty']):
-                observation['medical_specialty'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'medical_specialty', type(observation['medical_specialty']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-def check_race(observation):
-    
-    if observation['race']:
-        if type(observation['race']).__name__ == type("").__name__:
-            observation['race'] = observation['race'].strip()
-        elif type(observation['race']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['race']):
-                observation['race'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'race', type(observation['gender']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-def check_diag_1(observation):
-    
-    if observation['diag_1']:
-        if type(observation['diag_1']).__name__ == type("").__name__:
-            observation['diag_1'] = observation['diag_1'].strip()
-        elif type(observation['diag_1']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['diag_1']):
-                observation['diag_1'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'diag_1', type(observation['diag_1']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-
-def check_diag_2(observation):
-    
-    if observation['diag_2']:
-        if type(observation['diag_2']).__name__ == type("").__name__:
-            observation['diag_2'] = observation['diag_2'].strip()
-        elif type(observation['diag_2']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['diag_2']):
-                observation['diag_2'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'diag_2', type(observation['diag_2']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-
-def check_diag_3(observation):
-    
-    if observation['diag_3']:
-        if type(observation['diag_3']).__name__ == type("").__name__:
-            observation['diag_3'] = observation['diag_3'].strip()
-        elif type(observation['diag_3']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['diag_3']):
-                observation['diag_3'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'diag_3', type(observation['diag_3']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-def check_admission_type_code(observation):
-
-    if observation['admission_type_code']:
-        if type(observation['admission_type_code']).__name__ == type(1).__name__:
-            observation['admission_type_code'] = float(observation['admission_type_code'])
-        elif type(observation['admission_type_code']).__name__ == type(1.0).__name__:
-            if observation['admission_type_code'].is_integer():
-                observation['admission_type_code'] = float(observation['admission_type_code'])
-            elif pd.isna(observation['admission_type_code']):
-                observation['admission_type_code'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'admission_type_code', type(observation['admission_type_code']).__name__,(type(1).__name__))
-                return False, error
-        else:
-            error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'admission_type_code', type(observation['admission_type_code']).__name__,(type(1).__name__))
-            return False, error
-    
-    return True, ''
-
-def check_discharge_disposition_code(observation):
-    
-    if observation['discharge_disposition_code']:
-        if type(observation['discharge_disposition_code']).__name__ == type(1).__name__:
-            observation['discharge_disposition_code'] = float(observation['discharge_disposition_code'])
-        elif type(observation['discharge_disposition_code']).__name__ == type(1.0).__name__:
-            if observation['discharge_disposition_code'].is_integer():
-                observation['discharge_disposition_code'] = float(observation['discharge_disposition_code'])
-            elif pd.isna(observation['discharge_disposition_code']):
-                observation['discharge_disposition_code'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'discharge_disposition_code', type(observation['discharge_disposition_code']).__name__,(type(1).__name__))
-                return False, error
-        else:
-            error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'discharge_disposition_code', type(observation['discharge_disposition_code']).__name__,(type(1).__name__))
-            return False, error
-    
-    return True, ''
-
-
-def check_admission_source_code(observation):
-    
-    if observation['admission_source_code']:
-        if type(observation['admission_source_code']).__name__ == type(1).__name__:
-            observation['admission_source_code'] = float(observation['admission_source_code'])
-        elif type(observation['admission_source_code']).__name__ == type(1.0).__name__:
-            if observation['admission_source_code'].is_integer():
-                observation['admission_source_code'] = float(observation['admission_source_code'])
-            elif pd.isna(observation['admission_source_code']):
-                observation['admission_source_code'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'admission_source_code', type(observation['admission_source_code']).__name__,(type(1).__name__))
-                return False, error
-        else:
-            error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'admission_source_code', type(observation['admission_source_code']).__name__,(type(1).__name__))
-            return False, error
-    return True, ''
-
-def check_time_in_hospital(observation):
-    
-    if observation['time_in_hospital']:
-        if type(observation['time_in_hospital']).__name__ == type(1).__name__:
-            observation['time_in_hospital'] = float(observation['time_in_hospital'])
-        elif type(observation['time_in_hospital']).__name__ == type(1.0).__name__:
-            if observation['time_in_hospital'].is_integer():
-                observation['time_in_hospital'] = float(observation['time_in_hospital'])
-            elif pd.isna(observation['time_in_hospital']):
-                observation['time_in_hospital'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'time_in_hospital', type(observation['time_in_hospital']).__name__,(type(1).__name__))
-                return False, error
-        else:
-            error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'time_in_hospital', type(observation['time_in_hospital']).__name__,(type(1).__name__))
-            return False, error
-    
-    if observation['time_in_hospital']:    
-        if observation['time_in_hospital']<0:
-            error = "Invalid value provided for '{}': '{}'. Value cannot be negative".format( 'time_in_hospital', observation['time_in_hospital'])
-            return False, error
-    
-    return True, ''
-
-def check_complete_vaccination_status(observation):
-    #valid_values = [None,"none","complete","incomplete"]
-    
-    if observation['complete_vaccination_status']:
-        if type(observation['complete_vaccination_status']).__name__ == type("").__name__:
-            observation['complete_vaccination_status'] = observation['complete_vaccination_status'].strip()
-        #if observation['complete_vaccination_status'].strip().lower() not in valid_values:
-        #    error = "Invalid value provided for '{}': '{}'. Allowed values are: {}".format( 'complete_vaccination_status' , observation['complete_vaccination_status'], ",".join(["'{}'".format(v) for v in valid_values]))
-        #    return False, error      
-        elif type(observation['complete_vaccination_status']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['complete_vaccination_status']):
-                observation['complete_vaccination_status'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'complete_vaccination_status', type(observation['complete_vaccination_status']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-def check_num_lab_procedures(observation):
-
-    if observation['num_lab_procedures']:
-        if type(observation['num_lab_procedures']).__name__ == type(1).__name__:
-            observation['num_lab_procedures'] = int(observation['num_lab_procedures'])
-        elif type(observation['num_lab_procedures']).__name__ == type(1.0).__name__:
-            if observation['num_lab_procedures'].is_integer():
-                observation['num_lab_procedures'] = int(observation['num_lab_procedures'])
-            elif pd.isna(observation['num_lab_procedures']):
-                observation['num_lab_procedures'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'num_lab_procedures', type(observation['num_lab_procedures']).__name__,(type(1).__name__))
-                return False, error
-    if observation['num_lab_procedures']:
-        if observation['num_lab_procedures']<0:
-            error = "Invalid value provided for '{}': '{}'. Value cannot be negative".format( 'num_lab_procedures', observation['num_lab_procedures'])
-            return False, error
-    return True, ''
-
-def check_num_procedures(observation):
-
-    if observation['num_procedures']:
-        if type(observation['num_procedures']).__name__ == type(1).__name__:
-            observation['num_procedures'] = int(observation['num_procedures'])
-        
-        elif type(observation['num_procedures']).__name__ == type(1.0).__name__:
-            if observation['num_procedures'].is_integer():
-                observation['num_procedures'] = int(observation['num_procedures'])
-            elif pd.isna(observation['num_procedures']):
-                observation['num_procedures'] = None     
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'num_procedures', type(observation['num_procedures']).__name__,(type(1).__name__))
-                return False, error
-    if observation['num_procedures']:    
-        if observation['num_procedures']<0:
-            error = "Invalid value provided for '{}': '{}'. Value cannot be negative".format( 'num_procedures', observation['num_procedures'])
-            return False, error
-    return True, ''
-
-def check_num_medications(observation):
-
-    if observation['num_medications']:
-        if type(observation['num_medications']).__name__ == type(1).__name__:
-            observation['num_medications'] = int(observation['num_medications'])
-        
-        elif type(observation['num_medications']).__name__ == type(1.0).__name__:
-            if observation['num_medications'].is_integer():
-                observation['num_medications'] = int(observation['num_medications'])
-            elif pd.isna(observation['num_medications']):
-                observation['num_medications'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'num_medications', type(observation['num_medications']).__name__,(type(1).__name__))
-                return False, error
-    if observation['num_medications']:   
-        if observation['num_medications']<0:
-            error = "Invalid value provided for '{}': '{}'. Value cannot be negative".format( 'num_medications', observation['num_medications'])
-            return False, error
-    return True, ''
-
-def check_number_outpatient(observation):
-
-    if observation['number_outpatient']:
-        if type(observation['number_outpatient']).__name__ == type(1).__name__:
-            observation['number_outpatient'] = int(observation['number_outpatient'])
-        
-        elif type(observation['number_outpatient']).__name__ == type(1.0).__name__:
-            if observation['number_outpatient'].is_integer():
-                observation['number_outpatient'] = int(observation['number_outpatient'])
-            elif pd.isna(observation['number_outpatient']):
-                observation['number_outpatient'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'number_outpatient', type(observation['number_outpatient']).__name__,(type(1).__name__))
-                return False, error
-            
-    if observation['number_outpatient']:    
-        if observation['number_outpatient']<0:
-            error = "Invalid value provided for '{}': '{}'. Value cannot be negative".format( 'number_outpatient', observation['number_outpatient'])
-            return False, error
-    return True, ''
-
-def check_number_emergency(observation):
-
-    if observation['number_emergency']:
-        if type(observation['number_emergency']).__name__ == type(1).__name__:
-            observation['number_emergency'] = int(observation['number_emergency'])
-        
-        elif type(observation['number_emergency']).__name__ == type(1.0).__name__:
-            if observation['number_emergency'].is_integer():
-                observation['number_emergency'] = int(observation['number_emergency'])
-            elif pd.isna(observation['number_emergency']):
-                observation['number_emergency'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'number_emergency', type(observation['number_emergency']).__name__,(type(1).__name__))
-                return False, error
-    if observation['number_emergency']:    
-        if observation['number_emergency']<0:
-            error = "Invalid value provided for '{}': '{}'. Value cannot be negative".format( 'number_emergency', observation['number_emergency'])
-            return False, error
-    return True, ''
-
-def check_number_inpatient(observation):
-
-    if observation['number_inpatient']:
-        if type(observation['number_inpatient']).__name__ == type(1).__name__:
-            observation['number_inpatient'] = int(observation['number_inpatient'])
-        
-        elif type(observation['number_inpatient']).__name__ == type(1.0).__name__:
-            if observation['number_inpatient'].is_integer():
-                observation['number_inpatient'] = int(observation['number_inpatient'])
-            elif pd.isna(observation['number_inpatient']):
-                observation['number_inpatient'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'number_inpatient', type(observation['number_inpatient']).__name__,(type(1).__name__))
-                return False, error
-    if observation['number_inpatient']:    
-        if observation['number_inpatient']<0:
-            error = "Invalid value provided for '{}': '{}'. Value cannot be negative".format( 'number_inpatient', observation['number_inpatient'])
-            return False, error
-    return True, ''
-
-
-def check_number_diagnoses(observation):
-
-    if observation['number_diagnoses']:
-        if type(observation['number_diagnoses']).__name__ == type(1).__name__:
-            observation['number_diagnoses'] = int(observation['number_diagnoses'])
-        
-        elif type(observation['number_diagnoses']).__name__ == type(1.0).__name__:
-            if observation['number_diagnoses'].is_integer():
-                observation['number_diagnoses'] = int(observation['number_diagnoses'])
-            elif pd.isna(observation['number_diagnoses']):
-                observation['number_diagnoses'] = None               
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'number_diagnoses', type(observation['number_diagnoses']).__name__,(type(1).__name__))
-                return False, error
-    if observation['number_diagnoses']:    
-        if observation['number_diagnoses']<0:
-            error = "Invalid value provided for '{}': '{}'. Value cannot be negative".format( 'number_inpatient', observation['number_diagnoses'])
-            return False, error
-    return True, ''
-
-def check_blood_type(observation):
-    valid_values = [None,"","?","o+","a+","b+","o-","a-","ab+","b-","ab-"]
-    
-    if observation['blood_type']:
-        if type(observation['blood_type']).__name__ == type("").__name__:
-                if observation['blood_type'].strip().lower() not in valid_values:
-                    error = "Invalid value provided for '{}': '{}'. Allowed values are: {}".format( 'blood_type' , observation['blood_type'], ",".join(["'{}'".format(v) for v in valid_values]))
-                    return False, error      
-                else:
-                    observation['blood_type']= observation['blood_type'].strip().lower()
-        elif type(observation['blood_type']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['blood_type']):
-                observation['blood_type'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'blood_type', type(observation['blood_type']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-    
-def check_hemoglobin_level(observation):
-    if observation['hemoglobin_level']:
-        if observation['hemoglobin_level']<0 or observation['hemoglobin_level']>100:
-            error = "Invalid value provided for '{}': '{}'. Value outside expected range".format( 'hemoglobin_level', observation['hemoglobin_level'])
-            return False, error
-    return True, ''
-
-def check_A1Cresult(observation):
-    valid_values = [None,"none","norm",">8",">7"]
-    
-    if observation['A1Cresult']:
-        if type(observation['A1Cresult']).__name__ == type("").__name__:
-                if observation['A1Cresult'].strip().lower() not in valid_values:
-                    error = "Invalid value provided for '{}': '{}'. Allowed values are: {}".format( 'A1Cresult' , observation['A1Cresult'], ",".join(["'{}'".format(v) for v in valid_values]))
-                    return False, error      
-                else:
-                    observation['A1Cresult']= observation['A1Cresult'].strip().lower()
-        elif type(observation['A1Cresult']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['A1Cresult']):
-                observation['A1Cresult'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'A1Cresult', type(observation['A1Cresult']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-def check_max_glu_serum(observation):
-    valid_values = [None,"none","norm",">200",">300"]
-
-    if observation['max_glu_serum']:
-        if type(observation['max_glu_serum']).__name__ == type("").__name__:
-                if observation['max_glu_serum'].strip().lower() not in valid_values:
-                    error = "Invalid value provided for '{}': '{}'. Allowed values are: {}".format( 'max_glu_serum' , observation['max_glu_serum'], ",".join(["'{}'".format(v) for v in valid_values]))
-                    return False, error      
-                else:
-                    observation['max_glu_serum']= observation['max_glu_serum'].strip().lower()
-        elif type(observation['max_glu_serum']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['max_glu_serum']):
-                observation['max_glu_serum'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'max_glu_serum', type(observation['max_glu_serum']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-def check_diuretics(observation):
-    valid_values = [None,"yes","no"]
-    
-    if observation['diuretics']:
-        if type(observation['diuretics']).__name__ == type("").__name__:
-                if observation['diuretics'].strip().lower() not in valid_values:
-                    error = "Invalid value provided for '{}': '{}'. Allowed values are: {}".format( 'diuretics' , observation['diuretics'], ",".join(["'{}'".format(v) for v in valid_values]))
-                    return False, error      
-                else:
-                    observation['diuretics']= observation['diuretics'].strip().lower()
-        elif type(observation['diuretics']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['diuretics']):
-                observation['diuretics'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'diuretics', type(observation['diuretics']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-def check_insulin(observation):
-    valid_values = [None,"yes","no"]
-    
-    if observation['insulin']:
-        if type(observation['insulin']).__name__ == type("").__name__:
-                if observation['insulin'].strip().lower() not in valid_values:
-                    error = "Invalid value provided for '{}': '{}'. Allowed values are: {}".format( 'insulin' , observation['insulin'], ",".join(["'{}'".format(v) for v in valid_values]))
-                    return False, error      
-                else:
-                    observation['insulin']= observation['insulin'].strip().lower()
-        elif type(observation['insulin']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['insulin']):
-                observation['insulin'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'insulin', type(observation['insulin']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-def check_diabetesMed(observation):
-    valid_values = [None,"yes","no"]
-    
-    if observation['diabetesMed']:
-        if type(observation['diabetesMed']).__name__ == type("").__name__:
-                if observation['diabetesMed'].strip().lower() not in valid_values:
-                    error = "Invalid value provided for '{}': '{}'. Allowed values are: {}".format( 'diabetesMed' , observation['diabetesMed'], ",".join(["'{}'".format(v) for v in valid_values]))
-                    return False, error      
-                else:
-                    observation['diabetesMed']= observation['diabetesMed'].strip().lower()
-        elif type(observation['diabetesMed']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['diabetesMed']):
-                observation['diabetesMed'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'diabetesMed', type(observation['diabetesMed']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
-def check_change(observation):
-    valid_values = [None,"ch","no"]
-    
-    if observation['change']:
-        if type(observation['change']).__name__ == type("").__name__:
-                if observation['change'].strip().lower() not in valid_values:
-                    error = "Invalid value provided for '{}': '{}'. Allowed values are: {}".format( 'change' , observation['change'], ",".join(["'{}'".format(v) for v in valid_values]))
-                    return False, error      
-                else:
-                    observation['change']= observation['change'].strip().lower()
-        elif type(observation['change']).__name__ == type(1.0).__name__:
-            if pd.isna(observation['change']):
-                observation['change'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'change', type(observation['change']).__name__,(type(None).__name__))
-                return False, error
-    
-    return True, ''
-
 def check_update_requests(observation):
     valid_columns = {'admission_id',
                      'readmitted'
@@ -781,54 +438,6 @@ def check_update_requests(observation):
 
     return True, "",""
 
-def check_has_prosthesis(observation):
-    
-    if observation['has_prosthesis']:
-        if type(observation['has_prosthesis']).__name__ == type(1).__name__:
-            observation['has_prosthesis'] = int(observation['has_prosthesis'])
-        elif type(observation['has_prosthesis']).__name__ == type(1.0).__name__:
-            if observation['has_prosthesis'].is_integer():
-                observation['has_prosthesis'] = int(observation['has_prosthesis'])
-            elif pd.isna(observation['has_prosthesis']):
-                observation['has_prosthesis'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'has_prosthesis', type(observation['has_prosthesis']).__name__,(type(1).__name__))
-                return False, error
-        if observation['has_prosthesis'] in (True,1):
-            observation['has_prosthesis'] = "1"
-        elif observation['has_prosthesis'] in (False,0):
-            observation['has_prosthesis'] = "0"
-        else:   
-            observation['has_prosthesis'] = "other"
-            #error = "Invalid value provided for '{}': '{}'".format( 'blood_transfusion' , observation['blood_transfusion'])
-            #return False, error       
-    return True, ''
-
-
-def check_blood_transfusion(observation):
-    
-    if observation['blood_transfusion']:
-        if type(observation['blood_transfusion']).__name__ == type(1).__name__:
-            observation['blood_transfusion'] = int(observation['blood_transfusion'])
-        elif type(observation['blood_transfusion']).__name__ == type(1.0).__name__:
-            if observation['blood_transfusion'].is_integer():
-                observation['blood_transfusion'] = int(observation['blood_transfusion'])
-            elif pd.isna(observation['blood_transfusion']):
-                observation['blood_transfusion'] = None
-            else:
-                error = "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format( 'blood_transfusion', type(observation['blood_transfusion']).__name__,(type(1).__name__))
-                return False, error
-        if observation['blood_transfusion'] in (True,1):
-            observation['blood_transfusion'] = "1"
-        elif observation['blood_transfusion'] in (False,0):
-            observation['blood_transfusion'] = "0"
-        else:   
-            observation['blood_transfusion'] = "other"
-            #error = "Invalid value provided for '{}': '{}'".format( 'blood_transfusion' , observation['blood_transfusion'])
-            #return False, error      
-    return True, ''
-
-
 def check_column_types_update(observation):
 
     valid_column_types = {
@@ -855,12 +464,108 @@ def check_readmitted(observation):
     
     return True, ''
 
+def validate_observation(observation, model=None):
+    model = model or load_model()
+    observation_ok, response, warning_description, _ = model.validator.validate(observation)
+    return observation_ok, response, warning_description
+
+
+def score_observation(observation, model=None):
+    
+    model = model or load_model()
+    if not prediction_cache.enabled:
+        return model_probability(observation, model)
+    
+    key = prediction_cache.key(observation, model.columns, model.version)
+    probability = prediction_cache.get(key)
+    stage_metrics.mark('cache')
+    if probability is None:
+        probability = model_probability(observation, model)
+        prediction_cache.set(key, probability)
+    return probability
+
+def score_observations(observations, model=None):
+    
+    model = model or load_model()
+    probabilities = [None] * len(observations)
+    keys = [None] * len(observations)
+    if prediction_cache.enabled:
+        for i, observation in enumerate(observations):
+            keys[i] = prediction_cache.key(observation, model.columns, model.version)
+            probabilities[i] = prediction_cache.get(keys[i])
+        stage_metrics.mark('cache')
+    
+    misses = [i for i, probability in enumerate(probabilities) if probability is None]
+    if misses:
+        for i, probability in zip(misses, model_probabilities([observations[i] for i in misses], model)):
+            probabilities[i] = probability
+            if prediction_cache.enabled:
+                prediction_cache.set(keys[i], probability)
+    
+    return probabilities
+
+def model_probabilities(observations, model):
+    # Each probability is the one model_probability gives the observation on
+    # its own, whatever else is in the batch
+    if model.scorer is not None:
+        try:
+            probabilities = model.scorer.predict_proba_many(observations)
+            stage_metrics.mark('fast_scorer')
+            return probabilities
+        except Exception as e:
+            logger.warning("Fast scorer failed, falling back to the pipeline: {}".format(e))
+    
+    import pandas as pd
+    obs = pd.DataFrame(observations, columns=model.columns).astype(model.dtypes)
+    stage_metrics.mark('dataframe')
+    probabilities = model.pipeline.predict_proba(obs)[:, 1]
+    stage_metrics.mark('predict_proba')
+    return probabilities
+
+def model_probability(observation, model):
+    
+    if batcher.enabled:
+        return batched_probability(observation, model)
+    
+    if model.scorer is not None:
+        try:
+            probability = model.scorer.predict_proba(observation)
+            stage_metrics.mark('fast_scorer')
+            return probability
+        except Exception as e:
+            logger.warning("Fast scorer failed, falling back to the pipeline: {}".format(e))
+    
+    import pandas as pd
+    obs = pd.DataFrame([observation], columns=model.columns).astype(model.dtypes)
+    stage_metrics.mark('dataframe')
+    probability = model.pipeline.predict_proba(obs)[0, 1]
+    stage_metrics.mark('predict_proba')
+    return probability
+
+def batched_probability(observation, model):
+    # Scored with the observations of other requests in one predict_proba call
+    job = batcher.submit(model, observation)
+    probability = job.future.result()
+    stage_metrics.mark('batch_wait', job.started)
+    stage_metrics.mark('batch_score')
+    return probability
+
+# Micro-batching of the observations that /predict requests score at the same
+# time, off unless PREDICT_BATCH_SIZE is above 1: a batch is scored once it has
+# PREDICT_BATCH_SIZE observations or its first one waited PREDICT_BATCH_WAIT_MS
+batcher = MicroBatcher(model_probabilities,
+                       max_batch_size=int(os.environ.get('PREDICT_BATCH_SIZE', 1)),
+                       max_wait=float(os.environ.get('PREDICT_BATCH_WAIT_MS', 2)) / 1000)
+atexit.register(batcher.close)
+
+PREDICTION_THRESHOLD = 0.142
+
 def get_model_prediction(pred_value):
     readmitted = ""
         
-    if pred_value >=0.142:
+    if pred_value >=PREDICTION_THRESHOLD:
         readmitted = "Yes"
-    elif pred_value < 0.142 :
+    elif pred_value < PREDICTION_THRESHOLD :
         readmitted = "No"
         
     return readmitted
@@ -870,288 +575,395 @@ def get_model_prediction(pred_value):
 
 
 ########################################
-# Begin webserver app
+# Compile the fast scorer
 
-app = Flask(__name__)
+def sample_observations():
+    observations = []
+    for name in ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']:
+        if os.path.exists(name):
+            with open(name) as fh:
+                observations += [dict(record['data']) for record in json.load(fh)]
+    return observations
 
-@app.route('/predict', methods=['POST'])
-def predict():
-    
-    warning = False
-    warning_description = ""
+def load_scorer(pipeline, columns, dtypes, validator, stage=profile_stage):
     
-    observation = request.get_json()
+    if os.environ.get('FAST_SCORER', '1') == '0':
+        return None
     
-    request_ok, error_description = check_request_id(observation)
-    if not request_ok:
-        response = {'id': None,'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
-
-    columns_ok, error_description, error_type = check_valid_column(observation)
-    if not columns_ok and error_type=='failure':
-        response = {'admission_id': observation['admission_id'],'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response    
-    
-    if not columns_ok and error_type=='warning':
-        warning_description = error_description
-        warning = True
+    from utils.fast_scorer import compile_scorer
+    try:
+        compiled = compile_scorer(pipeline, dtypes)
+    except ValueError as e:
+        logger.warning("Fast scorer disabled, the pipeline cannot be compiled: {}".format(e))
+        return None
     
-    column_types_ok, error_description = check_column_types(observation)
-    if not column_types_ok:
-        response = {"admission_id": observation['admission_id'], 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
+    # The compiled scorer is only used if it gives exactly the same
+    # probabilities as the pipeline on the sample observations
+    observations = [observation for observation in sample_observations() if validator.validate(observation)[0]]
     
-    admission_id_ok, error_description = check_admission_id(observation)
-    if not admission_id_ok:
-        response = {"admission_id": observation['admission_id'], 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
-    
-    _id = observation['admission_id']
+    stage('model: compile scorer')
     
-    patient_id_ok, error_description = check_patient_id(observation)
-    if not patient_id_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
+    mismatches = compiled.verify(pipeline, observations, columns, dtypes)
+    stage('model: verify scorer')
+    if mismatches:
+        logger.error("Fast scorer disabled, {} of {} sample probabilities differ from the pipeline".format(
+            len(mismatches), len(observations)))
+        return None
     
-    age_ok, error_description = check_age(observation)
-    if not age_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
+    return compiled
 
-    weight_ok, error_description = check_weight(observation)
-    if not weight_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
+prediction_cache = PredictionCache(max_size=int(os.environ.get('PREDICTION_CACHE_SIZE', 10000)),
+                                   ttl=float(os.environ.get('PREDICTION_CACHE_TTL', 3600)))
 
-    race_ok, error_description = check_race(observation)
-    if not race_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
-    
-    diag_1_ok, error_description = check_diag_1(observation)
-    if not diag_1_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
+# End fast scorer
+########################################
 
-    diag_2_ok, error_description = check_diag_2(observation)
-    if not diag_2_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
-    
-    diag_3_ok, error_description = check_diag_3(observation)
-    if not diag_3_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
-    
-    gender_ok, error_description = check_gender(observation)
-    if not gender_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
-    
-    payer_code_ok, error_description = check_payer_code(observation)
-    if not payer_code_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response    
 
-    complete_vaccination_status_ok, error_description = check_complete_vaccination_status(observation)
-    if not complete_vaccination_status_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response      
-    
-    medical_specialty_ok, error_description = check_medical_specialty(observation)
-    if not medical_specialty_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
-    
-    admission_type_code_ok, error_description = check_admission_type_code(observation)
-    if not admission_type_code_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
+########################################
+# Shadow scoring
+
+# With SHADOW_MODEL set to a registry version, observations scored by the
+# active model are scored again by that candidate once the response is ready,
+# in shadow processes forked from the worker, and stored in ShadowPrediction
+# by the worker. The candidate is neither cached nor used for responses
+
+shadow_name = os.environ.get('SHADOW_MODEL') or None
+shadow_model = None
+shadow_lock = threading.Lock()
+# Description of the candidate that scored the latest shadow job
+shadow_loaded = None
+
+def load_shadow_model(name=None):
+    global shadow_model
+    
+    name = name or shadow_name
+    if name is None:
+        return None
+    with shadow_lock:
+        if shadow_model is None or shadow_model.name != name:
+            shadow_model = read_model(name)
+        return shadow_model
+
+def score_shadow(observations, name):
+    # Runs in a shadow process, returns the rows to store. The candidate is
+    # the one loaded before the fork, unless /admin/shadow changed it since
+    model = load_shadow_model(name)
+    # The candidate may expect other columns than the active model
+    observations = [observation for observation in observations if model.validator.validate(dict(observation))[0]]
+    # Not model_probability: the process has no micro-batcher to wait for
+    probabilities = model_probabilities(observations, model) if observations else []
+    
+    now = datetime.datetime.now()
+    rows = [{'admission_id': observation['admission_id'], 'model_version': model.version,
+             'probability': float(probability), 'prediction': get_model_prediction(probability), 'created_date': now}
+            for observation, probability in zip(observations, probabilities)]
+    return model.describe(), rows
+
+def save_shadow(result):
+    global shadow_loaded
+    
+    shadow_loaded, rows = result
+    if not rows:
+        return
+    if writer.enabled:
+        for row in rows:
+            writer.put(ShadowPrediction, row)
+        return
+    with db.connection_context():
+        for rows_chunk in chunked(rows, 100):
+            ShadowPrediction.insert_many(rows_chunk).execute()
+
+shadow = ShadowScorer(score_shadow, save_shadow,
+                      max_workers=int(os.environ.get('SHADOW_WORKERS', 1)),
+                      max_pending=int(os.environ.get('SHADOW_QUEUE_SIZE', 1000)),
+                      batch_size=int(os.environ.get('SHADOW_BATCH_SIZE', 50)),
+                      max_wait=float(os.environ.get('SHADOW_BATCH_WAIT', 0.5)),
+                      niceness=int(os.environ.get('SHADOW_NICE', 10)))
+# Runs before writer.close, so that the last shadow rows are still written
+atexit.register(shadow.close)
+
+def submit_shadow(observations):
+    if shadow_name is not None and shadow.enabled and observations:
+        shadow.submit(observations, shadow_name)
+
+def start_shadow():
+    # Forks the shadow processes of this worker with the candidate loaded,
+    # before its threads start
+    if shadow_name is not None and shadow.enabled:
+        load_shadow_model()
+        shadow.start()
+
+def classification_summary(labels, probabilities, predictions):
+    positives = sum(labels)
+    predicted = sum(predictions)
+    true_positives = sum(1 for label, prediction in zip(labels, predictions) if label and prediction)
+    correct = sum(1 for label, prediction in zip(labels, predictions) if label == prediction)
+    return {'accuracy': correct / len(labels),
+            'precision': true_positives / predicted if predicted else None,
+            'recall': true_positives / positives if positives else None,
+            'brier': sum((p - label) ** 2 for label, p in zip(labels, probabilities)) / len(labels)}
+
+def shadow_report():
+    # Primary and shadow scores of the admissions whose true class was sent
+    # to /update, per shadow model version
+    scored = dict(ShadowPrediction
+                  .select(ShadowPrediction.model_version, fn.COUNT(ShadowPrediction.id))
+                  .group_by(ShadowPrediction.model_version)
+                  .tuples())
+    query = (ShadowPrediction
+             .select(ShadowPrediction.model_version, ShadowPrediction.probability, ShadowPrediction.prediction,
+                     Prediction.probability, Prediction.prediction, Prediction.true_class)
+             .join(Prediction, on=(ShadowPrediction.admission_id == Prediction.admission_id))
+             .where(Prediction.true_class.is_null(False) & (Prediction.true_class != ''))
+             .tuples())
+    
+    labelled = {}
+    for version, shadow_probability, shadow_prediction, probability, prediction, true_class in query:
+        labelled.setdefault(version, []).append((is_positive(true_class), probability, is_positive(prediction),
+                                                 shadow_probability, is_positive(shadow_prediction)))
+    
+    report = {}
+    for version, count in scored.items():
+        rows = labelled.get(version, [])
+        report[version] = {'scored': count, 'labelled': len(rows)}
+        if rows:
+            labels = [row[0] for row in rows]
+            report[version].update(
+                primary=classification_summary(labels, [row[1] for row in rows], [row[2] for row in rows]),
+                shadow=classification_summary(labels, [row[3] for row in rows], [row[4] for row in rows]),
+                agreement=sum(1 for row in rows if row[2] == row[4]) / len(rows),
+                mean_abs_difference=sum(abs(row[1] - row[3]) for row in rows) / len(rows))
+    return report
+
+# End shadow scoring
+########################################
 
-    admission_source_code_ok, error_description = check_admission_source_code(observation)
-    if not admission_source_code_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
-    
-    discharge_disposition_code_ok, error_description = check_discharge_disposition_code(observation)
-    if not discharge_disposition_code_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response    
-    
-    check_time_in_hospital_ok, error_description = check_time_in_hospital(observation)
-    if not check_time_in_hospital_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response 
-    
-    check_complete_vaccination_status_ok, error_description = check_complete_vaccination_status(observation)
-    if not check_complete_vaccination_status_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response   
-    
-    check_num_lab_procedures_ok, error_description = check_num_lab_procedures(observation)
-    if not check_num_lab_procedures_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response   
-    
-    check_num_medications_ok, error_description = check_num_medications(observation)
-    if not check_num_medications_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response  
-    
-    check_num_procedures_ok, error_description = check_num_procedures(observation)
-    if not check_num_procedures_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response   
-    
-    check_number_outpatient_ok, error_description = check_number_outpatient(observation)
-    if not check_number_outpatient_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response   
-    
-    check_number_emergency_ok, error_description = check_number_emergency(observation)
-    if not check_number_emergency_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response   
-    
-    check_number_inpatient_ok, error_description = check_number_inpatient(observation)
-    if not check_number_inpatient_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response   
-    
-    check_number_diagnoses_ok, error_description = check_number_diagnoses(observation)
-    if not check_number_diagnoses_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response   
-    
-    check_blood_type_ok, error_description = check_blood_type(observation)
-    if not check_blood_type_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response   
-    
-    check_hemoglobin_level_ok, error_description = check_hemoglobin_level(observation)
-    if not check_hemoglobin_level_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response   
-    
-    check_max_glu_serum_ok, error_description = check_max_glu_serum(observation)
-    if not check_max_glu_serum_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response
-    
-    check_A1Cresult_ok, error_description = check_A1Cresult(observation)
-    if not check_A1Cresult_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response      
-    
-    check_diuretics_ok, error_description = check_diuretics(observation)
-    if not check_diuretics_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response 
-    
-    check_insulin_ok, error_description = check_insulin(observation)
-    if not check_insulin_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response    
+
+########################################
+# Model quality
+
+# Counters of the labelled predictions, kept up to date by /update and
+# /update_batch in the transaction that stores the label: the confusion matrix
+# at PREDICTION_THRESHOLD and histograms of the scores of positives and
+# negatives (see utils/quality_metrics.py), per day of prediction and model
+# version. /metrics/model only reads these counters
+
+# SQLite retries a busy write lock after growing sleeps, so threads labelling
+# back to back can keep one of them waiting until busy_timeout, when it fails.
+# The threads of a process queue on this lock instead
+sqlite_write_lock = threading.Lock()
+
+@contextlib.contextmanager
+def label_transaction():
+    # The previous label of a prediction must not change between reading it
+    # and updating the counters: SQLite takes the write lock up front, other
+    # databases lock the rows read with `locked`
+    if isinstance(db, SqliteDatabase):
+        with sqlite_write_lock, db.atomic('IMMEDIATE'):
+            yield
+    else:
+        with db.atomic():
+            yield
+
+def locked(query):
+    return query.for_update() if db.for_update else query
+
+def quality_deltas(labels, deltas=None):
+    # `labels` holds (created_date, model_version, prediction, probability,
+    # old label, new label) tuples
+    deltas = {} if deltas is None else deltas
+    for created_date, model_version, prediction, probability, old_label, new_label in labels:
+        for name, delta in counter_deltas(prediction, probability, old_label, new_label).items():
+            key = (created_date.date(), model_version or '', name)
+            deltas[key] = deltas.get(key, 0) + delta
+    return deltas
+
+def add_quality_counts(deltas):
+    rows = [{'day': day, 'model_version': model_version, 'name': name, 'count': delta}
+            for (day, model_version, name), delta in sorted(deltas.items()) if delta]
+    for rows_chunk in chunked(rows, 100):
+        (QualityCounter
+         .insert_many(rows_chunk)
+         .on_conflict(conflict_target=[QualityCounter.day, QualityCounter.model_version, QualityCounter.name],
+                      update={QualityCounter.count: QualityCounter.count + EXCLUDED.count})
+         .execute())
+
+def rebuild_quality_counters():
+    # Recomputes every counter from the Prediction table
+    with label_transaction():
+        QualityCounter.delete().execute()
+        query = (Prediction
+                 .select(Prediction.created_date, Prediction.model_version, Prediction.prediction,
+                         Prediction.probability, Prediction.true_class)
+                 .where(Prediction.true_class.is_null(False))
+                 .tuples())
+        deltas = {}
+        labelled = 0
+        for rows_chunk in chunked(query.iterator(), 1000):
+            quality_deltas([(created_date, model_version, prediction, probability, None, true_class)
+                            for created_date, model_version, prediction, probability, true_class in rows_chunk],
+                           deltas)
+            labelled += len(rows_chunk)
+        add_quality_counts(deltas)
+    return labelled
+
+def model_quality(days=None, model_version=None):
+    # Two reads of the counters: totals per counter, and the confusion matrix
+    # cells per day
+    def counters(*columns):
+        query = QualityCounter.select(*columns, fn.SUM(QualityCounter.count)).group_by(*columns)
+        if days is not None:
+            query = query.where(QualityCounter.day > datetime.date.today() - datetime.timedelta(days=days))
+        if model_version is not None:
+            query = query.where(QualityCounter.model_version == model_version)
+        return query
+    
+    totals = dict(counters(QualityCounter.name).tuples())
+    daily = {}
+    cells = counters(QualityCounter.day, QualityCounter.name).where(QualityCounter.name.in_(['tp', 'fp', 'tn', 'fn']))
+    for day, name, count in cells.tuples():
+        daily.setdefault(str(day), {})[name] = count
+    
+    metrics = summarize(totals)
+    metrics['threshold'] = PREDICTION_THRESHOLD
+    metrics['daily'] = []
+    for day, counts in sorted(daily.items()):
+        confusion = {cell: counts.get(cell, 0) for cell in ('tp', 'fp', 'tn', 'fn')}
+        predicted = confusion['tp'] + confusion['fp']
+        positives = confusion['tp'] + confusion['fn']
+        metrics['daily'].append({'day': day,
+                                 'labelled': sum(confusion.values()),
+                                 'confusion': confusion,
+                                 'precision': confusion['tp'] / predicted if predicted else None,
+                                 'recall': confusion['tp'] / positives if positives else None})
+    return metrics
+
+# A database from before the counters already has labels, which /update only
+# counts from their next change: the new table starts from all of them
+if quality_counters_created:
+    with db.connection_context():
+        if Prediction.select().where(Prediction.true_class.is_null(False)).exists():
+            logger.info("Quality counters rebuilt from {} labelled predictions".format(rebuild_quality_counters()))
+    if DATABASE_POOL:
+        db.close_all()
+
+# End model quality
+########################################
+
+
+########################################
+# Begin webserver app
+
+app = Flask(__name__)
+
+# Latency of each request stage (parse, validate, dataframe, predict_proba,
+# save, ...) per endpoint and outcome, served by /metrics. Stages are marked
+# with `stage_metrics.mark(stage)` once they are done. Under gunicorn,
+# METRICS_DIR holds the histograms of every worker, see utils/metrics.py
+stage_metrics = StageHistograms(os.environ.get('METRICS_DIR'),
+                                flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', 1)),
+                                enabled=os.environ.get('STAGE_METRICS', '1') != '0')
+atexit.register(stage_metrics.close)
+
+# Opt-in profiling of the predict and update views: 1 in PROFILE_SAMPLE_EVERY
+# requests, and with PROFILE_HEADER=1 any request sending an X-Profile header
+# and the admin token. Profiles are aggregated in memory and dumped by
+# /admin/profile, see utils/profiler.py
+request_profiler = RequestProfiler(sample_every=int(os.environ.get('PROFILE_SAMPLE_EVERY', 0)),
+                                   mode=os.environ.get('PROFILE_MODE', 'cprofile'),
+                                   allow_header=os.environ.get('PROFILE_HEADER', '0') == '1',
+                                   interval=float(os.environ.get('PROFILE_INTERVAL', 0.001)),
+                                   header_allowed=lambda request: check_admin_request())
+
+def profiled(view):
+    return request_profiler.wrap(view, request)
+
+@app.before_request
+def open_db_connection():
+    stage_metrics.start_request()
+    db.connect(reuse_if_open=True)
+    follow_model_pointer()
+    stage_metrics.mark('connect')
+
+@app.teardown_request
+def close_db_connection(exc):
+    if db.is_closed():
+        return
+    # A connection that failed may be broken (e.g. after a database restart):
+    # drop it instead of returning it to the pool
+    if DATABASE_POOL and isinstance(exc, (OperationalError, InterfaceError)):
+        db.manual_close()
+    else:
+        db.close()
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    stage_metrics.finish_request(request.endpoint, 'error' if exc is not None else None)
+
+@app.route('/predict', methods=['POST'])
+@profiled
+def predict():
     
-    check_diabetesMed_ok, error_description = check_diabetesMed(observation)
-    if not check_diabetesMed_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response    
+    observation = request.get_json()
+    stage_metrics.mark('parse')
+    model = load_model()
     
-    check_change_ok, error_description = check_change(observation)
-    if not check_change_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response    
+    observation_ok, response, warning_description = validate_observation(observation, model)
+    stage_metrics.mark('validate')
+    if not observation_ok:
+        return reject_observation(observation, response)
     
-    check_has_prosthesis_ok, error_description = check_has_prosthesis(observation)
-    if not check_has_prosthesis_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response  
+    _id = observation['admission_id']
+    if writer.enabled and not reserve_admission_id(_id):
+        return reject_duplicate(observation)
+    stage_metrics.mark('check_id')
 
-    check_blood_transfusion_ok, error_description = check_blood_transfusion(observation)
-    if not check_blood_transfusion_ok:
-        response = {"admission_id": _id, 'error': error_description}
-        r = Request(request=observation, response=response, endpoint='predict', status='error')
-        r.save()
-        return response  
+    try:
+        probability = score_observation(observation, model)
+        return save_prediction(observation, model, probability, warning_description)
+    except Exception:
+        # A failed request must not leave its id reserved
+        if writer.enabled:
+            writer.release(_id)
+        raise
+
+# The steps of /predict after parsing, also run by the ASGI app (asgi.py)
+
+def reject_observation(observation, response):
+    stage_metrics.set_outcome('validation_error')
+    save_request(observation, response, 'predict')
+    stage_metrics.mark('save')
+    return response
+
+def reject_duplicate(observation):
+    _id = observation['admission_id']
+    stage_metrics.set_outcome('duplicate')
+    response = {'id':_id, 'error': "ERROR: Admission ID: '{}' already exists".format(_id)}
+    save_request(observation, response, 'predict')
+    stage_metrics.mark('save')
+    return response
 
-    obs = pd.DataFrame([observation], columns=columns).astype(dtypes)
-    probability = pipeline.predict_proba(obs)[0, 1]
-    prediction = get_model_prediction(pipeline.predict_proba(obs)[0, 1])
+def save_prediction(observation, model, probability, warning_description):
+    # Stores a scored observation, returns the response of /predict
+    warning = warning_description != ""
+    _id = observation['admission_id']
+    prediction = get_model_prediction(probability)
     response = {'readmitted':prediction}
-    p = Prediction(admission_id=_id, probability=probability, prediction=prediction, observation=observation)
+    if writer.enabled:
+        # Waits for the insert: the ids stored by other workers are only known
+        # to the database
+        row = {'admission_id': _id, 'probability': float(probability), 'prediction': prediction,
+               'observation': observation, 'model_version': model.version, 'created_date': datetime.datetime.now()}
+        if not writer.store(Prediction, [row], [_id])[0]:
+            return reject_duplicate(observation)
+        stage_metrics.mark('save')
+        if warning:
+            response['warning'] = warning_description
+        submit_shadow([observation])
+        return response
+
+    p = Prediction(admission_id=_id, probability=probability, prediction=prediction, observation=observation,
+                   model_version=model.version)
     try:
         p.save()
         #r = Request(request=observation, response=response, endpoint='predict', status='success')
@@ -1161,22 +973,204 @@ def predict():
             response['warning'] = warning_description
         #r.save()
     except IntegrityError:
+        stage_metrics.set_outcome('duplicate')
         error_msg = "ERROR: Admission ID: '{}' already exists".format(_id)
         response = {'id':_id, 'error': error_msg}
         db.rollback()
         r = Request(request = observation, response = response, endpoint = 'predict', status = 'error')
         r.save()
+        stage_metrics.mark('save')
         return response
-        
+    stage_metrics.mark('save')
+    
+    submit_shadow([observation])
     return response
 
-@app.route('/update', methods=['POST'])
-def update():
+@app.route('/predict_batch', methods=['POST'])
+@profiled
+def predict_batch():
     
-    warning = False
-    warning_description = ""
+    observations = request.get_json()
+    stage_metrics.mark('parse')
     
-    observation = request.get_json()
+    if not isinstance(observations, list):
+        stage_metrics.set_outcome('validation_error')
+        response = {'error': "Request must be a list of observations"}
+        save_request(observations, response, 'predict_batch')
+        stage_metrics.mark('save')
+        return response
+    
+    return jsonify(predict_observations(observations, load_model(), 'predict_batch'))
+
+def predict_observations(observations, model, endpoint):
+    # Validates, scores and stores a list of observations as /predict_batch
+    # does, returns one result or error per observation in input order
+    results = [None] * len(observations)
+    valid = []
+    failed = []
+    
+    for position, (observation, (observation_ok, response, warning_description, errors)) in enumerate(
+            zip(observations, model.validator.validate_many(observations))):
+        if observation_ok:
+            valid.append((position, observation, warning_description))
+        else:
+            if len(errors) > 1:
+                response = dict(response, errors=errors)
+            results[position] = response
+            failed.append((observation, response))
+    stage_metrics.mark('validate')
+    
+    # Admission ids must stay unique inside the batch, against the write-behind
+    # queue and against the table
+    seen = set()
+    unique = []
+    duplicated = []
+    for position, observation, warning_description in valid:
+        _id = observation['admission_id']
+        if _id in seen or (writer.enabled and not writer.reserve(_id)):
+            duplicated.append((position, observation))
+        else:
+            seen.add(_id)
+            unique.append((position, observation, warning_description))
+    
+    # Until the rows are handed to the writer, a failure must not leave the
+    # ids of the batch reserved
+    try:
+        existing = set()
+        for ids_chunk in chunked(list(seen), 500):
+            query = Prediction.select(Prediction.admission_id).where(Prediction.admission_id.in_(ids_chunk))
+            existing.update(p.admission_id for p in query)
+    
+        to_score = []
+        for position, observation, warning_description in unique:
+            if observation['admission_id'] in existing:
+                if writer.enabled:
+                    writer.release(observation['admission_id'])
+                duplicated.append((position, observation))
+            else:
+                to_score.append((position, observation, warning_description))
+    
+        for position, observation in sorted(duplicated, key=lambda d: d[0]):
+            _id = observation['admission_id']
+            error_msg = "ERROR: Admission ID: '{}' already exists".format(_id)
+            response = {'id':_id, 'error': error_msg}
+            results[position] = response
+            failed.append((observation, response))
+        stage_metrics.mark('check_id')
+    
+        rows = []
+        if to_score:
+            probabilities = score_observations([observation for _, observation, _ in to_score], model)
+            for (position, observation, warning_description), probability in zip(to_score, probabilities):
+                _id = observation['admission_id']
+                prediction = get_model_prediction(probability)
+                response = {'admission_id': _id, 'readmitted': prediction}
+                if warning_description:
+                    response['warning'] = warning_description
+                results[position] = response
+                rows.append({'admission_id': _id, 'probability': float(probability), 'prediction': prediction,
+                             'observation': observation, 'model_version': model.version})
+    except Exception:
+        if writer.enabled:
+            for _id in seen:
+                writer.release(_id)
+        raise
+    
+    errors = [{'request': observation, 'response': response, 'endpoint': endpoint, 'status': 'error'}
+              for observation, response in failed]
+    
+    if writer.enabled:
+        now = datetime.datetime.now()
+        written = writer.store(Prediction, [dict(row, created_date=now) for row in rows],
+                               [row['admission_id'] for row in rows])
+        for (position, _, _), row, row_written in zip(to_score, rows, written):
+            if not row_written:
+                _id = row['admission_id']
+                error_msg = "ERROR: Admission ID: '{}' already exists".format(_id)
+                response = {'id':_id, 'error': error_msg}
+                results[position] = response
+                errors.append({'request': row['observation'], 'response': response, 'endpoint': endpoint, 'status': 'error'})
+        for error in errors:
+            writer.put(Request, dict(error, created_date=now))
+        stage_metrics.mark('save')
+        submit_shadow([observation for position, observation, _ in to_score if 'readmitted' in results[position]])
+        return results
+    
+    try:
+        with db.atomic():
+            for rows_chunk in chunked(rows, 100):
+                Prediction.insert_many(rows_chunk).execute()
+            for errors_chunk in chunked(errors, 100):
+                Request.insert_many(errors_chunk).execute()
+    except IntegrityError:
+        # Another writer inserted one of our ids in the meantime: fall back to
+        # row by row inserts so that only the duplicated ids are rejected
+        positions = {row['admission_id']: position for (position, _, _), row in zip(to_score, rows)}
+        with db.atomic():
+            for row in rows:
+                try:
+                    with db.atomic():
+                        Prediction.insert(row).execute()
+                except IntegrityError:
+                    _id = row['admission_id']
+                    error_msg = "ERROR: Admission ID: '{}' already exists".format(_id)
+                    response = {'id':_id, 'error': error_msg}
+                    results[positions[_id]] = response
+                    errors.append({'request': row['observation'], 'response': response, 'endpoint': endpoint, 'status': 'error'})
+            for errors_chunk in chunked(errors, 100):
+                Request.insert_many(errors_chunk).execute()
+    stage_metrics.mark('save')
+    
+    submit_shadow([observation for position, observation, _ in to_score if 'readmitted' in results[position]])
+    return results
+
+
+# /predict_stream reads newline-delimited observations from the request body
+# while it streams the results back, scoring them in batches of at most
+# PREDICT_STREAM_BATCH_SIZE lines, see utils/ndjson_stream.py
+PREDICT_STREAM_BATCH_SIZE = int(os.environ.get('PREDICT_STREAM_BATCH_SIZE', 64))
+PREDICT_STREAM_MAX_WAIT = float(os.environ.get('PREDICT_STREAM_MAX_WAIT', 0.005))
+PREDICT_STREAM_MAX_LINE = int(os.environ.get('PREDICT_STREAM_MAX_LINE', 1 << 20))
+
+@app.route('/predict_stream', methods=['POST'])
+def predict_stream():
+    
+    model = load_model()
+    batches = NDJSONBatches(request.stream, batch_size=PREDICT_STREAM_BATCH_SIZE, max_wait=PREDICT_STREAM_MAX_WAIT,
+                            max_line=PREDICT_STREAM_MAX_LINE)
+    
+    def results():
+        # The server asks for the next batch of results once the previous one
+        # is sent, so a client reading slowly also slows down the reading
+        try:
+            for batch in batches:
+                lines = [None] * len(batch)
+                positions = []
+                observations = []
+                for position, line in enumerate(batch):
+                    if isinstance(line, LineTooLong):
+                        lines[position] = {'error': "Line longer than {} bytes".format(line.max_line)}
+                        continue
+                    try:
+                        observations.append(json.loads(line))
+                        positions.append(position)
+                    except ValueError as e:
+                        lines[position] = {'error': "Invalid JSON: {}".format(e)}
+                stage_metrics.mark('parse')
+                if observations:
+                    for position, result in zip(positions, predict_observations(observations, model, 'predict_stream')):
+                        lines[position] = result
+                yield ''.join(json.dumps(result) + '\n' for result in lines)
+        finally:
+            batches.close()
+    
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson')
+
+
+def validate_update(observation):
+    # Returns (ok, error response, warning description, admission id as sent)
+    warning_description = ""
+    _id = None
     
     request_ok, error_description = check_request_id(observation)
     if not request_ok:
@@ -1184,7 +1178,7 @@ def update():
         logger.error(response)
         #r = Request(request=observation, response=response, endpoint='update', status='error')
         #r.save()
-        return response
+        return False, response, warning_description, _id
 
 
     _id = observation['admission_id']    
@@ -1195,11 +1189,10 @@ def update():
         logger.error(response)
         #r = Request(request=observation, response=response, endpoint='update', status='error')
         #r.save()
-        return response
+        return False, response, warning_description, _id
     
     if not columns_ok and error_type=='warning':
         warning_description = error_description
-        warning = True
     
     check_column_types_update_ok, error_description = check_column_types_update(observation)
     if not check_column_types_update_ok:
@@ -1207,7 +1200,7 @@ def update():
         logger.error(response)
         #r = Request(request=observation, response=response, endpoint='update', status='error')
         #r.save()
-        return response
+        return False, response, warning_description, _id
     
     admission_id_ok, error_description = check_admission_id(observation)
     if not admission_id_ok:
@@ -1215,7 +1208,7 @@ def update():
         logger.error(response)
         #r = Request(request=observation, response=response, endpoint='update', status='error')
         #r.save()
-        return response
+        return False, response, warning_description, _id
   
     
     check_readmitted_ok, error_description = check_readmitted(observation)
@@ -1224,13 +1217,44 @@ def update():
         logger.error(response)
         #r = Request(request=observation, response=response, endpoint='update', status='error')
         #r.save()
-        return response    
+        return False, response, warning_description, _id
+    
+    return True, None, warning_description, _id
+
+@app.route('/update', methods=['POST'])
+@profiled
+def update():
+    
+    observation = request.get_json()
+    stage_metrics.mark('parse')
+    
+    observation_ok, response, warning_description, _id = validate_update(observation)
+    stage_metrics.mark('validate')
+    if not observation_ok:
+        stage_metrics.set_outcome('validation_error')
+        return response
+    
+    return jsonify(save_label(observation, _id, warning_description))
+
+def save_label(observation, _id, warning_description):
+    # Stores the label of a validated update, returns the response of /update,
+    # also run by the ASGI app (asgi.py)
+    warning = warning_description != ""
   
+    # The prediction may still be waiting in the write-behind queue
+    if writer.enabled and writer.is_pending(_id):
+        writer.flush()
+    
     try:
-        p = Prediction.get(Prediction.admission_id == _id)
-        p.true_class = observation['readmitted']
-        p.modified_date = datetime.datetime.now()
-        p.save()
+        with label_transaction():
+            p = locked(Prediction.select().where(Prediction.admission_id == _id)).get()
+            previous_label = p.true_class
+            p.true_class = observation['readmitted']
+            p.modified_date = datetime.datetime.now()
+            p.save()
+            add_quality_counts(quality_deltas([(p.created_date, p.model_version, p.prediction, p.probability,
+                                                previous_label, p.true_class)]))
+        stage_metrics.mark('save')
         response = {'admission_id':_id, 'actual_readmitted':observation['readmitted'] , "predicted_readmitted":p.prediction }
         if warning:
             response['warning'] = warning_description
@@ -1240,9 +1264,11 @@ def update():
         #d.modified_date = datetime.datetime.now()
         #d.readmitted = observation['readmitted']
         #d.save()
-        return jsonify(response)
+        return response
     
     except Prediction.DoesNotExist:
+        stage_metrics.mark('save')
+        stage_metrics.set_outcome('not_found')
         error_msg = 'Observation ID: "{}" does not exist'.format(observation['admission_id'])
         response = {'error': error_msg}
         #r = Request(request=observation, response=response, endpoint='update', status='error')
@@ -1250,11 +1276,318 @@ def update():
         logger.error(response)
         #r = Request(request=observation, response=response, endpoint='update', status='error')
         #r.save()
-        return jsonify(response)
+        return response
+
+@app.route('/update_batch', methods=['POST'])
+@profiled
+def update_batch():
+    
+    observations = request.get_json()
+    stage_metrics.mark('parse')
+    
+    if not isinstance(observations, list):
+        stage_metrics.set_outcome('validation_error')
+        response = {'error': "Request must be a list of updates"}
+        logger.error(response)
+        return response
+    
+    # Same checks as /update. When an admission id is sent more than once,
+    # its last update is applied
+    results = [None] * len(observations)
+    updates = {}
+    for position, observation in enumerate(observations):
+        if not isinstance(observation, dict):
+            results[position] = {'id': None, 'error': "Update must be an object: {}".format(observation)}
+            continue
+        observation_ok, response, warning_description, _id = validate_update(observation)
+        if not observation_ok:
+            results[position] = response
+            continue
+        admission_id = observation['admission_id']
+        if admission_id in updates:
+            error_msg = 'Admission ID: "{}" is updated again later in the batch'.format(admission_id)
+            results[updates[admission_id][0]] = {'admission_id': updates[admission_id][1], 'error': error_msg}
+        updates[admission_id] = (position, _id, observation['readmitted'], warning_description)
+    stage_metrics.mark('validate')
+    
+    if writer.enabled and any(writer.is_pending(admission_id) for admission_id in updates):
+        writer.flush()
+    
+    # One UPDATE per chunk sets each row's own true_class with a CASE on
+    # admission_id; the other columns, observation included, are not rewritten.
+    # Chunks of 300 ids stay under SQLite's 999 variables per statement
+    now = datetime.datetime.now()
+    predictions = {}
+    deltas = {}
+    with label_transaction():
+        for ids_chunk in chunked(list(updates), 300):
+            query = (Prediction
+                     .select(Prediction.admission_id, Prediction.prediction, Prediction.created_date,
+                             Prediction.model_version, Prediction.probability, Prediction.true_class)
+                     .where(Prediction.admission_id.in_(ids_chunk)))
+            found = {row[0]: row[1:] for row in locked(query).tuples()}
+            if not found:
+                continue
+            true_class = Case(Prediction.admission_id, [(admission_id, updates[admission_id][2]) for admission_id in found])
+            (Prediction
+             .update(true_class=true_class, modified_date=now)
+             .where(Prediction.admission_id.in_(list(found)))
+             .execute())
+            quality_deltas([(created_date, model_version, prediction, probability, previous_label, updates[admission_id][2])
+                            for admission_id, (prediction, created_date, model_version, probability, previous_label)
+                            in found.items()], deltas)
+            predictions.update((admission_id, row[0]) for admission_id, row in found.items())
+        add_quality_counts(deltas)
+    stage_metrics.mark('save')
+    
+    for admission_id, (position, _id, readmitted, warning_description) in updates.items():
+        if admission_id in predictions:
+            response = {'admission_id': _id, 'actual_readmitted': readmitted, 'predicted_readmitted': predictions[admission_id]}
+            if warning_description:
+                response['warning'] = warning_description
+        else:
+            response = {'admission_id': _id, 'error': 'Observation ID: "{}" does not exist'.format(admission_id)}
+            logger.error(response)
+        results[position] = response
+    
+    return jsonify(results)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    
+    return stage_metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/metrics/model', methods=['GET'])
+def metrics_model():
+    
+    try:
+        days = int(request.args['days']) if 'days' in request.args else None
+    except ValueError:
+        return {'error': "`days` must be an integer"}, 400
+    return jsonify(model_quality(days, request.args.get('model_version')))
+
+
+def check_admin_request():
+    # The admin endpoints are closed unless ADMIN_TOKEN is set
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    if not admin_token:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), admin_token)
+
+@app.route('/admin/cache', methods=['GET', 'DELETE'])
+def admin_cache():
+    
+    if not check_admin_request():
+        return {'error': 'Invalid admin token'}, 403
+    
+    if request.method == 'DELETE':
+        prediction_cache.clear()
+    
+    return jsonify(prediction_cache.stats())
+
+@app.route('/admin/db_pool', methods=['GET'])
+def admin_db_pool():
+    
+    if not check_admin_request():
+        return {'error': 'Invalid admin token'}, 403
+    
+    if not DATABASE_POOL:
+        return {'pooled': False}
+    return jsonify(db.stats())
 
+@app.route('/admin/write_behind', methods=['GET', 'POST'])
+def admin_write_behind():
+    
+    if not check_admin_request():
+        return {'error': 'Invalid admin token'}, 403
+    
+    if request.method == 'POST':
+        writer.flush()
+    return jsonify(writer.stats())
+
+@app.route('/admin/batcher', methods=['GET', 'DELETE'])
+def admin_batcher():
+    
+    if not check_admin_request():
+        return {'error': 'Invalid admin token'}, 403
+    
+    if request.method == 'DELETE':
+        batcher.clear()
+    return jsonify(batcher.stats())
+
+@app.route('/admin/model', methods=['GET', 'POST'])
+def admin_model():
+    
+    if not check_admin_request():
+        return {'error': 'Invalid admin token'}, 403
+    
+    status = 200
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        name = body.get('version')
+        if name not in registry.versions():
+            return {'error': "Unknown model version: '{}'".format(name), 'versions': registry.versions()}, 400
+        # The version is loaded in the background unless the caller waits for it
+        if body.get('wait'):
+            status = 200 if switch_model(name) else 500
+        else:
+            model_switch.update(name=name, state='loading', error=None)
+            start_model_switch(name)
+            status = 202
+    
+    return jsonify(model_status()), status
+
+@app.route('/admin/model/rollback', methods=['POST'])
+def admin_model_rollback():
+    
+    if not check_admin_request():
+        return {'error': 'Invalid admin token'}, 403
+    
+    if previous_model is None:
+        return {'error': 'No previous model version to roll back to'}, 409
+    switch_model(previous_model.name)
+    return jsonify(model_status())
+
+def model_status():
+    return {'active': active_model.describe() if active_model else None,
+            'previous': previous_model.describe() if previous_model else None,
+            'published': registry.active_name(),
+            'versions': registry.versions(),
+            'switch': dict(model_switch)}
+
+@app.route('/admin/shadow', methods=['GET', 'POST'])
+def admin_shadow():
+    
+    if not check_admin_request():
+        return {'error': 'Invalid admin token'}, 403
+    
+    global shadow_name
+    if request.method == 'POST':
+        # Changes the candidate of this worker only, SHADOW_MODEL sets it for all
+        body = request.get_json(silent=True) or {}
+        name = body.get('version')
+        if name is not None and name not in registry.versions():
+            return {'error': "Unknown model version: '{}'".format(name), 'versions': registry.versions()}, 400
+        shadow_name = name
+    
+    loaded = shadow_loaded if shadow_loaded is not None and shadow_loaded.get('name') == shadow_name else None
+    return jsonify(dict(shadow.stats(), model=shadow_name, loaded=loaded))
+
+@app.route('/admin/shadow/report', methods=['GET'])
+def admin_shadow_report():
+    
+    if not check_admin_request():
+        return {'error': 'Invalid admin token'}, 403
+    
+    return jsonify(shadow_report())
+
+@app.route('/admin/captures', methods=['GET', 'POST', 'DELETE'])
+def admin_captures():
+    
+    if not check_admin_request():
+        return {'error': 'Invalid admin token'}, 403
+    
+    from utils import custom_transformers
+    
+    response = {}
+    if request.method == 'DELETE':
+        custom_transformers.clear_captures()
+    elif request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        if 'sample_rate' in body:
+            try:
+                custom_transformers.set_capture_sample_rate(float(body['sample_rate']))
+            except (TypeError, ValueError) as e:
+                return {'error': str(e)}, 400
+        if body.get('dump'):
+            response['files'] = custom_transformers.dump_captures(os.environ.get('PIPELINE_CAPTURE_DIR', '.'))
+    
+    response['sample_rate'] = custom_transformers.capture_sample_rate
+    response['captures'] = {step: [{'captured_at': capture['captured_at'],
+                                    'data': json.loads(capture['data'].to_json(orient='split'))}
+                                   for capture in buffer]
+                            for step, buffer in custom_transformers.get_captures().items()}
+    return jsonify(response)
+
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def admin_profile():
+    
+    if not check_admin_request():
+        return {'error': 'Invalid admin token'}, 403
+    
+    # Settings and profiles are those of the worker serving the request
+    response = {}
+    if request.method == 'DELETE':
+        request_profiler.clear()
+    elif request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        try:
+            request_profiler.configure(sample_every=body.get('sample_every'), mode=body.get('mode'),
+                                       allow_header=body.get('allow_header'))
+        except (TypeError, ValueError) as e:
+            return {'error': str(e)}, 400
+        if body.get('dump'):
+            response['files'] = request_profiler.dump(os.environ.get('PROFILE_DIR', '.'))
+    
+    response.update(request_profiler.status())
+    if request.args.get('format') == 'pstats':
+        return request_profiler.stats_report(int(request.args.get('limit', 40))), 200, {'Content-Type': 'text/plain'}
+    if request.args.get('format') == 'collapsed':
+        return request_profiler.collapsed(), 200, {'Content-Type': 'text/plain'}
+    return jsonify(response)
 
 # End webserver app
 ########################################
 
+def print_startup_profile():
+    # Runs the startup in a fresh interpreter, since this one has already
+    # imported everything, and reports the import time of each top-level
+    # package (including those imported while unpickling the model) and the
+    # time of each startup stage
+    import subprocess
+    code = "import json, app; app.load_model(); print(json.dumps(app.startup_profile))"
+    child = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+    
+    packages = {}
+    for line in child.stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('package'):
+            self_us, _, name = line[len('import time:'):].split('|')
+            package = name.strip().split('.')[0]
+            packages[package] = packages.get(package, 0) + int(self_us)
+    
+    print("{:<28} {:>10}".format('imported package', 'ms'))
+    for package, us in sorted(packages.items(), key=lambda p: -p[1])[:20]:
+        print("{:<28} {:>10.1f}".format(package, us / 1000))
+    print()
+    print("{:<28} {:>10}".format('startup stage', 'ms'))
+    stages = json.loads(child.stdout.strip().splitlines()[-1])
+    for stage, seconds in stages:
+        print("{:<28} {:>10.1f}".format(stage, seconds * 1000))
+    print("{:<28} {:>10.1f}".format('total', sum(seconds for _, seconds in stages) * 1000))
+
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--print-startup-profile', action='store_true',
+                        help="print the import and model loading time of each module and exit")
+    parser.add_argument('--rebuild-quality-metrics', action='store_true',
+                        help="recompute the /metrics/model counters from the Prediction table and exit")
+    parser.add_argument('--migrate-observations', action='store_true',
+                        help="rewrite the observations stored as Python reprs as JSON and exit")
+    args = parser.parse_args()
+    
+    if args.print_startup_profile:
+        print_startup_profile()
+    elif args.rebuild_quality_metrics:
+        with db.connection_context():
+            labelled = rebuild_quality_counters()
+        print("Quality counters rebuilt from {} labelled predictions".format(labelled))
+    elif args.migrate_observations:
+        with db.connection_context():
+            migrated, before, after = migrate_observations()
+        print("{} observations rewritten as JSON, observation column {} -> {} bytes".format(migrated, before, after))
+    else:
+        load_model()
+        start_shadow()
+        app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,251 @@
+########################################
+## ASGI serving mode
+##
+## GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c gunicorn.conf.py asgi:app
+## uvicorn asgi:app --port 8000
+##
+## /predict and /update take the same requests and give the same responses as
+## the Flask views of app.py, whose steps they run: parsing and validation on
+## the event loop, scoring in a bounded pool of INFERENCE_WORKERS threads (or
+## processes with INFERENCE_EXECUTOR=process) and database round trips in a
+## pool of DATABASE_THREADS threads, so that a worker keeps serving other
+## requests while one waits for the model, the database or a slow client.
+## Every other endpoint is served by the Flask app, in uvicorn's WSGI thread
+## pool.
+import os
+import json
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from loguru import logger
+from peewee import OperationalError, InterfaceError, SqliteDatabase
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+import app as flask_app
+
+INFERENCE_EXECUTOR = os.environ.get('INFERENCE_EXECUTOR', 'thread')
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', os.cpu_count()))
+# SQLite has one writer at a time, and threads waiting on its busy handler can
+# starve until they fail with `database is locked`: its round trips queue on
+# one thread instead. Other databases get one thread per pooled connection
+DATABASE_THREADS = int(os.environ.get('DATABASE_THREADS') or
+                       (1 if isinstance(flask_app.db, SqliteDatabase) else os.environ.get('DATABASE_MAX_CONNECTIONS', 20)))
+
+if INFERENCE_EXECUTOR not in ('thread', 'process'):
+    raise ValueError("INFERENCE_EXECUTOR must be 'thread' or 'process': '{}'".format(INFERENCE_EXECUTOR))
+
+# Created in each worker process when it starts serving, see `startup`
+inference_executor = None
+database_executor = None
+wsgi = WSGIMiddleware(flask_app.app)
+
+## End setup
+########################################
+
+
+########################################
+## Executors
+
+def waited(function, *args):
+    # The time a call waited for a free thread is its own stage
+    flask_app.stage_metrics.mark('wait')
+    return function(*args)
+
+async def run_in(executor, function, *args):
+    # Runs `function` in a thread of `executor` with the context of the
+    # request, so that its stage marks go to the timer of the request
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(context.run, waited, function, *args))
+
+def with_connection(function, *args):
+    # Checks a connection out for one call and gives it back, as a Flask
+    # request does between its before_request and teardown hooks
+    db = flask_app.db
+    db.connect(reuse_if_open=True)
+    try:
+        return function(*args)
+    except (OperationalError, InterfaceError):
+        # The connection may be broken (e.g. after a database restart)
+        if flask_app.DATABASE_POOL:
+            db.manual_close()
+        raise
+    finally:
+        if not db.is_closed():
+            db.close()
+
+async def in_database(function, *args):
+    return await run_in(database_executor, with_connection, function, *args)
+
+process_model = None
+
+def score_in_process(observation, name, version):
+    # Runs in a process of the inference pool, forked with the model of the
+    # server; it reads the version the server switched to since, if any
+    global process_model
+    model = process_model or flask_app.active_model
+    if model is None or model.version != version:
+        model = process_model = flask_app.read_model(name)
+    return flask_app.score_observation(observation, model)
+
+async def score(observation, model):
+    global inference_executor
+    if INFERENCE_EXECUTOR == 'thread':
+        return await run_in(inference_executor, flask_app.score_observation, observation, model)
+    loop = asyncio.get_running_loop()
+    executor = inference_executor
+    try:
+        probability = await loop.run_in_executor(executor, score_in_process, observation, model.name,
+                                                 model.version)
+    except BrokenProcessPool:
+        # An inference process died: the next requests get a new pool, whose
+        # processes are forked on its first submit
+        if inference_executor is executor:
+            logger.error("Inference process pool broken, starting a new one")
+            inference_executor = ProcessPoolExecutor(INFERENCE_WORKERS)
+            executor.shutdown(wait=False)
+        raise
+    flask_app.stage_metrics.mark('score')
+    return probability
+
+def startup():
+    global inference_executor, database_executor
+    flask_app.load_model()
+    if INFERENCE_EXECUTOR == 'thread':
+        # With micro-batching the threads mostly wait for the batcher, a batch
+        # can only fill up with as many
+        workers = max(INFERENCE_WORKERS, flask_app.batcher.max_batch_size)
+        inference_executor = ThreadPoolExecutor(workers, thread_name_prefix='inference')
+    else:
+        # The processes are forked now, with the model loaded and before the
+        # other threads of the worker start. Each one scores one observation
+        # at a time, there is nothing for a batcher to coalesce
+        flask_app.batcher.max_batch_size = 1
+        inference_executor = ProcessPoolExecutor(INFERENCE_WORKERS)
+        inference_executor.submit(int).result()
+    database_executor = ThreadPoolExecutor(DATABASE_THREADS, thread_name_prefix='database')
+    flask_app.start_shadow()
+
+def shutdown():
+    for executor in (inference_executor, database_executor):
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+## End executors
+########################################
+
+
+########################################
+## Endpoints
+
+async def predict(observation):
+    model = flask_app.load_model()
+
+    observation_ok, response, warning_description = flask_app.validate_observation(observation, model)
+    flask_app.stage_metrics.mark('validate')
+    if not observation_ok:
+        return await in_database(flask_app.reject_observation, observation, response)
+
+    _id = observation['admission_id']
+    if flask_app.writer.enabled and not await in_database(flask_app.reserve_admission_id, _id):
+        return await in_database(flask_app.reject_duplicate, observation)
+    flask_app.stage_metrics.mark('check_id')
+
+    try:
+        probability = await score(observation, model)
+        return await in_database(flask_app.save_prediction, observation, model, probability, warning_description)
+    except BaseException:
+        # A failed or cancelled request must not leave its id reserved
+        if flask_app.writer.enabled:
+            flask_app.writer.release(_id)
+        raise
+
+async def update(observation):
+    observation_ok, response, warning_description, _id = flask_app.validate_update(observation)
+    flask_app.stage_metrics.mark('validate')
+    if not observation_ok:
+        flask_app.stage_metrics.set_outcome('validation_error')
+        return response
+
+    return await in_database(flask_app.save_label, observation, _id, warning_description)
+
+ROUTES = {'/predict': predict, '/update': update}
+
+def is_json(headers):
+    # As Flask's `request.is_json`
+    content_type = headers.get(b'content-type', b'').split(b';')[0].strip().lower()
+    return content_type == b'application/json' or (content_type.startswith(b'application/')
+                                                   and content_type.endswith(b'+json'))
+
+async def read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+async def send_json(send, status, response):
+    # Serialized as Flask's `jsonify`
+    body = (json.dumps(response, sort_keys=True, separators=(',', ':')) + '\n').encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def serve(view, scope, receive, send):
+    stage_metrics = flask_app.stage_metrics
+    stage_metrics.start_request()
+    endpoint = scope['path'].lstrip('/')
+    outcome = None
+    try:
+        flask_app.follow_model_pointer()
+        stage_metrics.mark('connect')
+        body = await read_body(receive)
+        if body is None:
+            endpoint = None
+            return
+        # Like `request.get_json()`: None unless the body is sent as JSON
+        observation = None
+        if is_json(dict(scope['headers'])):
+            try:
+                observation = json.loads(body)
+            except ValueError as e:
+                outcome = 'validation_error'
+                await send_json(send, 400, {'error': "Failed to decode JSON object: {}".format(e)})
+                return
+        stage_metrics.mark('parse')
+        response = await view(observation)
+        await send_json(send, 200, response)
+    except Exception:
+        logger.exception("Error serving {}".format(scope['path']))
+        outcome = 'error'
+        await send_json(send, 500, {'error': 'Internal Server Error'})
+    finally:
+        stage_metrics.finish_request(endpoint, outcome)
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await asyncio.get_running_loop().run_in_executor(None, startup)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(None, shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    view = ROUTES.get(scope['path']) if scope['type'] == 'http' and scope['method'] == 'POST' else None
+    if view is None:
+        await wsgi(scope, receive, send)
+        return
+    await serve(view, scope, receive, send)
+
+## End endpoints
+########################################
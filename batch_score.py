@@ -0,0 +1,396 @@
+########################################
+## Bulk scoring of historical admissions
+##
+## python batch_score.py admissions.ndjson --output scores.ndjson [--database] [--workers 8]
+##
+## Reads observations from a JSON array, NDJSON or CSV file in chunks of
+## --chunk-size rows, validates them with the rules of /predict and scores
+## each chunk with one predict_proba call, on a pool of --workers processes.
+## The model is loaded once, before the workers are forked. Results go to
+## --output (NDJSON or CSV, one line per input row, errors included), and with
+## --database valid predictions are also loaded into the Prediction table.
+##
+## Chunks are written in input order, and after each one the checkpoint file
+## records how many chunks are done and the size of the output. Running the
+## same command again resumes after the last chunk written.
+import os
+import csv
+import json
+import time
+import argparse
+import datetime
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Chunks are scored with the pipeline, which is faster than the compiled
+# scorer on chunks of thousands of rows. Both give each row the probability
+# of /predict, whatever the other rows of its chunk
+os.environ.setdefault('FAST_SCORER', '0')
+os.environ.setdefault('PREDICTION_CACHE_SIZE', '0')
+
+FORMATS = {'.json': 'json', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.csv': 'csv'}
+OUTPUT_FIELDS = ['admission_id', 'prediction', 'probability', 'model_version', 'warning', 'error']
+
+
+########################################
+## Reading the input
+
+def input_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError("Unknown input format '{}', use --format".format(extension))
+    return FORMATS[extension]
+
+def read_json_array(fh, buffer_size=1 << 16):
+    # Items of a JSON array, decoded one at a time so that the file is never
+    # held in memory as a whole
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buffer):
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError("A JSON input must hold an array of observations")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # The item goes on in the next read
+                if eof:
+                    raise
+            else:
+                yield item
+                continue
+        elif eof:
+            raise ValueError("Unexpected end of the JSON array")
+        more = fh.read(buffer_size)
+        eof = not more
+        buffer = buffer[pos:] + more
+        pos = 0
+
+def read_items(path, fmt):
+    # Raw items, decoded in the workers: NDJSON lines, CSV rows with their
+    # header, JSON array items
+    with open(path, newline='' if fmt == 'csv' else None) as fh:
+        if fmt == 'ndjson':
+            for line in fh:
+                if line.strip():
+                    yield line
+        elif fmt == 'csv':
+            reader = csv.reader(fh)
+            header = next(reader, None)
+            for row in reader:
+                yield (header, row)
+        else:
+            yield from read_json_array(fh)
+
+def read_chunks(path, fmt, chunk_size):
+    chunk = []
+    for item in read_items(path, fmt):
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def csv_value(value, types):
+    # CSV cells are text: they are converted to the first type /predict
+    # accepts for the column, and left as text when none fits
+    if value == '':
+        return None if type(None) in types else value
+    if str in types:
+        return value
+    if bool in types and value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    for kind in (int, float):
+        if kind in types:
+            try:
+                return kind(value)
+            except ValueError:
+                pass
+    return value
+
+def decode_item(fmt, item, column_types):
+    # Returns (observation, error)
+    if fmt == 'ndjson':
+        try:
+            item = json.loads(item)
+        except ValueError as e:
+            return None, "Invalid JSON: {}".format(e)
+    elif fmt == 'csv':
+        header, row = item
+        if len(row) != len(header):
+            return None, "Expected {} CSV fields, got {}".format(len(header), len(row))
+        item = {col: csv_value(value, column_types.get(col, (str,))) for col, value in zip(header, row)}
+    # Records of the data files wrap the observation
+    if isinstance(item, dict) and isinstance(item.get('data'), dict):
+        item = item['data']
+    return item, None
+
+# End reading the input
+########################################
+
+
+########################################
+## Scoring, in the worker processes
+
+worker_model = None
+
+def init_worker(name):
+    # Forked workers inherit the model of the parent, others load it
+    global worker_model
+    warnings.filterwarnings('ignore')
+    if worker_model is None or worker_model.name != name:
+        import app
+        worker_model = app.read_model(name)
+
+def score_chunk(fmt, items, with_observations=False):
+    # One result per item, in order: the /predict_batch response of the
+    # observation plus its probability and model version. Valid observations
+    # are returned too when they are to be stored
+    import app
+    model = worker_model
+    column_types = {col: types for col, types, _ in model.validator.column_types}
+    results = [None] * len(items)
+    valid = []
+    for position, item in enumerate(items):
+        observation, error = decode_item(fmt, item, column_types)
+        if error:
+            results[position] = {'admission_id': None, 'error': error}
+            continue
+        observation_ok, response, warning_description, errors = model.validator.validate(observation)
+        if not observation_ok:
+            result = {'admission_id': response.get('admission_id'), 'error': response['error']}
+            if len(errors) > 1:
+                result['errors'] = errors
+            results[position] = result
+            continue
+        valid.append((position, observation, warning_description))
+
+    rows = []
+    if valid:
+        probabilities = app.model_probabilities([observation for _, observation, _ in valid], model)
+        for (position, observation, warning_description), probability in zip(valid, probabilities):
+            result = {'admission_id': observation['admission_id'], 'prediction': app.get_model_prediction(probability),
+                      'probability': float(probability), 'model_version': model.version}
+            if warning_description:
+                result['warning'] = warning_description
+            results[position] = result
+            if with_observations:
+                rows.append(dict(result, observation=observation))
+    return results, rows
+
+def ordered_map(executor, function, tasks, window):
+    # Results in task order, with at most `window` tasks submitted ahead so
+    # that the input is read no faster than it is scored
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(function, *task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+# End scoring
+########################################
+
+
+########################################
+## Writing the results
+
+class Checkpoint:
+    # Progress of a run, replaced atomically after each chunk. A run resumes
+    # only with the same input file, chunk size and model version
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.chunks = 0
+        self.output_size = 0
+        self.counts = {'rows': 0, 'scored': 0, 'errors': 0, 'inserted': 0, 'replaced': 0, 'skipped': 0}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as fh:
+            saved = json.load(fh)
+        if saved['settings'] != self.settings:
+            raise ValueError("Checkpoint {} is for another run: {}, use --restart to start over".format(
+                self.path, saved['settings']))
+        self.chunks = saved['chunks']
+        self.output_size = saved['output_size']
+        self.counts = saved['counts']
+        return True
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump({'settings': self.settings, 'chunks': self.chunks, 'output_size': self.output_size,
+                       'counts': self.counts}, fh)
+        os.replace(tmp, self.path)
+
+class ResultWriter:
+    # NDJSON or CSV output, truncated to the size the checkpoint recorded so
+    # that a chunk written after the last checkpoint is written again
+
+    def __init__(self, path, size):
+        self.path = path
+        self.csv = path.lower().endswith('.csv')
+        if os.path.exists(path):
+            os.truncate(path, size)
+        self.fh = open(path, 'a', newline='' if self.csv else None)
+        if self.csv:
+            self.writer = csv.DictWriter(self.fh, OUTPUT_FIELDS, extrasaction='ignore')
+            if size == 0:
+                self.writer.writeheader()
+
+    def write(self, results):
+        if self.csv:
+            self.writer.writerows(results)
+        else:
+            self.fh.write(''.join(json.dumps(result) + '\n' for result in results))
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        return os.path.getsize(self.path)
+
+    def close(self):
+        self.fh.close()
+
+def save_predictions(rows, replace):
+    # Loads one chunk into the Prediction table in a transaction. Without
+    # `replace`, ids already stored (or seen earlier in the chunk) are
+    # skipped; with it the last row of an id replaces the stored prediction,
+    # keeping its label and dates. Returns (inserted, replaced, skipped)
+    import app
+    from peewee import chunked
+    latest = {}
+    for row in rows:
+        if replace or row['admission_id'] not in latest:
+            latest[row['admission_id']] = row
+    existing = set()
+    for ids_chunk in chunked(list(latest), 500):
+        query = app.Prediction.select(app.Prediction.admission_id).where(app.Prediction.admission_id.in_(ids_chunk))
+        existing.update(p.admission_id for p in query)
+
+    now = datetime.datetime.now()
+    fields = ['admission_id', 'observation', 'prediction', 'probability', 'model_version']
+    new = [dict({field: row[field] for field in fields}, created_date=now)
+           for _id, row in latest.items() if _id not in existing]
+    replaced = [{field: row[field] for field in fields} for _id, row in latest.items() if _id in existing] if replace else []
+    P = app.Prediction
+    with app.db.atomic():
+        for rows_chunk in chunked(new, 100):
+            P.insert_many(rows_chunk).on_conflict_ignore().execute()
+        for rows_chunk in chunked(replaced, 100):
+            (P.insert_many([dict(row, created_date=now) for row in rows_chunk])
+             .on_conflict(conflict_target=[P.admission_id],
+                          update={P.observation: app.EXCLUDED.observation, P.prediction: app.EXCLUDED.prediction,
+                                  P.probability: app.EXCLUDED.probability, P.model_version: app.EXCLUDED.model_version})
+             .execute())
+    return len(new), len(replaced), len(rows) - len(new) - len(replaced)
+
+# End writing the results
+########################################
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score a file of observations with the model of app.py")
+    parser.add_argument('input', help="JSON array, NDJSON (.ndjson, .jsonl) or CSV file of observations")
+    parser.add_argument('--format', choices=sorted(set(FORMATS.values())), help="input format, by default from the extension")
+    parser.add_argument('--output', help="NDJSON or CSV (.csv) file of the results")
+    parser.add_argument('--database', action='store_true', help="load the predictions into the Prediction table")
+    parser.add_argument('--replace', action='store_true',
+                        help="replace the predictions already stored for an admission id instead of skipping them")
+    parser.add_argument('--model-version', help="registry version to score with, by default the active one")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="scoring processes (default: one per CPU)")
+    parser.add_argument('--chunk-size', type=int, default=5000, help="rows per chunk (default 5000)")
+    parser.add_argument('--checkpoint', help="checkpoint file, by default <output or input>.checkpoint")
+    parser.add_argument('--restart', action='store_true', help="ignore an existing checkpoint and start over")
+    parser.add_argument('--max-chunks', type=int, help="stop after this many chunks, to be resumed later")
+    args = parser.parse_args(argv)
+
+    if not args.output and not args.database:
+        parser.error("nothing to do: give --output and/or --database")
+    fmt = args.format or input_format(args.input)
+
+    global worker_model
+    warnings.filterwarnings('ignore')
+    import app
+    from loguru import logger
+
+    name = args.model_version or app.registry.active_name()
+    if name not in app.registry.versions():
+        parser.error("unknown model version '{}', available: {}".format(name, ', '.join(app.registry.versions())))
+    worker_model = app.read_model(name)
+
+    stat = os.stat(args.input)
+    settings = {'input': os.path.abspath(args.input), 'input_size': stat.st_size, 'input_mtime': stat.st_mtime,
+                'format': fmt, 'chunk_size': args.chunk_size, 'model_version': worker_model.version,
+                'output': os.path.abspath(args.output) if args.output else None, 'database': args.database,
+                'replace': args.replace}
+    checkpoint = Checkpoint(args.checkpoint or (args.output or args.input) + '.checkpoint', settings)
+    if args.restart and os.path.exists(checkpoint.path):
+        os.remove(checkpoint.path)
+    if checkpoint.load():
+        logger.info("Resuming {} after chunk {} ({} rows)".format(args.input, checkpoint.chunks, checkpoint.counts['rows']))
+    writer = ResultWriter(args.output, checkpoint.output_size) if args.output else None
+
+    chunks = read_chunks(args.input, fmt, args.chunk_size)
+    tasks = ((fmt, chunk, args.database) for i, chunk in enumerate(chunks) if i >= checkpoint.chunks)
+    if args.max_chunks is not None:
+        tasks = (task for task, _ in zip(tasks, range(args.max_chunks)))
+
+    executor = ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(name,)) if args.workers > 1 else None
+    results = ordered_map(executor, score_chunk, tasks, 2 * args.workers) if executor else (score_chunk(*task) for task in tasks)
+
+    start = time.perf_counter()
+    rows_done = 0
+    counts = checkpoint.counts
+    if args.database:
+        app.db.connect(reuse_if_open=True)
+    try:
+        for chunk_results, rows in results:
+            if writer:
+                checkpoint.output_size = writer.write(chunk_results)
+            if args.database:
+                inserted, replaced, skipped = save_predictions(rows, args.replace)
+                counts['inserted'] += inserted
+                counts['replaced'] += replaced
+                counts['skipped'] += skipped
+            errors = sum(1 for result in chunk_results if 'error' in result)
+            counts['rows'] += len(chunk_results)
+            counts['errors'] += errors
+            counts['scored'] += len(chunk_results) - errors
+            checkpoint.chunks += 1
+            checkpoint.save()
+            rows_done += len(chunk_results)
+            logger.info("Chunk {}: {} rows, {:.0f} rows/s".format(checkpoint.chunks, counts['rows'],
+                                                                  rows_done / (time.perf_counter() - start)))
+        # Replaced predictions may be labelled, their quality counters are
+        # recomputed
+        if args.database and counts['replaced']:
+            app.rebuild_quality_counters()
+    finally:
+        if executor:
+            executor.shutdown()
+        if writer:
+            writer.close()
+        if args.database:
+            app.db.close()
+
+    print(json.dumps(dict(counts, chunks=checkpoint.chunks, model_version=worker_model.version,
+                          seconds=round(time.perf_counter() - start, 3))))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+########################################
+## The Flask app under gunicorn (gthread workers, app:app) side by side with
+## the ASGI app under gunicorn's uvicorn workers (asgi:app), same number of
+## workers and a new SQLite database each. Both first get the same sequence of
+## /predict and /update requests, valid and invalid, and must give the same
+## responses. Then `--clients` concurrent keep-alive clients each post
+## /predict then /update requests for `--seconds`, once sending each request
+## at once and once as slow clients that send the body `--slow-ms` after the
+## headers, and the throughput, p50/p99 latency and errors are reported.
+##
+## Usage: python benchmarks/bench_asgi.py [--workers 1] [--clients 8 64 256] [--seconds 10] [--slow-ms 200]
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import tempfile
+import argparse
+import subprocess
+import http.client
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import bench_replay
+
+SERVERS = [('flask gthread', 'app:app', {}),
+           ('asgi uvicorn', 'asgi:app', {'GUNICORN_WORKER_CLASS': 'uvicorn.workers.UvicornWorker'})]
+
+ID_BASE = 10**8
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(target, env, workers, tmp):
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, 'bench.db')), PORT=str(port),
+               WEB_CONCURRENCY=str(workers), SQLITE_PROFILE='production', PYTHONHASHSEED='0', **env)
+    gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    gunicorn = gunicorn if os.path.exists(gunicorn) else 'gunicorn'
+    process = subprocess.Popen([gunicorn, '-c', 'gunicorn.conf.py', target], cwd=ROOT,
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/metrics')
+            if connection.getresponse().status == 200:
+                return process, port
+        except OSError:
+            time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError("{} did not start".format(target))
+
+
+def stop_server(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    process.wait()
+
+
+def contract_responses(port):
+    # Responses to the request files of bench_replay, sent one at a time
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    responses = []
+    for path, payloads in bench_replay.workload(1, 0):
+        for payload in payloads:
+            connection.request('POST', path, json.dumps(payload), {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            responses.append((path, response.status, response.read()))
+    return responses
+
+
+async def post(reader, writer, path, payload, slow):
+    body = json.dumps(payload).encode()
+    writer.write('POST {} HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                 .format(path, len(body)).encode())
+    if slow:
+        await writer.drain()
+        await asyncio.sleep(slow)
+    writer.write(body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode().partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def client(port, observations, ids, seconds, slow, latencies, errors):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    deadline = time.perf_counter() + seconds
+    try:
+        while time.perf_counter() < deadline:
+            _id = next(ids)
+            observation = dict(observations[_id % len(observations)], admission_id=_id)
+            for path, payload in (('/predict', observation), ('/update', {'admission_id': _id, 'readmitted': 'Yes'})):
+                start = time.perf_counter()
+                try:
+                    status = await post(reader, writer, path, payload, slow)
+                except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                    errors.append('connection')
+                    return
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    errors.append(status)
+    finally:
+        writer.close()
+
+
+async def load(port, observations, clients, seconds, slow):
+    ids = iter(range(ID_BASE, 2**31))
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(port, observations, ids, seconds, slow, latencies, errors)
+                           for _ in range(clients)])
+    return time.perf_counter() - start, sorted(latencies), errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help="gunicorn workers of both servers")
+    parser.add_argument('--clients', type=int, nargs='+', default=[8, 64, 256])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--slow-ms', type=float, default=200, help="delay between the headers and the body of slow clients")
+    args = parser.parse_args()
+
+    observations = [observation for observation in bench_replay.read_observations('data.json')]
+    contracts = {}
+    results = []
+    for name, target, env in SERVERS:
+        with tempfile.TemporaryDirectory() as tmp:
+            process, port = start_server(target, env, args.workers, tmp)
+            try:
+                contracts[name] = contract_responses(port)
+                for clients in args.clients:
+                    for slow in (0, args.slow_ms / 1000):
+                        seconds, latencies, errors = asyncio.run(load(port, observations, clients, args.seconds, slow))
+                        results.append((name, clients, slow, len(latencies) / seconds,
+                                        bench_replay.percentile(latencies, 50), bench_replay.percentile(latencies, 99),
+                                        len(errors)))
+            finally:
+                stop_server(process)
+
+    (first, expected), (second, actual) = contracts.items()
+    assert expected == actual, "{} and {} give different responses".format(first, second)
+    print("same responses to {} requests".format(len(expected)))
+
+    print("{:<14} {:>8} {:>8} {:>9} {:>9} {:>9} {:>7}".format('server', 'clients', 'slow ms', 'req/s', 'p50 ms',
+                                                               'p99 ms', 'errors'))
+    for name, clients, slow, throughput, p50, p99, errors in results:
+        print("{:<14} {:>8} {:>8.0f} {:>9.0f} {:>9.1f} {:>9.1f} {:>7}".format(name, clients, slow * 1000, throughput,
+                                                                            p50 * 1000, p99 * 1000, errors))
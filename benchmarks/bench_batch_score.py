@@ -0,0 +1,94 @@
+########################################
+## Rows per second of batch_score.py on a generated NDJSON file (the
+## observations of the data files repeated with shifted admission ids, every
+## 7th one without `diabetesMed`) for each of `--workers`, checking that every
+## worker count writes the same results, that a run stopped after two chunks
+## and resumed writes them too, and that the first 600 rows get the same
+## results one row per chunk as in one chunk. Each run scores into a new
+## SQLite database with --database.
+##
+## Usage: python benchmarks/bench_batch_score.py [--rows 100000] [--workers 1 2 4] [--chunk-size 5000]
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_FILES = ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']
+
+
+def write_input(path, rows):
+    observations = []
+    for name in DATA_FILES:
+        with open(os.path.join(ROOT, name)) as fh:
+            observations += [record['data'] for record in json.load(fh)]
+    with open(path, 'w') as fh:
+        for i in range(rows):
+            observation = observations[i % len(observations)]
+            copy = i // len(observations)
+            if isinstance(observation.get('admission_id'), int):
+                observation = dict(observation, admission_id=observation['admission_id'] + copy * 10**6)
+            if i % 7 == 0:
+                observation = dict(observation, diabetesMed=None)
+            fh.write(json.dumps(observation) + '\n')
+
+
+def batch_score(tmp, name, input_path, workers, chunk_size, *extra):
+    # Runs batch_score.py into `name`.ndjson and `name`.db, returns the
+    # seconds it took and its counts
+    env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, name + '.db')),
+               PYTHONHASHSEED='0')
+    command = [sys.executable, 'batch_score.py', input_path, '--output', os.path.join(tmp, name + '.ndjson'),
+               '--database', '--workers', str(workers), '--chunk-size', str(chunk_size)] + list(extra)
+    start = time.perf_counter()
+    output = subprocess.run(command, cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+    return time.perf_counter() - start, json.loads(output.strip().splitlines()[-1])
+
+
+def read_output(tmp, name):
+    with open(os.path.join(tmp, name + '.ndjson'), 'rb') as fh:
+        return fh.read()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, 'input.ndjson')
+        write_input(input_path, args.rows)
+
+        print("{:<8} {:>10} {:>10} {:>8}  {}".format('workers', 'seconds', 'rows/s', 'speedup', 'counts'))
+        first = None
+        for workers in args.workers:
+            seconds, counts = batch_score(tmp, 'workers{}'.format(workers), input_path, workers, args.chunk_size)
+            if first is None:
+                first = (workers, seconds)
+            else:
+                assert read_output(tmp, 'workers{}'.format(workers)) == read_output(tmp, 'workers{}'.format(first[0])), \
+                    "--workers {} writes other results than --workers {}".format(workers, first[0])
+            print("{:<8} {:>10.2f} {:>10.0f} {:>7.2f}x  inserted {inserted}, errors {errors}".format(
+                workers, seconds, args.rows / seconds, first[1] / seconds, **counts))
+
+        # Stopped after two chunks then resumed from the checkpoint
+        batch_score(tmp, 'resumed', input_path, args.workers[-1], args.chunk_size, '--max-chunks', '2')
+        _, counts = batch_score(tmp, 'resumed', input_path, args.workers[-1], args.chunk_size)
+        assert read_output(tmp, 'resumed') == read_output(tmp, 'workers{}'.format(first[0])), \
+            "a resumed run writes other results than a full one"
+        print("resumed after 2 chunks: same results, inserted {inserted}".format(**counts))
+
+        # A row's result does not depend on the rows scored with it
+        write_input(input_path, 600)
+        batch_score(tmp, 'chunk1', input_path, args.workers[-1], 1)
+        batch_score(tmp, 'chunk600', input_path, args.workers[-1], 600)
+        assert read_output(tmp, 'chunk1') == read_output(tmp, 'chunk600'), \
+            "--chunk-size 1 and --chunk-size 600 write different results"
+        print("chunks of 1 and 600 rows: same results")
@@ -0,0 +1,97 @@
+########################################
+## Checks that the vectorized CategoricalTransformer.transform gives the same
+## output as the row by row implementation, and times both of them.
+##
+## Usage: python benchmarks/bench_categorical_transformer.py [--rows 100000]
+
+import os
+import sys
+import json
+import time
+import argparse
+import warnings
+
+import joblib
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DATA_FILES = ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']
+
+
+def load_observations():
+    observations = []
+    for name in DATA_FILES:
+        with open(os.path.join(ROOT, name)) as fh:
+            observations += [record['data'] for record in json.load(fh)]
+    return observations
+
+
+def load_transformer():
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        pipeline = joblib.load(os.path.join(ROOT, 'pipeline.pickle'))
+    return pipeline.named_steps['preprocessor'].transformer_list[0][1].named_steps['transformer']
+
+
+def transform(transformer, X, vectorized):
+    # Forces the requested mode whatever the number of rows
+    transformer.vectorized = vectorized
+    transformer.vectorized_min_rows = 1
+    try:
+        return transformer.transform(X)
+    finally:
+        del transformer.vectorized, transformer.vectorized_min_rows
+
+
+def check_equivalence(transformer, frames):
+    for name, X in frames:
+        expected = transform(transformer, X, vectorized=False)
+        result = transform(transformer, X, vectorized=True)
+        pd.testing.assert_frame_equal(expected, result)
+        print("{:<40} {:>8} rows: identical output".format(name, len(X)))
+
+
+def time_transform(transformer, X, vectorized, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        transform(transformer, X, vectorized)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    transformer = load_transformer()
+    observations = load_observations()
+    # diag_2 and diag_3 need category lists that the served model was not fitted with
+    columns = sorted(col for col in transformer.transformed_columns - {'readmitted'}
+                     if col not in ('diag_2', 'diag_3') or hasattr(transformer, col))
+
+    raw = pd.DataFrame(observations).reindex(columns=columns)
+    scaled = raw.sample(args.rows, replace=True, random_state=args.seed).reset_index(drop=True)
+    # Mixed python types in the boolean columns, as sent by different clients
+    mixed = scaled.copy()
+    for col in ['has_prosthesis', 'blood_transfusion']:
+        mixed[col] = mixed[col].astype(object)
+        mixed.loc[mixed.index % 3 == 0, col] = mixed.loc[mixed.index % 3 == 0, col].map({True: 1, False: 0})
+        mixed.loc[mixed.index % 5 == 0, col] = None
+
+    frames = [(', '.join(DATA_FILES), raw), ('resampled', scaled), ('resampled with mixed types', mixed), ('single row', raw.head(1))]
+
+    check_equivalence(transformer, frames)
+
+    print()
+    print("{:>10} {:>12} {:>12} {:>8}".format('rows', 'row by row', 'vectorized', 'speedup'))
+    for rows in [1, 100, 1000, args.rows]:
+        X = scaled.head(rows)
+        rowwise = time_transform(transformer, X, vectorized=False)
+        vectorized = time_transform(transformer, X, vectorized=True)
+        print("{:>10} {:>11.4f}s {:>11.4f}s {:>7.1f}x".format(rows, rowwise, vectorized, rowwise / vectorized))
@@ -0,0 +1,93 @@
+########################################
+## Overhead of the /metrics stage histograms on /predict. The instrumentation
+## of one request (start, the seven stage marks of /predict and the histogram
+## update) is timed on its own and compared with the median /predict latency,
+## then /predict is timed end to end with STAGE_METRICS=0 and 1, alternating
+## runs of each, each against a fresh database and without prediction cache.
+##
+## Usage: python benchmarks/bench_metrics.py [--requests 2000] [--rounds 3]
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.metrics import StageHistograms
+
+CLIENT = r'''
+import os, sys, json, time, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.getcwd())
+from loguru import logger
+logger.remove()
+import app
+
+n = int(sys.argv[1])
+observations = []
+for name in ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']:
+    with open(name) as fh:
+        observations += [record['data'] for record in json.load(fh)]
+
+client = app.app.test_client()
+app.load_model()
+latencies = []
+for i in range(n):
+    observation = dict(observations[i % len(observations)], admission_id=10**9 + i)
+    start = time.perf_counter()
+    client.post('/predict', json=observation)
+    latencies.append(time.perf_counter() - start)
+print(json.dumps(latencies))
+'''
+
+STAGES = ['connect', 'parse', 'validate', 'check_id', 'cache', 'fast_scorer', 'save']
+
+
+def instrumentation_seconds(directory, n=20000):
+    histograms = StageHistograms(directory)
+    start = time.perf_counter()
+    for _ in range(n):
+        histograms.start_request()
+        for stage in STAGES:
+            histograms.mark(stage)
+        histograms.finish_request('predict')
+    elapsed = (time.perf_counter() - start) / n
+    histograms.close()
+    return elapsed
+
+
+def predict_latency(enabled, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, 'bench.db')),
+                   PREDICTION_CACHE_SIZE='0', STAGE_METRICS=enabled, METRICS_DIR=os.path.join(tmp, 'metrics'))
+        output = subprocess.run([sys.executable, '-c', CLIENT, str(args.requests)], cwd=ROOT, env=env,
+                                check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    latencies = {'0': [], '1': []}
+    for _ in range(args.rounds):
+        for enabled in ['0', '1']:
+            latencies[enabled] += predict_latency(enabled, args)
+    off = statistics.median(latencies['0'])
+    on = statistics.median(latencies['1'])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cost = instrumentation_seconds(tmp)
+    print("instrumentation per request: {:.1f} us, {:.2f}% of the median /predict latency".format(
+        cost * 1e6, 100 * cost / off))
+    print("{:<14} {:>14}".format('STAGE_METRICS', 'median ms'))
+    print("{:<14} {:>14.3f}".format('0', off * 1000))
+    print("{:<14} {:>14.3f}   {:+.2f}%".format('1', on * 1000, 100 * (on - off) / off))
@@ -0,0 +1,252 @@
+########################################
+## Microbenchmarks of the pure-Python hot paths: the CategoricalTransformer
+## helpers per value, CategoricalTransformer.transform and
+## NumericalTransformer.transform of the served pipeline at 1, 1000 and
+## 100000 rows, and the /predict and /update validator chains of app.py on
+## valid and invalid payloads. Inputs are drawn with a fixed seed from the
+## values of the data files and the categories of the lookup CSVs (age.csv,
+## race.csv, medical.csv, ...), with some missing and differently written
+## values. Each case reports the best of several runs.
+##
+## Usage: python benchmarks/bench_micro.py [--rows 1 1000 100000] [--filter transform]
+##                                         [--save results.json] [--baseline benchmarks/baselines/micro.json]
+
+import os
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import tempfile
+import warnings
+
+import joblib
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+DATA_FILES = ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']
+
+# Lookup CSVs of the categories of a column, as written after pre-processing
+LOOKUPS = {'age': 'age.csv', 'gender': 'gender.csv', 'race': 'race.csv', 'medical_specialty': 'medical.csv',
+           'payer_code': 'payer_code.csv', 'admission_source_code': 'admission_source_code.csv'}
+
+# Share of the generated values taken from the data files, from the lookup
+# CSV, and written as one of the MISSING markers
+SOURCES = {'observed': 0.6, 'lookup': 0.35, 'missing': 0.05}
+MISSING = [None, float('nan'), '?', 'Unknown/Invalid', 'None', '']
+
+# Validation only lets numbers and missing values through for these
+CODE_COLUMNS = {'admission_type_code', 'admission_source_code', 'discharge_disposition_code'}
+
+# Field values that fail validation, as in bench_validation.py
+INVALID_VALUES = [('age', 3.5), ('blood_type', 'zz'), ('time_in_hospital', -1), ('num_procedures', 1.5),
+                  ('hemoglobin_level', 150), ('diuretics', 'maybe'), ('patient_id', 'a'), ('race', 1.0)]
+INVALID_UPDATES = [('readmitted', 'maybe'), ('readmitted', 1), ('admission_id', 1.5), ('extra', 'x')]
+
+HELPER_VALUES = 10000
+
+
+def load_observations():
+    observations = []
+    for name in DATA_FILES:
+        with open(name) as fh:
+            observations += [record['data'] for record in json.load(fh)]
+    return observations
+
+
+def load_pipeline():
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return joblib.load('pipeline.pickle')
+
+
+def named_step(pipeline, name):
+    # The Pipeline step holding a transformer of class `name`
+    for step in [pipeline] + [step for _, step in pipeline.named_steps['preprocessor'].transformer_list]:
+        for transformer in step.named_steps.values():
+            if type(transformer).__name__ == name:
+                return transformer
+    raise LookupError(name)
+
+
+def spellings(value, rng):
+    # How clients write a category that the lookup CSVs hold pre-processed
+    if not isinstance(value, str) or value == 'missing':
+        return '?' if value == 'missing' else value
+    return rng.choice([value, value.upper(), value.title(), ' ' + value])
+
+
+def column_values(column, observed, n, rng):
+    lookup = []
+    if column in LOOKUPS:
+        lookup = pd.read_csv(LOOKUPS[column])[column].tolist()
+    if column.startswith('diag_'):
+        # ICD-9 codes: numeric with and without decimals, V and E codes
+        lookup = [str(rng.randint(1, 999)) for _ in range(300)] + \
+                 ['{}.{}'.format(rng.randint(1, 999), rng.randint(0, 99)) for _ in range(100)] + \
+                 ['V{}'.format(rng.randint(1, 90)) for _ in range(30)] + ['E{}'.format(rng.randint(800, 999)) for _ in range(20)]
+    missing = MISSING
+    if column in CODE_COLUMNS:
+        lookup = [int(value) for value in lookup if str(value).isdigit()]
+        missing = [None, float('nan')]
+    sources = [source for source in SOURCES if {'observed': observed, 'lookup': lookup, 'missing': True}[source]]
+    weights = [SOURCES[source] for source in sources]
+    values = []
+    for source in rng.choices(sources, weights, k=n):
+        if source == 'observed':
+            values.append(rng.choice(observed))
+        elif source == 'lookup':
+            values.append(spellings(rng.choice(lookup), rng))
+        else:
+            values.append(rng.choice(missing))
+    return values
+
+
+def observed_values(observations, column):
+    return [observation[column] for observation in observations if column in observation]
+
+
+def generate_frame(columns, observations, n, rng, missing=True):
+    frame = {}
+    for column in columns:
+        observed = observed_values(observations, column)
+        if missing:
+            frame[column] = column_values(column, observed, n, rng)
+        else:
+            frame[column] = [rng.choice(observed) for _ in range(n)]
+    return pd.DataFrame(frame, columns=columns)
+
+
+def best_seconds(function, setup, min_seconds=0.2, repeat=5):
+    # Best mean time of a call over `repeat` runs of calls lasting at least
+    # `min_seconds`. `setup` makes the argument of each call, untimed
+    best = float('inf')
+    for _ in range(repeat):
+        elapsed = 0.0
+        calls = 0
+        while elapsed < min_seconds:
+            argument = setup()
+            start = time.perf_counter()
+            function(argument)
+            elapsed += time.perf_counter() - start
+            calls += 1
+        best = min(best, elapsed / calls)
+    return best
+
+
+def helper_cases(transformer, observations, rng):
+    # Seconds per value of each helper, on values as they reach it in
+    # `transform_column`
+    raw = column_values('race', observed_values(observations, 'race'), HELPER_VALUES, rng)
+    texts = [transformer.pre_process_text(v)
+             for v in column_values('medical_specialty', observed_values(observations, 'medical_specialty'), HELPER_VALUES, rng)]
+    diags = [transformer.handle_missing_values(transformer.pre_process_text(v))
+             for v in column_values('diag_1', observed_values(observations, 'diag_1'), HELPER_VALUES, rng)]
+    categories = set(transformer.medical_specialty)
+    cases = {
+        'pre_process_text': (lambda values: [transformer.pre_process_text(v) for v in values], raw),
+        'handle_missing_values': (lambda values: [transformer.handle_missing_values(v) for v in values], texts),
+        'handle_categories': (lambda values: [transformer.handle_categories(v, categories) for v in values], texts),
+        'create_diag_category': (lambda values: [transformer.create_diag_category(v) for v in values], diags),
+    }
+    return {name: (function, (lambda values=values: values), HELPER_VALUES, 'value')
+            for name, (function, values) in cases.items()}
+
+
+def transform_cases(pipeline, observations, rows, rng):
+    categorical = named_step(pipeline, 'CategoricalTransformer')
+    numerical = named_step(pipeline, 'NumericalTransformer')
+    # diag_2 and diag_3 need category lists that the served model was not fitted with
+    categorical_columns = sorted(col for col in categorical.transformed_columns - {'readmitted'}
+                                 if col not in ('diag_2', 'diag_3') or hasattr(categorical, col))
+    numerical_columns = ['time_in_hospital', 'num_lab_procedures', 'num_procedures', 'num_medications',
+                         'number_outpatient', 'number_emergency', 'number_inpatient', 'number_diagnoses',
+                         'hemoglobin_level']
+    categorical_frame = generate_frame(categorical_columns, observations, max(rows), rng)
+    # Numerical columns hold the values validation lets through
+    numerical_frame = generate_frame(numerical_columns, observations, max(rows), rng, missing=False)
+    cases = {}
+    for n in rows:
+        X = categorical_frame.head(n)
+        cases['CategoricalTransformer.transform[{}]'.format(n)] = (categorical.transform, (lambda X=X: X), n, 'row')
+        X = numerical_frame.head(n)
+        cases['NumericalTransformer.transform[{}]'.format(n)] = (numerical.transform, (lambda X=X: X), n, 'row')
+    return cases
+
+
+def validation_cases(observations, rng):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from loguru import logger
+        logger.remove()
+        import app
+    valid = [o for o in observations if app.validate_observation(copy.deepcopy(o))[0]]
+    invalid = []
+    for observation in valid:
+        field, value = rng.choice(INVALID_VALUES)
+        invalid.append(dict(observation, **{field: value}))
+    updates = [{'admission_id': o['admission_id'], 'readmitted': rng.choice(['Yes', 'No', 'yes', ' no'])} for o in valid]
+    invalid_updates = []
+    for update in updates:
+        field, value = rng.choice(INVALID_UPDATES)
+        invalid_updates.append(dict(update, **{field: value}))
+
+    def chain(validate, payloads):
+        # Validation converts the payloads in place, each call gets fresh copies
+        def run(batch):
+            for payload in batch:
+                validate(payload)
+        return run, (lambda: copy.deepcopy(payloads)), len(payloads), 'payload'
+
+    return {'validate_observation[valid]': chain(app.validate_observation, valid),
+            'validate_observation[invalid]': chain(app.validate_observation, invalid),
+            'validate_update[valid]': chain(app.validate_update, updates),
+            'validate_update[invalid]': chain(app.validate_update, invalid_updates)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[1, 1000, 100000])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--filter', help="only run the cases whose name contains this text")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON file of a previous run to compare with")
+    args = parser.parse_args()
+
+    # Importing app opens its database: keep predictions.db out of it
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///{}'.format(os.path.join(tempfile.mkdtemp(), 'bench.db')))
+
+    # Each group of cases draws its inputs from its own generator, so that they
+    # do not depend on --rows
+    observations = load_observations()
+    pipeline = load_pipeline()
+    cases = {}
+    cases.update(helper_cases(named_step(pipeline, 'CategoricalTransformer'), observations, random.Random(args.seed)))
+    cases.update(transform_cases(pipeline, observations, args.rows, random.Random(args.seed)))
+    cases.update(validation_cases(observations, random.Random(args.seed)))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+
+    results = {}
+    print("{:<42} {:>10} {:>14} {:>14} {:>8}".format('case', 'per', 'us/item', 'baseline', 'change'))
+    for name, (function, setup, items, unit) in cases.items():
+        if args.filter and args.filter not in name:
+            continue
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            results[name] = best_seconds(function, setup) / items
+        line = "{:<42} {:>10} {:>14.3f}".format(name, unit, results[name] * 1e6)
+        if name in baseline:
+            line += " {:>14.3f} {:>7.2f}x".format(baseline[name] * 1e6, baseline[name] / results[name])
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2)
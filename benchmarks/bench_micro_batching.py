@@ -0,0 +1,111 @@
+########################################
+## Observations per second and p50/p99 latency of `score_observation`, the
+## scoring step of /predict, called from `--threads` concurrent threads,
+## without micro-batching (compiled scorer, and the pipeline on one-row
+## DataFrames) and with PREDICT_BATCH_SIZE / PREDICT_BATCH_WAIT_MS settings
+## with either scorer, without prediction cache. The observations include
+## copies with one missing value, batched with complete ones. Checks that every
+## setting gives each observation the probability of a single pipeline call,
+## and reports the mean batch size and queue wait of the batcher.
+##
+## Usage: python benchmarks/bench_micro_batching.py [--threads 1 8 32 64] [--requests 4000]
+
+import os
+import sys
+import json
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLIENT = r'''
+import os, sys, copy, json, time, threading, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.getcwd())
+from loguru import logger
+logger.remove()
+import app
+
+threads, requests = int(sys.argv[1]), int(sys.argv[2])
+observations = []
+for name in ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']:
+    with open(name) as fh:
+        observations += [record['data'] for record in json.load(fh)]
+model = app.load_model()
+observations = [o for o in observations if app.validate_observation(o, model)[0]]
+# Rows with a missing value, batched with the complete ones
+observations += [dict(o, **{column: None}) for o in observations[:10] for column in model.columns
+                 if column in o and app.validate_observation(dict(o, **{column: None}), model)[0]]
+work = [copy.deepcopy(observations[i % len(observations)]) for i in range(requests)]
+
+probabilities = [None] * requests
+latencies = [None] * requests
+positions = iter(range(requests))
+lock = threading.Lock()
+
+def client():
+    while True:
+        with lock:
+            i = next(positions, None)
+        if i is None:
+            return
+        start = time.perf_counter()
+        probabilities[i] = float(app.score_observation(work[i], model))
+        latencies[i] = time.perf_counter() - start
+
+start = time.perf_counter()
+pool = [threading.Thread(target=client) for _ in range(threads)]
+for thread in pool:
+    thread.start()
+for thread in pool:
+    thread.join()
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'latencies': latencies, 'probabilities': probabilities[:len(observations)],
+                  'batcher': app.batcher.stats()}))
+'''
+
+SETTINGS = [('compiled scorer', {'FAST_SCORER': '1'}),
+            ('pipeline', {'FAST_SCORER': '0'}),
+            ('batch 16, 2 ms', {'PREDICT_BATCH_SIZE': '16', 'PREDICT_BATCH_WAIT_MS': '2'}),
+            ('batch 64, 5 ms', {'PREDICT_BATCH_SIZE': '64', 'PREDICT_BATCH_WAIT_MS': '5'}),
+            ('pipe batch 16', {'FAST_SCORER': '0', 'PREDICT_BATCH_SIZE': '16', 'PREDICT_BATCH_WAIT_MS': '2'})]
+
+
+def run(threads, requests, env):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, 'bench.db')),
+                   PREDICTION_CACHE_SIZE='0', **env)
+        output = subprocess.run([sys.executable, '-c', CLIENT, str(threads), str(requests)], cwd=ROOT, env=env,
+                                check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32, 64])
+    parser.add_argument('--requests', type=int, default=4000)
+    args = parser.parse_args()
+
+    print("{:<16} {:>8} {:>9} {:>9} {:>9} {:>11} {:>13}".format('setting', 'threads', 'obs/s', 'p50 ms', 'p99 ms',
+                                                                'mean batch', 'mean wait ms'))
+    expected = None
+    for threads in args.threads:
+        for name, env in SETTINGS:
+            result = run(threads, args.requests, env)
+            if expected is None:
+                expected = run(1, len(result['probabilities']), {'FAST_SCORER': '0'})['probabilities']
+            assert result['probabilities'] == expected, \
+                "{} with {} threads gives other probabilities than single pipeline calls".format(name, threads)
+            batcher = result['batcher']
+            print("{:<16} {:>8} {:>9.0f} {:>9.2f} {:>9.2f} {:>11} {:>13}".format(
+                name, threads, args.requests / result['seconds'], percentile(result['latencies'], 50) * 1000,
+                percentile(result['latencies'], 99) * 1000,
+                '{:.1f}'.format(batcher['mean_batch_size']) if batcher['enabled'] else '-',
+                '{:.2f}'.format(batcher['mean_queue_wait_seconds'] * 1000) if batcher['enabled'] else '-'))
+    print("same probabilities as single pipeline calls")
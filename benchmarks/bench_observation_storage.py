@@ -0,0 +1,113 @@
+########################################
+## Storage size of `--rows` predictions in SQLite with the observations stored
+## as Python reprs (str() of the dict, as before Prediction.observation was a
+## JSON column) and as compact JSON after `migrate_observations`, and the time
+## to read them back as a training DataFrame: Python reprs parsed with ast,
+## JSON parsed by the JSON field, and one SQL column per feature with
+## json_extract(). Checks that every way of reading gives the same DataFrame
+## (json_extract gives booleans as 0 and 1).
+##
+## Usage: python benchmarks/bench_observation_storage.py [--rows 100000] [--repeat 3]
+
+import os
+import sys
+import json
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLIENT = r'''
+import os, sys, json, time, datetime, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.getcwd())
+from loguru import logger
+logger.remove()
+import pandas as pd
+import app
+
+rows, repeat = int(sys.argv[1]), int(sys.argv[2])
+observations = []
+for name in ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']:
+    with open(name) as fh:
+        observations += [record['data'] for record in json.load(fh)]
+with open('columns.json') as fh:
+    columns = [column for column in json.load(fh) if column != 'readmitted']
+P = app.Prediction
+
+def size():
+    app.db.execute_sql('VACUUM')
+    pages = app.db.execute_sql('PRAGMA page_count').fetchone()[0] * app.db.execute_sql('PRAGMA page_size').fetchone()[0]
+    column = app.db.execute_sql('SELECT SUM(LENGTH(observation)) FROM prediction').fetchone()[0]
+    return pages, column
+
+def best(read):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frame = read()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds), frame
+
+def decoded():
+    # Through the field: ast for Python reprs, json.loads for JSON
+    return pd.DataFrame([o for o, in P.select(P.observation).order_by(P.id).tuples()], columns=columns)
+
+def extracted():
+    raw = 'SELECT {} FROM prediction ORDER BY id'.format(
+        ', '.join("json_extract(observation, '$.{}')".format(column) for column in columns))
+    return pd.DataFrame.from_records(app.db.execute_sql(raw).fetchall(), columns=columns)
+
+now = datetime.datetime.now()
+with app.db.connection_context():
+    # Written as TextField did: str() of the dict
+    with app.db.atomic():
+        app.db.connection().executemany(
+            'INSERT INTO prediction (admission_id, observation, prediction, probability, created_date) VALUES (?, ?, ?, ?, ?)',
+            ((i, str(dict(observations[i % len(observations)], admission_id=i)), 'No', 0.5, now) for i in range(rows)))
+    result = {'repr_size': size()}
+    result['repr_seconds'], repr_frame = best(decoded)
+    start = time.perf_counter()
+    migrated, _, _ = app.migrate_observations()
+    result['migrate_seconds'] = time.perf_counter() - start
+    assert migrated == rows, migrated
+    result['json_size'] = size()
+    result['json_seconds'], json_frame = best(decoded)
+    result['extract_seconds'], extract_frame = best(extracted)
+
+pd.testing.assert_frame_equal(repr_frame, json_frame)
+as_ints = json_frame.applymap(lambda value: int(value) if isinstance(value, bool) else value)
+pd.testing.assert_frame_equal(as_ints, extract_frame, check_dtype=False)
+print(json.dumps(result))
+'''
+
+
+def run(rows, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, 'bench.db')))
+        output = subprocess.run([sys.executable, '-c', CLIENT, str(rows), str(repeat)], cwd=ROOT, env=env,
+                                check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3, help="best of this many reads")
+    args = parser.parse_args()
+
+    result = run(args.rows, args.repeat)
+    (repr_file, repr_column), (json_file, json_column) = result['repr_size'], result['json_size']
+    print("{} rows, migrated to JSON in {:.1f} s ({:.0f} rows/s)".format(
+        args.rows, result['migrate_seconds'], args.rows / result['migrate_seconds']))
+    print("{:<26} {:>12} {:>14}".format('storage', 'file MB', 'column MB'))
+    print("{:<26} {:>12.1f} {:>14.1f}".format('python repr', repr_file / 1e6, repr_column / 1e6))
+    print("{:<26} {:>12.1f} {:>14.1f}".format('json', json_file / 1e6, json_column / 1e6))
+    print("{:<26} {:>11.0f}% {:>13.0f}%".format('saved', 100 * (1 - json_file / repr_file),
+                                                 100 * (1 - json_column / repr_column)))
+    print("{:<26} {:>12} {:>14}".format('read as DataFrame', 'seconds', 'rows/s'))
+    for name, key in [('python repr, ast', 'repr_seconds'), ('json, json.loads', 'json_seconds'),
+                      ('json, json_extract()', 'extract_seconds')]:
+        print("{:<26} {:>12.2f} {:>14.0f}".format(name, result[key], args.rows / result[key]))
+    print("same DataFrame from every layout")
@@ -0,0 +1,95 @@
+########################################
+## Observations per second of /predict (one request per observation),
+## /predict_batch (lists of `--batch-size`) and /predict_stream (one NDJSON
+## body) through the Flask test client, each into a new SQLite database and
+## without prediction cache. The observations are those of the data files
+## plus copies with one missing value, so batches mix rows with and without
+## missing values. Checks that the batch and stream endpoints give every
+## observation the prediction and stored probability /predict gives it, and
+## so does /predict answered from the prediction cache filled by
+## /predict_batch (`cached`: the observations again, under other admission
+## ids, which the cache key leaves out).
+##
+## Usage: python benchmarks/bench_predict_batch.py [--batch-size 64]
+
+import os
+import sys
+import json
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLIENT = r'''
+import os, sys, json, time, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.getcwd())
+from loguru import logger
+logger.remove()
+import app
+
+endpoint, batch_size = sys.argv[1], int(sys.argv[2])
+model = app.load_model()
+observations = [o for o in app.sample_observations() if app.validate_observation(o, model)[0]]
+observations += [dict(o, **{column: None}) for o in observations for column in model.columns
+                 if column in o and app.validate_observation(dict(o, **{column: None}), model)[0]]
+observations = [dict(o, admission_id=10**8 + i) for i, o in enumerate(observations)]
+
+client = app.app.test_client()
+start = time.perf_counter()
+if endpoint == 'predict':
+    responses = [client.post('/predict', json=o).get_json() for o in observations]
+elif endpoint in ('predict_batch', 'cached'):
+    responses = []
+    for i in range(0, len(observations), batch_size):
+        responses += client.post('/predict_batch', json=observations[i:i + batch_size]).get_json()
+    if endpoint == 'cached':
+        start = time.perf_counter()
+        responses = [client.post('/predict', json=dict(o, admission_id=o['admission_id'] + 10**7)).get_json()
+                     for o in observations]
+        assert app.prediction_cache.stats()['hits'] > 0
+else:
+    body = ''.join(json.dumps(o) + '\n' for o in observations)
+    response = client.post('/predict_stream', data=body, content_type='application/x-ndjson')
+    responses = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+seconds = time.perf_counter() - start
+
+with app.db.connection_context():
+    query = app.Prediction.select()
+    if endpoint == 'cached':
+        query = query.where(app.Prediction.admission_id >= 10**8 + 10**7)
+    probabilities = {p.admission_id % 10**7 + 10**8: p.probability for p in query}
+print(json.dumps({'seconds': seconds, 'responses': responses, 'probabilities': probabilities}))
+'''
+
+
+def run(endpoint, batch_size):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, 'bench.db')),
+                   PREDICTION_CACHE_SIZE='10000' if endpoint == 'cached' else '0')
+        output = subprocess.run([sys.executable, '-c', CLIENT, endpoint, str(batch_size)], cwd=ROOT, env=env,
+                                check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=64, help="observations per /predict_batch request")
+    args = parser.parse_args()
+
+    print("{:<16} {:>8} {:>9}".format('endpoint', 'obs', 'obs/s'))
+    expected = None
+    for endpoint in ['predict', 'predict_batch', 'predict_stream', 'cached']:
+        result = run(endpoint, args.batch_size)
+        if expected is None:
+            expected = result
+        else:
+            assert [r.get('readmitted') for r in result['responses']] == \
+                   [r.get('readmitted') for r in expected['responses']], \
+                "/{} gives other predictions than /predict".format(endpoint)
+            assert result['probabilities'] == expected['probabilities'], \
+                "/{} stores other probabilities than /predict".format(endpoint)
+        print("{:<16} {:>8} {:>9.0f}".format('/' + endpoint, len(result['responses']),
+                                             len(result['responses']) / result['seconds']))
+    print("same predictions and probabilities as /predict")
@@ -0,0 +1,93 @@
+########################################
+## Overhead of the request profiler on /predict. The cost of a disabled
+## profiled view (one attribute test) is timed on its own, then /predict is
+## timed end to end with profiling off, 1 in 100 requests and every request,
+## with cProfile and with the stack sampler, each against a fresh database and
+## without prediction cache.
+##
+## Usage: python benchmarks/bench_profiler.py [--requests 2000] [--rounds 3]
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.profiler import RequestProfiler
+
+CLIENT = r'''
+import os, sys, json, time, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.getcwd())
+from loguru import logger
+logger.remove()
+import app
+
+n = int(sys.argv[1])
+observations = []
+for name in ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']:
+    with open(name) as fh:
+        observations += [record['data'] for record in json.load(fh)]
+
+client = app.app.test_client()
+app.load_model()
+latencies = []
+for i in range(n):
+    observation = dict(observations[i % len(observations)], admission_id=10**9 + i)
+    start = time.perf_counter()
+    client.post('/predict', json=observation)
+    latencies.append(time.perf_counter() - start)
+print(json.dumps(latencies))
+'''
+
+SETTINGS = [('off', '0', 'cprofile'), ('cprofile 1/100', '100', 'cprofile'), ('cprofile 1/1', '1', 'cprofile'),
+            ('sampler 1/100', '100', 'sampler'), ('sampler 1/1', '1', 'sampler')]
+
+
+def disabled_view_seconds(n=200000):
+    def view():
+        return None
+    wrapped = RequestProfiler().wrap(view, None)
+    timings = []
+    for function in (view, wrapped):
+        start = time.perf_counter()
+        for _ in range(n):
+            function()
+        timings.append((time.perf_counter() - start) / n)
+    return timings[1] - timings[0]
+
+
+def predict_latency(sample_every, mode, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, 'bench.db')),
+                   PREDICTION_CACHE_SIZE='0', PROFILE_SAMPLE_EVERY=sample_every, PROFILE_MODE=mode)
+        output = subprocess.run([sys.executable, '-c', CLIENT, str(args.requests)], cwd=ROOT, env=env,
+                                check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    latencies = {name: [] for name, _, _ in SETTINGS}
+    for _ in range(args.rounds):
+        for name, sample_every, mode in SETTINGS:
+            latencies[name] += predict_latency(sample_every, mode, args)
+    off = statistics.median(latencies['off'])
+
+    print("disabled profiler per request: {:.3f} us".format(disabled_view_seconds() * 1e6))
+    print("{:<16} {:>10} {:>10}".format('profiling', 'median ms', 'mean ms'))
+    for name, _, _ in SETTINGS:
+        median = statistics.median(latencies[name])
+        print("{:<16} {:>10.3f} {:>10.3f}   {:+.2f}%".format(name, median * 1000,
+                                                           statistics.mean(latencies[name]) * 1000,
+                                                           100 * (median - off) / off))
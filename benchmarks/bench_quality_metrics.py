@@ -0,0 +1,112 @@
+########################################
+## /metrics/model read time against computing the same metrics from a scan of
+## the Prediction table, for growing numbers of labelled predictions. Labels
+## are sent through /update and /update_batch (some of them twice, with a
+## different class) and the counters they maintain are checked against
+## `--rebuild-quality-metrics` at every size.
+##
+## Usage: python benchmarks/bench_quality_metrics.py [--sizes 1000 10000 100000]
+
+import os
+import sys
+import json
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RUN = r'''
+import os, sys, json, time, random, datetime, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.getcwd())
+from loguru import logger
+logger.remove()
+import app
+from utils.quality_metrics import counter_deltas, summarize
+
+sizes = [int(size) for size in sys.argv[1:]]
+with open('data.json') as fh:
+    observation = json.load(fh)[0]['data']
+client = app.app.test_client()
+rng = random.Random(0)
+today = datetime.datetime.now()
+
+
+def best_time(function, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def scan():
+    # What /metrics/model would cost without the counters
+    counts = {}
+    query = (app.Prediction.select(app.Prediction.prediction, app.Prediction.probability, app.Prediction.true_class)
+             .where(app.Prediction.true_class.is_null(False)).tuples())
+    for prediction, probability, true_class in query.iterator():
+        for name, delta in counter_deltas(prediction, probability, None, true_class).items():
+            counts[name] = counts.get(name, 0) + delta
+    return summarize(counts)
+
+
+def counters():
+    return sorted(app.QualityCounter.select(app.QualityCounter.day, app.QualityCounter.model_version,
+                                            app.QualityCounter.name, app.QualityCounter.count)
+                  .where(app.QualityCounter.count != 0).tuples())
+
+
+results = []
+rows = 0
+for size in sizes:
+    with app.db.atomic():
+        for chunk in app.chunked(range(rows, size), 500):
+            app.Prediction.insert_many([{'admission_id': 10**9 + i, 'observation': observation,
+                                         'probability': p, 'prediction': app.get_model_prediction(p),
+                                         'model_version': rng.choice(['a', 'b']),
+                                         'created_date': today - datetime.timedelta(days=rng.randrange(30))}
+                                        for i, p in ((i, rng.random() ** 3) for i in chunk)]).execute()
+    labels = [{'admission_id': 10**9 + i, 'readmitted': rng.choice(['Yes', 'No', 'no'])} for i in range(rows, size)]
+    relabels = [dict(label, readmitted='Yes' if label['readmitted'].lower() == 'no' else 'No')
+                for label in rng.sample(labels, len(labels) // 10)]
+    for i in range(0, len(labels), 5000):
+        client.post('/update_batch', json=labels[i:i + 5000])
+    for label in relabels[:200]:
+        client.post('/update', json=label)
+    client.post('/update_batch', json=relabels[200:])
+    rows = size
+
+    maintained = counters()
+    with app.db.connection_context():
+        app.rebuild_quality_counters()
+    assert counters() == maintained, "maintained counters differ from a rebuild"
+    endpoint = client.get('/metrics/model').get_json()
+    scanned = scan()
+    assert endpoint['confusion'] == scanned['confusion'] and endpoint['roc'] == scanned['roc']
+
+    results.append({'rows': size, 'counters': len(maintained),
+                    'endpoint': best_time(lambda: client.get('/metrics/model')),
+                    'scan': best_time(scan, repeat=1 if size > 10000 else 3)})
+print(json.dumps(results))
+'''
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, 'bench.db')))
+        output = subprocess.run([sys.executable, '-c', RUN] + [str(size) for size in sorted(args.sizes)], cwd=ROOT,
+                                env=env, check=True, capture_output=True, text=True).stdout
+    results = json.loads(output.strip().splitlines()[-1])
+
+    print("counters match a rebuild and a full scan at every size")
+    print("{:>10} {:>10} {:>16} {:>12}".format('labelled', 'counters', '/metrics/model ms', 'scan ms'))
+    for result in results:
+        print("{:>10} {:>10} {:>16.1f} {:>12.1f}".format(result['rows'], result['counters'],
+                                                         result['endpoint'] * 1000, result['scan'] * 1000))
@@ -0,0 +1,287 @@
+########################################
+## Load test replaying the request files of the repository (data.json,
+## data_new.json and the two trial files of data/), `--scale` times with the
+## admission ids of each copy shifted, to /predict and then one /update per
+## payload with a random label, from `--concurrency` client threads. Reports
+## throughput, p50/p95/p99 latency and the mix of outcomes (success, warning,
+## duplicate, not_found, validation_error, http_<status>, exception) of each
+## endpoint.
+##
+## By default the app runs in-process (Flask test client, in a subprocess)
+## on a new SQLite database; `--database-url postgresql://...` runs it on
+## another database instead, and `--url http://host:port` sends the requests
+## to a running server. `--save` writes the results as JSON, and
+## `--baseline` compares with saved results: the run fails when a latency
+## percentile is more than `--tolerance` above the baseline, the throughput
+## more than `--tolerance` below it or the outcomes differ.
+##
+## Usage: python benchmarks/bench_replay.py [--scale 10] [--concurrency 4] [--url URL | --database-url URL]
+##                                          [--save results.json] [--baseline results.json] [--tolerance 0.25]
+
+import os
+import re
+import sys
+import ast
+import json
+import math
+import time
+import random
+import tempfile
+import argparse
+import threading
+import subprocess
+import http.client
+from collections import Counter
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_FILES = ['data.json', 'data_new.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']
+
+# Admission ids of the copies are this far apart, above those of the files
+ID_STRIDE = 10**6
+
+PERCENTILES = (50, 95, 99)
+
+CLIENT = r'''
+import os, sys, json, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.join(os.getcwd(), 'benchmarks'))
+from loguru import logger
+logger.remove()
+import app
+import bench_replay
+
+
+def test_client():
+    client = app.app.test_client()
+    def post(path, payload):
+        response = client.post(path, json=payload)
+        return response.status_code, response.get_json(silent=True)
+    return post
+
+
+app.load_model()
+scale, id_base, concurrency = [int(arg) for arg in sys.argv[1:]]
+print(json.dumps(bench_replay.run(test_client, scale, id_base, concurrency)))
+'''
+
+
+def read_observations(name):
+    with open(os.path.join(ROOT, name)) as fh:
+        data = json.load(fh)
+    if isinstance(data, str):
+        # data_new.json holds the repr of one observation, as written by
+        # requests_trial.ipynb
+        data = ast.literal_eval(re.sub(r'\bnan\b', 'None', data))
+    if isinstance(data, dict):
+        data = [data]
+    return [record['data'] if isinstance(record, dict) and 'data' in record else record for record in data]
+
+
+def shift_id(observation, offset):
+    value = observation.get('admission_id') if isinstance(observation, dict) else None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return dict(observation, admission_id=value + offset)
+    return observation
+
+
+def workload(scale, id_base, seed=0):
+    # The payloads are replayed as found, invalid and duplicate ones included,
+    # so every copy has the same outcomes
+    rng = random.Random(seed)
+    predicts = []
+    for copy in range(scale):
+        for name in DATA_FILES:
+            predicts += [shift_id(observation, id_base + copy * ID_STRIDE) for observation in read_observations(name)]
+    updates = [{'admission_id': observation['admission_id'], 'readmitted': rng.choice(['Yes', 'No'])}
+               for observation in predicts if isinstance(observation, dict) and 'admission_id' in observation]
+    return [('/predict', predicts), ('/update', updates)]
+
+
+def outcome(status, body):
+    if status != 200:
+        return 'http_{}'.format(status)
+    if isinstance(body, dict) and 'error' in body:
+        error = str(body['error'])
+        if 'already exists' in error:
+            return 'duplicate'
+        if 'does not exist' in error:
+            return 'not_found'
+        return 'validation_error'
+    if isinstance(body, dict) and 'warning' in body:
+        return 'warning'
+    return 'success'
+
+
+def http_client(url):
+    # One keep-alive connection per client thread
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    def make_client():
+        connection = connection_class(parts.hostname, parts.port, timeout=60)
+        def post(path, payload):
+            connection.request('POST', parts.path.rstrip('/') + path, json.dumps(payload),
+                               {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            body = response.read()
+            try:
+                body = json.loads(body)
+            except ValueError:
+                pass
+            return response.status, body
+        return post
+    return make_client
+
+
+def id_groups(payloads):
+    # Indexes of the payloads, those with the same admission id together and
+    # in order, so that which of them succeeds does not depend on the threads
+    groups = {}
+    for i, payload in enumerate(payloads):
+        value = payload.get('admission_id') if isinstance(payload, dict) else None
+        key = value if isinstance(value, (int, float, str)) else ('index', i)
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+
+def replay(make_client, path, payloads, concurrency):
+    # Each client thread posts the next group of payloads not yet sent, so
+    # that the replay takes as long as the slowest requests allow
+    results = [None] * len(payloads)
+    groups = iter(id_groups(payloads))
+    lock = threading.Lock()
+
+    def client():
+        post = make_client()
+        while True:
+            with lock:
+                group = next(groups, None)
+            if group is None:
+                return
+            for i in group:
+                start = time.perf_counter()
+                try:
+                    result = outcome(*post(path, payloads[i]))
+                except Exception as e:
+                    result = 'exception:{}'.format(type(e).__name__)
+                results[i] = (time.perf_counter() - start, result)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, results
+
+
+def percentile(values, q):
+    # Nearest rank, on sorted values
+    return values[min(len(values) - 1, max(0, int(math.ceil(q / 100 * len(values))) - 1))]
+
+
+def summarize(seconds, results):
+    latencies = sorted(latency for latency, _ in results)
+    summary = {'requests': len(results), 'seconds': seconds, 'throughput': len(results) / seconds}
+    for q in PERCENTILES:
+        summary['p{}'.format(q)] = percentile(latencies, q)
+    summary['outcomes'] = dict(Counter(result for _, result in results))
+    return summary
+
+
+def run(make_client, scale, id_base, concurrency):
+    return {path: summarize(*replay(make_client, path, payloads, concurrency))
+            for path, payloads in workload(scale, id_base)}
+
+
+def run_in_process(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL=args.database_url or 'sqlite:///{}'.format(os.path.join(tmp, 'bench.db')))
+        output = subprocess.run([sys.executable, '-c', CLIENT, str(args.scale), str(args.id_base), str(args.concurrency)],
+                                cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    # Reasons for the run to fail against the baseline
+    failures = []
+    for setting in ('target', 'scale', 'concurrency'):
+        if results[setting] != baseline[setting]:
+            failures.append("{} differs from the baseline: {} != {}".format(setting, results[setting], baseline[setting]))
+    for path, summary in results['endpoints'].items():
+        expected = baseline['endpoints'].get(path)
+        if expected is None:
+            continue
+        for q in PERCENTILES:
+            name = 'p{}'.format(q)
+            if summary[name] > expected[name] * (1 + tolerance):
+                failures.append("{} {} {:.2f} ms > baseline {:.2f} ms".format(path, name, summary[name] * 1000,
+                                                                            expected[name] * 1000))
+        if summary['throughput'] * (1 + tolerance) < expected['throughput']:
+            failures.append("{} throughput {:.0f} req/s < baseline {:.0f} req/s".format(path, summary['throughput'],
+                                                                                     expected['throughput']))
+        if summary['outcomes'] != expected['outcomes']:
+            failures.append("{} outcomes {} != baseline {}".format(path, summary['outcomes'], expected['outcomes']))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, default=10, help="copies of the request files to replay")
+    parser.add_argument('--concurrency', type=int, default=4, help="client threads")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help="base URL of a running server, instead of the app in-process")
+    target.add_argument('--database-url', help="DATABASE_URL of the in-process app, instead of a new SQLite database")
+    parser.add_argument('--id-base', type=int,
+                        help="added to the admission ids; random above 10**9 unless the database is new")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON file of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative regression (default 0.25)")
+    args = parser.parse_args()
+
+    if args.id_base is None:
+        # A database that may hold a previous run gets ids it has not seen,
+        # below 2**31 for Postgres integer columns
+        args.id_base = 0
+        if args.url or args.database_url:
+            copies = (2**31 - 1 - 10**9) // ID_STRIDE - args.scale
+            args.id_base = 10**9 + random.randrange(copies) * ID_STRIDE
+
+    if args.url:
+        endpoints = run(http_client(args.url), args.scale, args.id_base, args.concurrency)
+    else:
+        endpoints = run_in_process(args)
+    results = {'target': args.url or 'in-process',
+               'database': None if args.url else (args.database_url or 'sqlite').split(':')[0],
+               'scale': args.scale, 'concurrency': args.concurrency, 'id_base': args.id_base, 'endpoints': endpoints}
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+
+    print("{:<10} {:>8} {:>8} {:>9} {:>9} {:>9}  {}".format('endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms',
+                                                             'p99 ms', 'outcomes'))
+    for path, summary in endpoints.items():
+        print("{:<10} {:>8} {:>8.0f} {:>9.2f} {:>9.2f} {:>9.2f}  {}".format(
+            path, summary['requests'], summary['throughput'], summary['p50'] * 1000, summary['p95'] * 1000,
+            summary['p99'] * 1000, ', '.join('{} {}'.format(name, count) for name, count in sorted(summary['outcomes'].items()))))
+        if path in baseline.get('endpoints', {}):
+            expected = baseline['endpoints'][path]
+            print("{:<10} {:>8} {:>8.0f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                'baseline', expected['requests'], expected['throughput'], expected['p50'] * 1000,
+                expected['p95'] * 1000, expected['p99'] * 1000))
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.baseline:
+        failures = compare(results, baseline, args.tolerance)
+        for failure in failures:
+            print("REGRESSION: " + failure)
+        if failures:
+            sys.exit(1)
+        print("within {:.0%} of the baseline".format(args.tolerance))
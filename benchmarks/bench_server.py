@@ -0,0 +1,122 @@
+########################################
+## Memory per worker and /predict requests per second of a gunicorn server,
+## with the former command line (`gunicorn app:app`, no preloading) and with
+## gunicorn.conf.py. Both runs use the same number of workers and a fresh
+## SQLite database.
+##
+## Usage: python benchmarks/bench_server.py [--workers 4] [--clients 8] [--seconds 10]
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+import threading
+import subprocess
+import http.client
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_FILES = ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']
+
+
+def memory(pid):
+    # RSS, PSS and private memory of a process in MB
+    values = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as fh:
+        for line in fh:
+            parts = line.split()
+            if parts[0] in ('Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:'):
+                values[parts[0][:-1]] = int(parts[1]) / 1024
+    return values['Rss'], values['Pss'], values['Private_Clean'] + values['Private_Dirty']
+
+
+def children(pid):
+    with open('/proc/{}/task/{}/children'.format(pid, pid)) as fh:
+        return [int(child) for child in fh.read().split()]
+
+
+def post(port, path, payload):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    connection.request('POST', path, json.dumps(payload), {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.status
+
+
+def load(port, observations, clients, seconds):
+    counts = [0] * clients
+    deadline = time.time() + seconds
+
+    def client(k):
+        rng = random.Random(k)
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        i = 0
+        while time.time() < deadline:
+            observation = dict(rng.choice(observations), admission_id=10**9 + k * 10**7 + i)
+            connection.request('POST', '/predict', json.dumps(observation), {'Content-Type': 'application/json'})
+            connection.getresponse().read()
+            counts[k] += 1
+            i += 1
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(k,)) for k in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds
+
+
+def run(name, command, args, observations):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, 'bench.db')),
+                   SQLITE_PROFILE='production', WEB_CONCURRENCY=str(args.workers), PORT=str(args.port))
+        server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.time() + 120
+            while True:
+                try:
+                    post(args.port, '/predict', {})
+                    if len(children(server.pid)) >= args.workers:
+                        break
+                except OSError:
+                    pass
+                if time.time() > deadline:
+                    raise RuntimeError("{} did not start".format(name))
+                time.sleep(0.5)
+
+            rps = load(args.port, observations, args.clients, args.seconds)
+            workers = [memory(pid) for pid in children(server.pid)]
+        finally:
+            server.terminate()
+            server.wait()
+
+    n = len(workers)
+    rss, pss, private = [sum(w[i] for w in workers) / n for i in range(3)]
+    print("{:<10} {:>8} {:>10.1f} {:>10.1f} {:>12.1f} {:>8.0f}".format(name, n, rss, pss, private, rps))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    observations = []
+    for name in DATA_FILES:
+        with open(name) as fh:
+            observations += [record['data'] for record in json.load(fh)]
+
+    gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    gunicorn = [gunicorn if os.path.exists(gunicorn) else 'gunicorn']
+    bind = '127.0.0.1:{}'.format(args.port)
+    print("{:<10} {:>8} {:>10} {:>10} {:>12} {:>8}".format('server', 'workers', 'RSS MB', 'PSS MB', 'private MB', 'req/s'))
+    run('former', gunicorn + ['-c', '/dev/null', '-b', bind, '-w', str(args.workers), 'app:app'], args, observations)
+    run('config', gunicorn + ['-c', 'gunicorn.conf.py', '-b', bind, 'app:app'], args, observations)
@@ -0,0 +1,87 @@
+########################################
+## /predict latency without and with shadow scoring. The candidate is a copy
+## of the default model in a temporary registry, so both runs do the same
+## work on the request path and the shadow run adds the candidate scoring in
+## the shadow process. Each run uses a fresh SQLite database and no prediction
+## cache, and reports the latency percentiles and the shadow observation
+## counts (invalid sample observations are not scored, so not submitted).
+##
+## Usage: python benchmarks/bench_shadow.py [--requests 2000] [--queue-size 100]
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLIENT = r'''
+import os, sys, json, time, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.getcwd())
+from loguru import logger
+logger.remove()
+import app
+
+n = int(sys.argv[1])
+observations = []
+for name in ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']:
+    with open(name) as fh:
+        observations += [record['data'] for record in json.load(fh)]
+
+client = app.app.test_client()
+app.load_model()
+# The shadow processes are forked with the candidate loaded, as a worker does
+app.start_shadow()
+latencies = []
+for i in range(n):
+    observation = dict(observations[i % len(observations)], admission_id=10**9 + i)
+    start = time.perf_counter()
+    client.post('/predict', json=observation)
+    latencies.append(time.perf_counter() - start)
+app.shadow.close()
+print(json.dumps({'latencies': latencies, 'shadow': app.shadow.stats()}))
+'''
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(name, shadow, args, registry):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, 'bench.db')),
+                   PREDICTION_CACHE_SIZE='0', MODEL_REGISTRY_DIR=registry,
+                   SHADOW_QUEUE_SIZE=str(args.queue_size))
+        env.pop('SHADOW_MODEL', None)
+        if shadow:
+            env['SHADOW_MODEL'] = 'candidate'
+        output = subprocess.run([sys.executable, '-c', CLIENT, str(args.requests)], cwd=ROOT, env=env,
+                                check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    latencies = [latency * 1000 for latency in result['latencies']]
+    stats = result['shadow']
+    counts = [stats[count] if shadow else '-' for count in ['submitted', 'completed', 'dropped']]
+    print("{:<8} {:>8.2f} {:>8.2f} {:>8.2f} {:>10} {:>10} {:>8}".format(
+        name, percentile(latencies, 0.5), percentile(latencies, 0.95), percentile(latencies, 0.99), *counts))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--queue-size', type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as registry:
+        os.makedirs(os.path.join(registry, 'candidate'))
+        for artifact in ['pipeline.pickle', 'dtypes.pickle', 'columns.json']:
+            shutil.copy(os.path.join(ROOT, artifact), os.path.join(registry, 'candidate'))
+
+        print("{:<8} {:>8} {:>8} {:>8} {:>10} {:>10} {:>8}".format(
+            'shadow', 'p50 ms', 'p95 ms', 'p99 ms', 'submitted', 'completed', 'dropped'))
+        run('off', False, args, registry)
+        run('on', True, args, registry)
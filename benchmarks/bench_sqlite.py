@@ -0,0 +1,71 @@
+########################################
+## Inserts per second into a SQLite predictions database from several writer
+## processes, with the default pragmas and with SQLITE_PROFILE=production.
+## Each insert is its own transaction, like a `/predict` request.
+##
+## Usage: python benchmarks/bench_sqlite.py [--writers 4] [--inserts 500]
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WRITER = r'''
+import os, sys, json, time, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.getcwd())
+from loguru import logger
+logger.remove()
+import app
+
+writer, inserts, start_at = int(sys.argv[1]), int(sys.argv[2]), float(sys.argv[3])
+with open('data.json') as fh:
+    observation = json.load(fh)[0]['data']
+
+while time.time() < start_at:
+    time.sleep(0.001)
+
+errors = 0
+start = time.perf_counter()
+with app.db.connection_context():
+    for i in range(inserts):
+        try:
+            app.Prediction.create(admission_id=writer * 10**7 + i, observation=observation,
+                                  prediction='Yes', probability=0.5)
+        except app.OperationalError:
+            errors += 1
+print(json.dumps({'seconds': time.perf_counter() - start, 'errors': errors}))
+'''
+
+
+def run(profile, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, 'bench.db')), SQLITE_PROFILE=profile)
+        # Create the tables before the writers start
+        subprocess.run([sys.executable, '-c', 'import app'], cwd=ROOT, env=env, check=True, capture_output=True)
+        start_at = time.time() + args.startup
+        writers = [subprocess.Popen([sys.executable, '-c', WRITER, str(k), str(args.inserts), str(start_at)],
+                                    cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+                   for k in range(args.writers)]
+        results = [json.loads(writer.communicate()[0].strip().splitlines()[-1]) for writer in writers]
+    seconds = max(result['seconds'] for result in results)
+    errors = sum(result['errors'] for result in results)
+    return (args.writers * args.inserts - errors) / seconds, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--inserts', type=int, default=500, help="inserts per writer")
+    parser.add_argument('--startup', type=float, default=10, help="seconds given to the writers to import the app")
+    args = parser.parse_args()
+
+    print("{:<12} {:>12} {:>8}".format('profile', 'inserts/s', 'errors'))
+    for profile in ['default', 'production']:
+        rate, errors = run(profile, args)
+        print("{:<12} {:>12.0f} {:>8}".format(profile, rate, errors))
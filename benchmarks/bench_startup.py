@@ -0,0 +1,102 @@
+########################################
+## Cold start: time to `import app` in a fresh interpreter, and time from
+## launching `gunicorn -c gunicorn.conf.py app:app` (one worker, fresh SQLite
+## database) to the first response of `/update` (no model needed) and of
+## `/predict`. Each measure is the median of --repeat runs.
+##
+## Usage: python benchmarks/bench_startup.py [--repeat 5] [--save results.json] [--baseline results.json]
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import statistics
+import subprocess
+import http.client
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def post(port, path, payload):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    connection.request('POST', path, json.dumps(payload), {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.status
+
+
+def wait_for(port, path, payload, start, deadline=120):
+    while True:
+        try:
+            if post(port, path, payload) == 200:
+                return time.perf_counter() - start
+        except OSError:
+            pass
+        if time.perf_counter() - start > deadline:
+            raise RuntimeError("no response from {}".format(path))
+        time.sleep(0.01)
+
+
+def import_time(env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import app'], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def first_responses(env, port, observation):
+    gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    gunicorn = gunicorn if os.path.exists(gunicorn) else 'gunicorn'
+    start = time.perf_counter()
+    server = subprocess.Popen([gunicorn, '-c', 'gunicorn.conf.py', '-b', '127.0.0.1:{}'.format(port), 'app:app'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        update = wait_for(port, '/update', {'admission_id': 1, 'readmitted': 'No'}, start)
+        predict = wait_for(port, '/predict', observation, start)
+    finally:
+        server.terminate()
+        server.wait()
+    return update, predict
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON file of a previous run to compare with")
+    args = parser.parse_args()
+
+    with open(os.path.join(ROOT, 'data.json')) as fh:
+        observation = json.load(fh)[0]['data']
+
+    samples = {'import_app': [], 'first_update': [], 'first_predict': []}
+    for i in range(args.repeat):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(tmp, 'bench.db')),
+                       WEB_CONCURRENCY='1', GUNICORN_WORKER_CLASS='sync')
+            samples['import_app'].append(import_time(env))
+            observation['admission_id'] = 10**9 + i
+            update, predict = first_responses(env, args.port, observation)
+            samples['first_update'].append(update)
+            samples['first_predict'].append(predict)
+    results = {name: statistics.median(values) for name, values in samples.items()}
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+
+    print("{:<14} {:>10} {:>10} {:>8}".format('measure', 'seconds', 'baseline', 'change'))
+    for name, value in results.items():
+        if name in baseline:
+            print("{:<14} {:>10.3f} {:>10.3f} {:>7.1f}x".format(name, value, baseline[name], baseline[name] / value))
+        else:
+            print("{:<14} {:>10.3f}".format(name, value))
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2)
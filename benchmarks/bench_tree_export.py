@@ -0,0 +1,92 @@
+########################################
+## Exports the GradientBoostingClassifier of pipeline.pickle with
+## utils/tree_export.py, checks that the NumPy evaluator gives the same
+## probabilities as sklearn (within 1e-12) and times both at several batch
+## sizes. Feature rows are the preprocessed sample observations, resampled,
+## with noise added to part of them so that every branch gets exercised.
+##
+## Usage: python benchmarks/bench_tree_export.py [--sizes 1 100 100000]
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+import joblib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from utils.tree_export import export_trees, TreeEnsemble
+
+DATA_FILES = ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']
+TOLERANCE = 1e-12
+
+
+def feature_rows(pipeline, n, seed):
+    with open('columns.json') as fh:
+        columns = json.load(fh)
+    with open('dtypes.pickle', 'rb') as fh:
+        dtypes = pickle.load(fh)
+    observations = []
+    for name in DATA_FILES:
+        with open(name) as fh:
+            observations += [record['data'] for record in json.load(fh)]
+    X = pipeline.steps[0][1].transform(pd.DataFrame(observations, columns=columns).astype(dtypes, errors='ignore'))
+
+    rng = np.random.default_rng(seed)
+    X = X[rng.integers(0, len(X), n)]
+    noisy = rng.random(X.shape) < 0.3
+    return X + noisy * rng.normal(0, 1, X.shape)
+
+
+def best_time(function, X, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(X)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 100000])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        pipeline = joblib.load('pipeline.pickle')
+    model = pipeline.steps[-1][1]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'model_trees.npz')
+        start = time.perf_counter()
+        export_trees(model).save(path)
+        exported = time.perf_counter() - start
+        size = os.path.getsize(path)
+        ensemble = TreeEnsemble.load(path)
+    print("exported {} trees, {} nodes, to {:.1f} KB in {:.1f} ms".format(
+        len(ensemble.roots), len(ensemble.left), size / 1024, exported * 1000))
+
+    X = feature_rows(pipeline, max(args.sizes), args.seed)
+    difference = np.abs(model.predict_proba(X) - ensemble.predict_proba(X)).max()
+    print("max |sklearn - numpy| over {} rows: {:.3g}".format(len(X), difference))
+    assert difference <= TOLERANCE, "evaluator differs from sklearn by {}".format(difference)
+
+    print()
+    print("{:>8} {:>14} {:>14} {:>8}".format('rows', 'sklearn ms', 'numpy ms', 'speedup'))
+    for size in args.sizes:
+        batch = X[:size]
+        repeat = max(3, min(1000, 100000 // size))
+        reference = best_time(model.predict_proba, batch, repeat)
+        flattened = best_time(ensemble.predict_proba, batch, repeat)
+        print("{:>8} {:>14.3f} {:>14.3f} {:>7.1f}x".format(size, reference * 1000, flattened * 1000, reference / flattened))
@@ -0,0 +1,89 @@
+########################################
+## Applying a file of ground-truth labels: one /update request per label
+## against /update_batch requests of --batch-size labels. Both run on the same
+## fresh database of --rows predictions, with a few unknown admission ids in
+## the labels, and must give the same responses and the same stored labels.
+##
+## Usage: python benchmarks/bench_update_batch.py [--rows 20000] [--batch-size 5000] [--database-url URL]
+
+import os
+import sys
+import json
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RUN = r'''
+import os, sys, json, time, random, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.getcwd())
+from loguru import logger
+logger.remove()
+import app
+
+rows, batch_size = int(sys.argv[1]), int(sys.argv[2])
+with open('data.json') as fh:
+    observation = json.load(fh)[0]['data']
+base = 10**9
+app.Prediction.delete().where(app.Prediction.admission_id >= base).execute()
+with app.db.atomic():
+    for chunk in app.chunked(range(rows), 500):
+        app.Prediction.insert_many([{'admission_id': base + i, 'observation': observation, 'prediction': 'No',
+                                     'probability': 0.1} for i in chunk]).execute()
+
+rng = random.Random(0)
+labels = [{'admission_id': base + i, 'readmitted': rng.choice(['Yes', 'No'])} for i in range(rows)]
+labels += [{'admission_id': base + rows + i, 'readmitted': 'No'} for i in range(rows // 100)]
+rng.shuffle(labels)
+client = app.app.test_client()
+
+def stored():
+    query = (app.Prediction.select(app.Prediction.admission_id, app.Prediction.true_class)
+             .where(app.Prediction.admission_id >= base).order_by(app.Prediction.admission_id).tuples())
+    return list(query)
+
+def reset():
+    app.Prediction.update(true_class=None, modified_date=None).where(app.Prediction.admission_id >= base).execute()
+
+reset()
+start = time.perf_counter()
+single = [client.post('/update', json=label).get_json() for label in labels]
+single_seconds = time.perf_counter() - start
+single_stored = stored()
+
+reset()
+start = time.perf_counter()
+batched = []
+for i in range(0, len(labels), batch_size):
+    batched += client.post('/update_batch', json=labels[i:i + batch_size]).get_json()
+batch_seconds = time.perf_counter() - start
+
+# /update answers an unknown id without the id, /update_batch includes it
+single = [dict(response, admission_id=label['admission_id']) if 'error' in response else response
+          for label, response in zip(labels, single)]
+assert batched == single, "responses differ"
+assert stored() == single_stored, "stored labels differ"
+print(json.dumps({'labels': len(labels), 'single': single_seconds, 'batch': batch_seconds}))
+'''
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL=args.database_url or 'sqlite:///{}'.format(os.path.join(tmp, 'bench.db')))
+        output = subprocess.run([sys.executable, '-c', RUN, str(args.rows), str(args.batch_size)], cwd=ROOT, env=env,
+                                check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+
+    print("{} labels, same responses and stored labels".format(result['labels']))
+    print("{:<14} {:>10} {:>12}".format('endpoint', 'seconds', 'labels/s'))
+    for name in ['single', 'batch']:
+        print("{:<14} {:>10.2f} {:>12.0f}".format('/update' if name == 'single' else '/update_batch',
+                                                  result[name], result['labels'] / result[name]))
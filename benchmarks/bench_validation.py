@@ -0,0 +1,85 @@
+########################################
+## Per-observation cost of `app.validate_observation` on valid and invalid
+## payloads built from the sample data files.
+##
+## Usage: python benchmarks/bench_validation.py [--save results.json] [--baseline results.json]
+
+import os
+import sys
+import json
+import copy
+import time
+import random
+import argparse
+import warnings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+DATA_FILES = ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']
+
+# Field values that fail validation, applied one at a time to valid observations
+INVALID_VALUES = [('age', 3.5), ('blood_type', 'zz'), ('time_in_hospital', -1), ('num_procedures', 1.5),
+                  ('hemoglobin_level', 150), ('diuretics', 'maybe'), ('patient_id', 'a'), ('race', 1.0)]
+
+
+def load_payloads(validate_observation, seed):
+    observations = []
+    for name in DATA_FILES:
+        with open(name) as fh:
+            observations += [record['data'] for record in json.load(fh)]
+    valid = [o for o in observations if validate_observation(copy.deepcopy(o))[0]]
+
+    rng = random.Random(seed)
+    invalid = []
+    for observation in valid:
+        field, value = rng.choice(INVALID_VALUES)
+        observation = dict(observation)
+        observation[field] = value
+        invalid.append(observation)
+    return {'valid': valid, 'invalid': invalid}
+
+
+def time_per_observation(validate_observation, payloads, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        batch = copy.deepcopy(payloads)
+        start = time.perf_counter()
+        for observation in batch:
+            validate_observation(observation)
+        best = min(best, (time.perf_counter() - start) / len(batch))
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON file of a previous run to compare with")
+    args = parser.parse_args()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from app import validate_observation
+
+    payloads = load_payloads(validate_observation, args.seed)
+    results = {name: time_per_observation(validate_observation, batch, args.repeat) * 1e6
+               for name, batch in payloads.items()}
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+
+    print("{:<10} {:>12} {:>12} {:>8}".format('payload', 'us/obs', 'baseline', 'change'))
+    for name, value in results.items():
+        if name in baseline:
+            print("{:<10} {:>12.2f} {:>12.2f} {:>7.1f}x".format(name, value, baseline[name], baseline[name] / value))
+        else:
+            print("{:<10} {:>12.2f}".format(name, value))
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2)
@@ -0,0 +1,117 @@
+########################################
+## /predict throughput with synchronous saves and with the write-behind queue.
+## Each mode runs in its own process against a fresh database, posting the
+## sample observations under new admission ids from several threads. Then two
+## write-behind processes, like two workers, post the same admission ids at
+## the same time: checks that each id is acknowledged by one of them only and
+## that every acknowledged prediction is stored.
+##
+## Usage: python benchmarks/bench_write_behind.py [--requests 2000] [--threads 4] [--database-url URL]
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_FILES = ['data.json', 'data/moment_1_trial.json', 'data/moment_2_trial.json']
+
+RUN = r'''
+import os, sys, json, time, threading, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.getcwd())
+from loguru import logger
+logger.remove()
+import app
+
+requests, threads, start_at = int(sys.argv[1]), int(sys.argv[2]), float(sys.argv[3])
+observations = []
+for name in %r:
+    with open(name) as fh:
+        observations += [record['data'] for record in json.load(fh)]
+client = app.app.test_client()
+acknowledged = []
+
+def post(offset):
+    for i in range(offset, requests, threads):
+        observation = dict(observations[i %% len(observations)], admission_id=10**9 + i)
+        if 'readmitted' in client.post('/predict', json=observation).get_json():
+            acknowledged.append(observation['admission_id'])
+
+while time.time() < start_at:
+    time.sleep(0.001)
+start = time.perf_counter()
+workers = [threading.Thread(target=post, args=(k,)) for k in range(threads)]
+for worker in workers:
+    worker.start()
+for worker in workers:
+    worker.join()
+elapsed = time.perf_counter() - start
+app.writer.close()
+stored = [p.admission_id for p in app.Prediction.select().where(app.Prediction.admission_id >= 10**9)]
+print(json.dumps({'seconds': elapsed, 'stored': stored, 'acknowledged': acknowledged, 'writer': app.writer.stats()}))
+''' % (DATA_FILES,)
+
+
+def environment(mode, args, tmp):
+    env = dict(os.environ)
+    env['DATABASE_URL'] = args.database_url or 'sqlite:///{}'.format(os.path.join(tmp, 'bench.db'))
+    env['PREDICTION_CACHE_SIZE'] = '0'
+    if mode == 'write_behind':
+        env['WRITE_BEHIND_QUEUE_SIZE'] = str(args.queue_size)
+    else:
+        env.pop('WRITE_BEHIND_QUEUE_SIZE', None)
+    return env
+
+
+def run(mode, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        out = subprocess.run([sys.executable, '-c', RUN, str(args.requests), str(args.threads), '0'],
+                             cwd=ROOT, env=environment(mode, args, tmp), capture_output=True, text=True,
+                             check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def run_workers(args, workers=2):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = environment('write_behind', args, tmp)
+        # Create the tables before the workers start
+        subprocess.run([sys.executable, '-c', 'import app'], cwd=ROOT, env=env, check=True, capture_output=True)
+        start_at = time.time() + args.startup
+        processes = [subprocess.Popen([sys.executable, '-c', RUN, str(args.requests), str(args.threads), str(start_at)],
+                                      cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+                     for _ in range(workers)]
+        return [json.loads(process.communicate()[0].strip().splitlines()[-1]) for process in processes]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--database-url', help="must point to an empty database, defaults to a temporary SQLite file")
+    parser.add_argument('--startup', type=float, default=10, help="seconds given to the workers to import the app")
+    args = parser.parse_args()
+
+    print("{:<14} {:>10} {:>8} {:>14}".format('mode', 'req/s', 'stored', 'avg flush ms'))
+    for mode in ['sync', 'write_behind']:
+        result = run(mode, args)
+        writer = result['writer']
+        flush = writer['avg_flush_seconds']
+        print("{:<14} {:>10.0f} {:>8} {:>14}".format(
+            mode, args.requests / result['seconds'], len(result['stored']),
+            '-' if flush is None else '{:.2f}'.format(flush * 1000)))
+
+    # The database of --database-url is no longer empty
+    if not args.database_url:
+        results = run_workers(args)
+        acknowledged = [admission_id for result in results for admission_id in result['acknowledged']]
+        assert len(acknowledged) == len(set(acknowledged)), \
+            "{} admission ids acknowledged by both workers".format(len(acknowledged) - len(set(acknowledged)))
+        stored = max((result['stored'] for result in results), key=len)
+        assert sorted(acknowledged) == sorted(stored), "acknowledged predictions are not stored"
+        print("two write-behind workers: {} ids acknowledged once each, all stored".format(len(acknowledged)))
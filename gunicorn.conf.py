@@ -0,0 +1,62 @@
+########################################
+## gunicorn settings for the production server: gunicorn -c gunicorn.conf.py app:app
+##
+## The app is loaded once in the master (pipeline, scorer, validator) and the
+## workers are forked from it, so they share those pages copy-on-write.
+
+import gc
+import os
+import glob
+import tempfile
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8000))
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+accesslog = os.environ.get('GUNICORN_ACCESSLOG')
+
+# Each worker writes its /metrics histograms here so that any of them can
+# serve the totals; the app reads it when it is imported
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='gunicorn-metrics-'))
+
+
+def on_starting(server):
+    # Counts left by a previous server are not ours
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], 'metrics-*.json')):
+        os.remove(path)
+
+
+def when_ready(server):
+    # Runs in the master once the app is imported and before any worker is
+    # forked. The model is loaded here so that the workers share it. Frozen
+    # objects are left out of garbage collections, which would otherwise
+    # write to their headers and copy the shared pages into every worker
+    if preload_app:
+        import app
+        app.load_model()
+        app.load_shadow_model()
+        gc.collect()
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    # The master never serves requests, but anything it opened is not ours
+    import app
+    from utils.db_pool import forget_connections
+    forget_connections(app.db)
+    # Shadow processes are forked before the threads of the worker start.
+    # asgi.py forks them at lifespan startup, after its inference processes
+    if not worker_class.startswith('uvicorn'):
+        app.start_shadow()
+
+
+def worker_exit(server, worker):
+    import app
+    app.shadow.close()
+    app.writer.close()
+    app.stage_metrics.close()
@@ -1,4 +1,9 @@
 from sklearn.base import BaseEstimator, TransformerMixin
+import os
+import time
+import random
+import threading
+from collections import deque
 import pandas as pd
 import numpy as np
 
@@ -15,9 +20,20 @@ class ColumnSelector(BaseEstimator, TransformerMixin):
     
 class CategoricalTransformer(BaseEstimator, TransformerMixin):
     
-    def __init__(self, mininum_records=250):
+    transformed_columns = {'diuretics','insulin','change','diabetesMed','readmitted','has_prosthesis','blood_transfusion',
+                           'gender','age','weight','complete_vaccination_status','blood_type','max_glu_serum','A1Cresult',
+                           'race','admission_type_code','admission_source_code','discharge_disposition_code',
+                           'medical_specialty','payer_code','diag_1','diag_2','diag_3'}
+    
+    # Default for transformers pickled before `vectorized` existed
+    vectorized = True
+    # Below this many rows the fixed cost of factorizing outweighs the savings
+    vectorized_min_rows = 500
+    
+    def __init__(self, mininum_records=250, vectorized=True):
         super().__init__()
         self.mininum_records = mininum_records
+        self.vectorized = vectorized
             
     def fit(self, X, y=None):
         _X = X.copy()
@@ -27,28 +43,28 @@ class CategoricalTransformer(BaseEstimator, TransformerMixin):
         for col in _X.columns:
             if col == 'admission_type_code' :
                 list_values = _X['admission_type_code'].value_counts().reset_index(name="count").query(query_min)["index"]
-                self.admission_type_code = [str(int(x)).lower() for x in list_values]
+                self.admission_type_code = {str(int(x)).lower() for x in list_values}
             elif col == 'discharge_disposition_code':
                 list_values = _X['discharge_disposition_code'].value_counts().reset_index(name="count").query(query_min)["index"]
-                self.discharge_disposition_code = [str(int(x)).lower() for x in list_values]
+                self.discharge_disposition_code = {str(int(x)).lower() for x in list_values}
             elif col == 'admission_source_code':
                 list_values = _X['admission_source_code'].value_counts().reset_index(name="count").query(query_min)["index"]
-                self.admission_source_code = [str(int(x)).lower() for x in list_values]
+                self.admission_source_code = {str(int(x)).lower() for x in list_values}
             elif col == 'medical_specialty':
                 list_values = _X['medical_specialty'].value_counts().reset_index(name="count").query(query_min)["index"]
-                self.medical_specialty = [str(x).lower() for x in list_values]
+                self.medical_specialty = {str(x).lower() for x in list_values}
             elif col == 'payer_code':
                 list_values = _X['payer_code'].value_counts().reset_index(name="count").query(query_min)["index"]
-                self.payer_code = [str(x).lower() for x in list_values]
+                self.payer_code = {str(x).lower() for x in list_values}
             elif col == 'diag_1':
                 list_values = _X['diag_1'].value_counts().reset_index(name="count").query(query_min)["index"]
-                self.diag_1 = [str(x).lower() for x in list_values]
+                self.diag_1 = {str(x).lower() for x in list_values}
             elif col == 'diag_2':
                 list_values = _X['diag_2'].value_counts().reset_index(name="count").query(query_min)["index"]
-                self.diag_2 = [str(x).lower() for x in list_values]
+                self.diag_2 = {str(x).lower() for x in list_values}
             elif col == 'diag_3':
                 list_values = _X['diag_3'].value_counts().reset_index(name="count").query(query_min)["index"]
-                self.diag_3 = [str(x).lower() for x in list_values]
+                self.diag_3 = {str(x).lower() for x in list_values}
 
         return self
 
@@ -68,7 +84,7 @@ class CategoricalTransformer(BaseEstimator, TransformerMixin):
             return 0
         
     def handle_categories(self, obj, list_categories):
-        if obj in list(list_categories):
+        if obj in list_categories:
             return str(obj)
         elif obj is None:
             return None
@@ -82,7 +98,7 @@ class CategoricalTransformer(BaseEstimator, TransformerMixin):
             return obj
         
     def handle_invalid_categories(self, obj, invalid_categories):
-        if obj in list(invalid_categories):
+        if obj in invalid_categories:
             return None
         else :
             return obj
@@ -146,85 +162,114 @@ class CategoricalTransformer(BaseEstimator, TransformerMixin):
         #    _X['diag_1_categories'] = values.apply(self.handle_missing_values)
         #    _X['diag_1_categories'] = _X['diag_1_categories'].apply(self.create_diag_category) 
         
-        for _col in _X:     
-            if _col in []:
-                #_X[_col] = _X[_col].apply(self.bool_to_binary)
-                _X[_col] = _X[_col].apply(self.text_to_binary)
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                
-            elif _col in ['diuretics','insulin','change','diabetesMed','readmitted','has_prosthesis','blood_transfusion']:
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.text_to_binary)
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                
-            elif _col in ['gender','age','weight','complete_vaccination_status','blood_type','max_glu_serum','A1Cresult']:
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                
-            elif _col in ['race']:
-                transformation = {"caucasian" : "caucasian", "white" : "caucasian", "european" : "caucasian", "euro" : "caucasian",
-                  "africanamerican" : "afroamerican", "black" : "afroamerican", "afroamerican" : "afroamerican",
-                  "latino" : "hispanic", "hispanic" : "hispanic", 
-                  "asian":"asian", 
-                  "?" : "missing", "other":"other"}                
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].map(transformation)
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                
-            elif _col in ['admission_type_code']:
-                invalid_categories = ['5','6','8']
-                _X[_col] = _X[_col].astype('Int64') 
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.handle_invalid_categories, args =([invalid_categories]))
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                _X[_col] = _X[_col].apply(self.handle_categories, args = ([self.admission_type_code]))   
-                
-            elif _col in ['admission_source_code']:
-                invalid_categories = ['9','15','17','20','21']
-                _X[_col] = _X[_col].astype('Int64') 
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.handle_invalid_categories, args =([invalid_categories]))
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                _X[_col] = _X[_col].apply(self.handle_categories, args = ([self.admission_source_code]))  
-                
-            elif _col in ['discharge_disposition_code']:
-                invalid_categories = ['18','25','26']
-                _X[_col] = _X[_col].astype('Int64') 
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.handle_invalid_categories, args =([invalid_categories]))
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                _X[_col] = _X[_col].apply(self.handle_categories, args = ([self.discharge_disposition_code]))  
-                
-            elif _col in ['medical_specialty']:
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                _X[_col] = _X[_col].apply(self.handle_categories, args = ([self.medical_specialty]))  
-                
-            elif _col in ['payer_code']:
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                _X[_col] = _X[_col].apply(self.handle_categories, args = ([self.payer_code])) 
+        for _col in _X:
+            if _col not in self.transformed_columns:
+                continue
+            if self.vectorized and len(_X) >= self.vectorized_min_rows:
+                _X[_col] = self.transform_unique_values(_col, _X[_col])
+            else:
+                _X[_col] = self.transform_column(_col, _X[_col])
+        
+        return _X
+    
+    def transform_unique_values(self, _col, values):
+        # Runs the column transformation once per distinct value and broadcasts
+        # the results back to every row. Values that compare equal but have
+        # different types (1, 1.0 and True) are kept apart, since their text
+        # representation differs
+        codes, _ = pd.factorize(values)
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) not in ('string', 'empty'):
+            type_codes, type_uniques = pd.factorize(values.map(type))
+            codes = (codes + 1) * len(type_uniques) + type_codes
+        # Missing values are coded -1, factorizing the codes gives them a code of their own
+        codes, _ = pd.factorize(codes)
+        _, first_rows = np.unique(codes, return_index=True)
+        
+        transformed = self.transform_column(_col, values.iloc[first_rows])
+        result = transformed.to_numpy(dtype=object)[codes]
+        
+        return pd.Series(result, index=values.index, name=values.name)
+    
+    def transform_column(self, _col, values):
+        if _col in []:
+            #values = values.apply(self.bool_to_binary)
+            values = values.apply(self.text_to_binary)
+            values = values.apply(self.pre_process_text)
+            values = values.apply(self.handle_missing_values)
+            
+        elif _col in ['diuretics','insulin','change','diabetesMed','readmitted','has_prosthesis','blood_transfusion']:
+            values = values.apply(self.pre_process_text)
+            # Kept as objects: a None in another row must not turn the column
+            # into floats, which makes every 1 a '1.0' instead of a '1'
+            values = values.apply(self.text_to_binary, convert_dtype=False)
+            values = values.apply(self.pre_process_text)
+            values = values.apply(self.handle_missing_values)
+            
+        elif _col in ['gender','age','weight','complete_vaccination_status','blood_type','max_glu_serum','A1Cresult']:
+            values = values.apply(self.pre_process_text)
+            values = values.apply(self.handle_missing_values)
+            
+        elif _col in ['race']:
+            transformation = {"caucasian" : "caucasian", "white" : "caucasian", "european" : "caucasian", "euro" : "caucasian",
+              "africanamerican" : "afroamerican", "black" : "afroamerican", "afroamerican" : "afroamerican",
+              "latino" : "hispanic", "hispanic" : "hispanic", 
+              "asian":"asian", 
+              "?" : "missing", "other":"other"}                
+            values = values.apply(self.pre_process_text)
+            values = values.map(transformation)
+            values = values.apply(self.handle_missing_values)
             
-            elif _col in ['diag_1']:
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                _X[_col] = _X[_col].apply(self.create_diag_category) 
-                #_X[_col] = _X[_col].apply(self.handle_categories, args = ([self.diag_1])) 
-                
+        elif _col in ['admission_type_code']:
+            invalid_categories = {'5','6','8'}
+            values = values.astype('Int64') 
+            values = values.apply(self.pre_process_text)
+            values = values.apply(self.handle_invalid_categories, args =([invalid_categories]))
+            values = values.apply(self.handle_missing_values)
+            values = values.apply(self.handle_categories, args = ([set(self.admission_type_code)]))   
+            
+        elif _col in ['admission_source_code']:
+            invalid_categories = {'9','15','17','20','21'}
+            values = values.astype('Int64') 
+            values = values.apply(self.pre_process_text)
+            values = values.apply(self.handle_invalid_categories, args =([invalid_categories]))
+            values = values.apply(self.handle_missing_values)
+            values = values.apply(self.handle_categories, args = ([set(self.admission_source_code)]))  
+            
+        elif _col in ['discharge_disposition_code']:
+            invalid_categories = {'18','25','26'}
+            values = values.astype('Int64') 
+            values = values.apply(self.pre_process_text)
+            values = values.apply(self.handle_invalid_categories, args =([invalid_categories]))
+            values = values.apply(self.handle_missing_values)
+            values = values.apply(self.handle_categories, args = ([set(self.discharge_disposition_code)]))  
+            
+        elif _col in ['medical_specialty']:
+            values = values.apply(self.pre_process_text)
+            values = values.apply(self.handle_missing_values)
+            values = values.apply(self.handle_categories, args = ([set(self.medical_specialty)]))  
+            
+        elif _col in ['payer_code']:
+            values = values.apply(self.pre_process_text)
+            values = values.apply(self.handle_missing_values)
+            values = values.apply(self.handle_categories, args = ([set(self.payer_code)])) 
         
-            elif _col in ['diag_2']:
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                _X[_col] = _X[_col].apply(self.handle_categories, args = ([self.diag_2])) 
+        elif _col in ['diag_1']:
+            values = values.apply(self.pre_process_text)
+            values = values.apply(self.handle_missing_values)
+            values = values.apply(self.create_diag_category) 
+            #values = values.apply(self.handle_categories, args = ([set(self.diag_1)])) 
+            
+        elif _col in ['diag_2']:
+            values = values.apply(self.pre_process_text)
+            values = values.apply(self.handle_missing_values)
+            values = values.apply(self.handle_categories, args = ([set(self.diag_2)])) 
         
-            elif _col in ['diag_3']:
-                _X[_col] = _X[_col].apply(self.pre_process_text)
-                _X[_col] = _X[_col].apply(self.handle_missing_values)
-                _X[_col] = _X[_col].apply(self.handle_categories, args = ([self.diag_3])) 
+        elif _col in ['diag_3']:
+            values = values.apply(self.pre_process_text)
+            values = values.apply(self.handle_missing_values)
+            values = values.apply(self.handle_categories, args = ([set(self.diag_3)])) 
         
-        return _X
+        return values
     
 class NumericalTransformer(BaseEstimator, TransformerMixin):
     def __init__(self):
@@ -242,6 +287,40 @@ class NumericalTransformer(BaseEstimator, TransformerMixin):
                 _X[_col] = _X[_col].astype('Float64')
         return _X
 
+# SaveTransformer steps keep a sample of the data that goes through them in
+# memory. Sampling is off unless PIPELINE_CAPTURE_RATE is set, and captures are
+# only written to disk on demand with `dump_captures`
+capture_sample_rate = float(os.environ.get('PIPELINE_CAPTURE_RATE', 0))
+capture_buffer_size = int(os.environ.get('PIPELINE_CAPTURE_BUFFER', 10))
+capture_rows = 50
+captures = {}
+captures_lock = threading.Lock()
+
+def set_capture_sample_rate(rate):
+    global capture_sample_rate
+    if not 0 <= rate <= 1:
+        raise ValueError("Sample rate must be between 0 and 1: {}".format(rate))
+    capture_sample_rate = rate
+
+def get_captures():
+    with captures_lock:
+        return {step: list(buffer) for step, buffer in captures.items()}
+
+def clear_captures():
+    with captures_lock:
+        captures.clear()
+
+def dump_captures(directory='.'):
+    # Writes the latest capture of each step, with the file names the
+    # SaveTransformer used to write on every call
+    names = []
+    for step, buffer in get_captures().items():
+        if buffer:
+            name = os.path.join(directory, "pipeline_"+step+"_spy.csv")
+            buffer[-1]['data'].to_csv(name)
+            names.append(name)
+    return names
+
 class SaveTransformer(BaseEstimator, TransformerMixin):
     
     def __init__(self, step):
@@ -252,7 +331,11 @@ class SaveTransformer(BaseEstimator, TransformerMixin):
         return self
     
     def transform(self, data):
-        X = data.copy()
-        name = "pipeline_"+self.step+"_spy.csv"
-        pd.DataFrame(X).head(50).to_csv(name)
-        return X
\ No newline at end of file
+        if capture_sample_rate <= 0 or random.random() >= capture_sample_rate:
+            return data
+        capture = {'captured_at': time.time(), 'data': pd.DataFrame(data).head(capture_rows).copy()}
+        with captures_lock:
+            if self.step not in captures:
+                captures[self.step] = deque(maxlen=capture_buffer_size)
+            captures[self.step].append(capture)
+        return data
@@ -0,0 +1,108 @@
+import time
+import threading
+
+from playhouse.db_url import connect, register_database
+from playhouse.pool import PooledPostgresqlDatabase, PooledSqliteDatabase, MaxConnectionsExceeded
+
+
+class PoolMetrics:
+    # Mixin for playhouse.pool databases. Counts checkouts and the time spent
+    # waiting for a free connection, keeps at most `pool_size` idle connections
+    # and, with `pre_ping`, checks idle connections before handing them out so
+    # that connections broken by a server restart are thrown away
+
+    def __init__(self, database, pool_size=None, pre_ping=False, **kwargs):
+        self.pool_size = pool_size
+        self.pre_ping = pre_ping
+        self.metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        super().__init__(database, **kwargs)
+
+    def connect(self, reuse_if_open=False):
+        start = time.perf_counter()
+        try:
+            opened = super().connect(reuse_if_open)
+        except MaxConnectionsExceeded:
+            with self.metrics_lock:
+                self.timeouts += 1
+            raise
+        if opened:
+            elapsed = time.perf_counter() - start
+            with self.metrics_lock:
+                self.checkouts += 1
+                self.wait_seconds += elapsed
+                self.max_wait_seconds = max(self.max_wait_seconds, elapsed)
+        return opened
+
+    def _is_closed(self, conn):
+        if super()._is_closed(conn):
+            return True
+        if self.pre_ping:
+            try:
+                conn.cursor().execute('SELECT 1')
+            except Exception:
+                return True
+        return False
+
+    def _close(self, conn, close_conn=False):
+        if not close_conn and self.pool_size is not None and len(self._connections) >= self.pool_size:
+            self._in_use.pop(self.conn_key(conn), None)
+            close_conn = True
+        super()._close(conn, close_conn)
+
+    def stats(self):
+        with self.metrics_lock:
+            return {'pooled': True,
+                    'max_connections': self._max_connections,
+                    'pool_size': self.pool_size,
+                    'stale_timeout': self._stale_timeout,
+                    'wait_timeout': self._wait_timeout,
+                    'in_use': len(self._in_use),
+                    'idle': len(self._connections),
+                    'checkouts': self.checkouts,
+                    'timeouts': self.timeouts,
+                    'wait_seconds': self.wait_seconds,
+                    'avg_wait_seconds': self.wait_seconds / self.checkouts if self.checkouts else None,
+                    'max_wait_seconds': self.max_wait_seconds}
+
+
+class MeteredPooledPostgresqlDatabase(PoolMetrics, PooledPostgresqlDatabase):
+    pass
+
+
+class MeteredPooledSqliteDatabase(PoolMetrics, PooledSqliteDatabase):
+
+    def __init__(self, database, **kwargs):
+        # Pooled connections are handed from one thread to the next
+        kwargs.setdefault('check_same_thread', False)
+        super().__init__(database, **kwargs)
+
+
+register_database(MeteredPooledPostgresqlDatabase, 'postgres+pool', 'postgresql+pool')
+register_database(MeteredPooledSqliteDatabase, 'sqlite+pool')
+
+
+def pooled_url(url):
+    # postgres://host/db -> postgres+pool://host/db
+    scheme, rest = url.split('://', 1)
+    if not scheme.endswith('+pool'):
+        scheme += '+pool'
+    return '{}://{}'.format(scheme, rest)
+
+
+def connect_database(url, pool=True, **params):
+    if pool:
+        return connect(pooled_url(url), **params)
+    return connect(url, **params)
+
+
+def forget_connections(db):
+    # Called in a forked child: drops the connections inherited from the parent
+    # without closing them, since the parent still owns the sockets
+    db._state.reset()
+    if isinstance(db, PoolMetrics):
+        db._connections = []
+        db._in_use = {}
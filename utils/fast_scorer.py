@@ -0,0 +1,172 @@
+import math
+import numpy as np
+import pandas as pd
+from sklearn.pipeline import Pipeline, FeatureUnion
+from sklearn.impute import SimpleImputer
+from sklearn.preprocessing import OneHotEncoder, RobustScaler
+
+from utils.custom_transformers import ColumnSelector, CategoricalTransformer, NumericalTransformer
+
+
+class CategoryLookup:
+    # Memoizes CategoricalTransformer.transform_column for single values, so
+    # each distinct value goes through the exact same code path as the pipeline
+    # once and is a dict lookup afterwards
+
+    def __init__(self, transformer, column, dtype, max_size=10000):
+        self.transformer = transformer
+        self.column = column
+        self.dtype = dtype
+        self.max_size = max_size
+        self.values = {}
+
+    def __call__(self, value):
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            key = None
+        else:
+            key = (type(value), value)
+        try:
+            return self.values[key]
+        except KeyError:
+            pass
+        result = self.transformer.transform_column(self.column, pd.Series([value], dtype=self.dtype)).iloc[0]
+        if len(self.values) < self.max_size:
+            self.values[key] = result
+        return result
+
+
+class CategoricalBlock:
+
+    def __init__(self, steps, dtypes):
+        steps = list(steps)
+        selector, transformer, imputer, encoder = [step for _, step in steps]
+        if not (isinstance(selector, ColumnSelector) and isinstance(transformer, CategoricalTransformer)
+                and isinstance(imputer, SimpleImputer) and isinstance(encoder, OneHotEncoder)):
+            raise ValueError("Unsupported categorical pipeline: {}".format([name for name, _ in steps]))
+        if imputer.strategy != 'constant' or imputer.missing_values is not None or imputer.add_indicator:
+            raise ValueError("Unsupported categorical imputer: {}".format(imputer))
+        if encoder.drop is not None or encoder.handle_unknown != 'ignore':
+            raise ValueError("Unsupported one-hot encoder: {}".format(encoder))
+
+        self.columns = list(selector.columns)
+        self.lookups = [CategoryLookup(transformer, col, dtypes[col]) for col in self.columns]
+        self.fill_value = imputer.fill_value
+        self.indices = []
+        offset = 0
+        for categories in encoder.categories_:
+            self.indices.append({category: offset + i for i, category in enumerate(categories)})
+            offset += len(categories)
+        self.n_features = offset
+
+    def fill(self, observation, out):
+        for col, lookup, indices in zip(self.columns, self.lookups, self.indices):
+            value = lookup(observation.get(col))
+            if value is None:
+                value = self.fill_value
+            index = indices.get(value)
+            if index is not None:
+                out[index] = 1.0
+
+
+class NumericalBlock:
+
+    def __init__(self, steps):
+        steps = list(steps)
+        selector, transformer, imputer, scaler = [step for _, step in steps]
+        if not (isinstance(selector, ColumnSelector) and isinstance(transformer, NumericalTransformer)
+                and isinstance(imputer, SimpleImputer) and isinstance(scaler, RobustScaler)):
+            raise ValueError("Unsupported numerical pipeline: {}".format([name for name, _ in steps]))
+        if not (isinstance(imputer.missing_values, float) and math.isnan(imputer.missing_values)) or imputer.add_indicator:
+            raise ValueError("Unsupported numerical imputer: {}".format(imputer))
+        if not np.all(np.isfinite(imputer.statistics_)):
+            raise ValueError("Imputer statistics must be finite to be compiled")
+
+        self.columns = list(selector.columns)
+        integer_columns = ['num_lab_procedures','num_procedures','num_medications','time_in_hospital','number_outpatient','number_emergency','number_inpatient','number_diagnoses']
+        self.integer = [col in integer_columns for col in self.columns]
+        self.statistics = np.asarray(imputer.statistics_, dtype=np.float64)
+        n = len(self.columns)
+        self.center = np.zeros(n) if scaler.center_ is None else np.asarray(scaler.center_, dtype=np.float64)
+        self.scale = np.ones(n) if scaler.scale_ is None else np.asarray(scaler.scale_, dtype=np.float64)
+        self.n_features = n
+
+    def values(self, observation):
+        x = np.empty(self.n_features, dtype=np.float64)
+        for i, (col, integer) in enumerate(zip(self.columns, self.integer)):
+            value = observation.get(col)
+            value = np.nan if value is None else float(value)
+            # NumericalTransformer casts these columns to Int64, which refuses fractional values
+            if integer and not math.isnan(value) and (not value.is_integer() or abs(value) >= 2**63):
+                raise ValueError("Cannot cast {}={} to an integer".format(col, value))
+            x[i] = value
+        missing = np.isnan(x)
+        x[missing] = self.statistics[missing]
+        return (x - self.center) / self.scale
+
+
+class CompiledScorer:
+    # Scores one validated observation without building a DataFrame: the fitted
+    # preprocessing steps are turned into lookups and arrays once, and only the
+    # final estimator is called
+
+    def __init__(self, pipeline, dtypes):
+        if not isinstance(pipeline, Pipeline) or len(pipeline.steps) != 2:
+            raise ValueError("Expected a Pipeline with a preprocessor and a model")
+        preprocessor = pipeline.steps[0][1]
+        self.model = pipeline.steps[-1][1]
+        if not isinstance(preprocessor, FeatureUnion) or preprocessor.transformer_weights:
+            raise ValueError("Expected a FeatureUnion preprocessor")
+
+        self.blocks = []
+        for _, block in preprocessor.transformer_list:
+            if not isinstance(block, Pipeline):
+                raise ValueError("Unsupported transformer: {}".format(block))
+            transformer = block.steps[1][1]
+            if isinstance(transformer, CategoricalTransformer):
+                self.blocks.append(CategoricalBlock(block.steps, dtypes))
+            elif isinstance(transformer, NumericalTransformer):
+                self.blocks.append(NumericalBlock(block.steps))
+            else:
+                raise ValueError("Unsupported transformer: {}".format(transformer))
+        self.n_features = sum(block.n_features for block in self.blocks)
+
+    def features(self, *observations):
+        # One row per observation, each computed from its own observation only
+        x = np.zeros((len(observations), self.n_features), dtype=np.float64)
+        for row, observation in enumerate(observations):
+            offset = 0
+            for block in self.blocks:
+                if isinstance(block, CategoricalBlock):
+                    block.fill(observation, x[row, offset:offset + block.n_features])
+                else:
+                    x[row, offset:offset + block.n_features] = block.values(observation)
+                offset += block.n_features
+        return x
+
+    def predict_proba(self, observation):
+        return self.model.predict_proba(self.features(observation))[0, 1]
+
+    def predict_proba_many(self, observations):
+        # Same probabilities as predict_proba on each observation, with one
+        # call to the model for all of them
+        if not observations:
+            return np.empty(0)
+        return self.model.predict_proba(self.features(*observations))[:, 1]
+
+    def verify(self, pipeline, observations, columns, dtypes):
+        # Returns the observations where the compiled scorer does not give
+        # exactly the same probability as the full pipeline
+        # The pipeline scores all of them in one call, rows are independent
+        mismatches = []
+        if not observations:
+            return mismatches
+        obs = pd.DataFrame(observations, columns=columns).astype(dtypes)
+        for observation, expected in zip(observations, pipeline.predict_proba(obs)[:, 1]):
+            result = self.predict_proba(observation)
+            if result != expected:
+                mismatches.append((observation, expected, result))
+        return mismatches
+
+
+def compile_scorer(pipeline, dtypes):
+    return CompiledScorer(pipeline, dtypes)
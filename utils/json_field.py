@@ -0,0 +1,72 @@
+import ast
+import json
+import math
+
+from peewee import Field
+
+
+def finite(value):
+    # NaN and infinities are not JSON, they are stored as null like other
+    # missing values
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: finite(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [finite(item) for item in value]
+    return value
+
+
+def dumps(value):
+    # Compact JSON: no spaces after separators, non-ASCII text kept as is
+    try:
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False, allow_nan=False)
+    except ValueError:
+        return json.dumps(finite(value), separators=(',', ':'), ensure_ascii=False, allow_nan=False)
+
+
+LEGACY_NAMES = {'None': None, 'True': True, 'False': False, 'nan': None, 'inf': None}
+
+
+def literal(node):
+    # ast.literal_eval, plus the bare `nan` and `inf` of float reprs
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Name) and node.id in LEGACY_NAMES:
+        return LEGACY_NAMES[node.id]
+    if isinstance(node, ast.Dict):
+        return {literal(key): literal(value) for key, value in zip(node.keys, node.values)}
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [literal(item) for item in node.elts]
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = literal(node.operand)
+        return None if value is None else -value
+    raise ValueError("Not a literal: {}".format(ast.dump(node)))
+
+
+def parse_legacy(text):
+    # Values written through str() before they were stored as JSON
+    return literal(ast.parse(text.strip(), mode='eval').body)
+
+
+def loads(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return parse_legacy(text)
+
+
+class JSONField(Field):
+    # A dict or list stored as compact JSON. The column is JSON on SQLite,
+    # where it is queried with json_extract(), and JSONB on Postgres, whose
+    # driver returns it already parsed. Rows written as Python reprs before
+    # are still read, see `migrate_observations` in app.py
+    field_type = 'JSON'
+
+    def db_value(self, value):
+        return None if value is None else dumps(value)
+
+    def python_value(self, value):
+        if value is None or not isinstance(value, str):
+            return value
+        return loads(value)
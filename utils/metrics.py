@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import bisect
+import threading
+import contextvars
+
+
+# Upper bounds in seconds of the histogram buckets, +Inf is implicit
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestTimer:
+    # Time of a request split in stages: `mark(stage)` adds the time since the
+    # previous mark (or the start) to `stage`, up to now or to `now`, a
+    # time.perf_counter() value
+
+    __slots__ = ('start', 'last', 'stages', 'outcome')
+
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.stages = {}
+        self.outcome = 'success'
+
+    def mark(self, stage, now=None):
+        now = time.perf_counter() if now is None else now
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+
+class StageHistograms:
+    # Fixed-bucket latency histograms per (endpoint, outcome, stage), plus the
+    # `total` of each request. Each request thread (or asyncio task, and the
+    # executor calls it makes with its context) has its own RequestTimer, and
+    # the stages are added to the histograms once the request finished.
+    #
+    # With a `directory`, every process writes its histograms to
+    # <directory>/metrics-<pid>.json at most every `flush_interval` seconds,
+    # and `collect` adds up the files of all processes, so that any gunicorn
+    # worker can serve the totals. Files of exited workers are kept: their
+    # counts stay in the totals, like Prometheus counters should
+
+    def __init__(self, directory=None, flush_interval=1.0, enabled=True, buckets=BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.timer = contextvars.ContextVar('request_timer', default=None)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.histograms = {}
+        self.dirty = False
+        self.thread = None
+        self.closed = threading.Event()
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        # A worker starts from its own file, in case it reuses the pid of an
+        # exited one
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.timer = contextvars.ContextVar('request_timer', default=None)
+        self.histograms = self.read(self.path()) if self.directory else {}
+        self.dirty = False
+        self.thread = None
+        self.closed = threading.Event()
+
+    def start_request(self):
+        if self.enabled:
+            self.timer.set(RequestTimer())
+
+    def mark(self, stage, now=None):
+        timer = self.timer.get()
+        if timer is not None:
+            timer.mark(stage, now)
+
+    def set_outcome(self, outcome):
+        timer = self.timer.get()
+        if timer is not None:
+            timer.outcome = outcome
+
+    def finish_request(self, endpoint, outcome=None):
+        timer = self.timer.get()
+        if timer is None:
+            return
+        self.timer.set(None)
+        if endpoint is None:
+            return
+        stages = timer.stages
+        stages['total'] = time.perf_counter() - timer.start
+        outcome = outcome or timer.outcome
+        with self.lock:
+            for stage, seconds in stages.items():
+                key = (endpoint, outcome, stage)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    # One count per bucket and +Inf, then the sum
+                    histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+                histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+                histogram[-1] += seconds
+            self.dirty = True
+        if self.directory and self.thread is None:
+            self.start_flusher()
+
+    def start_flusher(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='metrics-flush', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    def path(self, pid=None):
+        return os.path.join(self.directory, 'metrics-{}.json'.format(pid or os.getpid()))
+
+    def snapshot(self):
+        with self.lock:
+            return {key: list(histogram) for key, histogram in self.histograms.items()}
+
+    def flush(self):
+        if not self.directory or not self.dirty:
+            return
+        # The flusher thread and a scrape may flush at the same time
+        with self.flush_lock:
+            with self.lock:
+                self.dirty = False
+                rows = [list(key) + histogram for key, histogram in self.histograms.items()]
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = self.path() + '.tmp'
+            with open(tmp, 'w') as fh:
+                json.dump({'buckets': self.buckets, 'histograms': rows}, fh)
+            os.replace(tmp, self.path())
+
+    def close(self):
+        self.closed.set()
+        self.flush()
+
+    def read(self, path):
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return {}
+        if tuple(data['buckets']) != self.buckets:
+            return {}
+        return {tuple(row[:3]): row[3:] for row in data['histograms']}
+
+    def collect(self):
+        # With a directory the totals are only read from the files, this
+        # process' included once flushed, so that they never go down from
+        # one scrape to the next whichever worker serves them
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        merged = {}
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if not (name.startswith('metrics-') and name.endswith('.json')):
+                    continue
+                for key, histogram in self.read(os.path.join(self.directory, name)).items():
+                    if key in merged:
+                        merged[key] = [a + b for a, b in zip(merged[key], histogram)]
+                    else:
+                        merged[key] = histogram
+        return merged
+
+    def render(self, name='app_request_stage_seconds'):
+        # Prometheus text exposition format
+        lines = ['# HELP {} Time spent in each stage of a request, per endpoint and outcome.'.format(name),
+                 '# TYPE {} histogram'.format(name)]
+        bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+        for (endpoint, outcome, stage), histogram in sorted(self.collect().items()):
+            labels = 'endpoint="{}",outcome="{}",stage="{}"'.format(endpoint, outcome, stage)
+            count = 0
+            for bound, bucket_count in zip(bounds, histogram[:-1]):
+                count += bucket_count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, count))
+            lines.append('{}_sum{{{}}} {!r}'.format(name, labels, histogram[-1]))
+            lines.append('{}_count{{{}}} {}'.format(name, labels, count))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,161 @@
+import os
+import time
+import queue
+import bisect
+import threading
+from concurrent.futures import Future
+
+from utils.metrics import BUCKETS
+
+
+STOP = 'stop'
+
+
+class Job:
+    # One observation waiting to be scored. `queued` and `started` are
+    # time.perf_counter() values: when it was submitted and when its batch
+    # started scoring
+
+    __slots__ = ('model', 'observation', 'future', 'queued', 'started')
+
+    def __init__(self, model, observation):
+        self.model = model
+        self.observation = observation
+        self.future = Future()
+        self.queued = time.perf_counter()
+        self.started = None
+
+
+class MicroBatcher:
+    # Coalesces concurrent single-observation scoring calls. `submit(model,
+    # observation)` queues a Job, and a batcher thread takes the oldest job,
+    # waits until it has `max_batch_size` jobs or the oldest one has waited
+    # `max_wait` seconds, then scores the observations of each model with one
+    # `score_batch(observations, model)` call and resolves the futures of the
+    # jobs with their probability, or with the exception of the call. Jobs
+    # that queue up while a batch is scored go into the next one without
+    # waiting. Off when `max_batch_size` is 1 or less
+
+    def __init__(self, score_batch, max_batch_size=1, max_wait=0.002):
+        self.score_batch = score_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = None
+        self.clear()
+        # The batcher thread does not survive a fork, each worker starts its own
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return self.max_batch_size > 1
+
+    def clear(self):
+        with self.lock:
+            self.batches = 0
+            self.jobs = 0
+            self.failed = 0
+            # Number of batches of each size, and jobs per queue wait bucket
+            self.sizes = {}
+            self.waits = [0] * (len(BUCKETS) + 1)
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            self.score_seconds = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, name='micro-batcher', daemon=True)
+            self.thread.start()
+
+    def submit(self, model, observation):
+        if self.thread is None:
+            self.start()
+        job = Job(model, observation)
+        self.queue.put(job)
+        return job
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is STOP:
+                return
+            batch = [job]
+            deadline = job.queued + self.max_wait
+            stop = False
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    job = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is STOP:
+                    stop = True
+                    break
+                batch.append(job)
+            self.score(batch)
+            if stop:
+                return
+
+    def score(self, batch):
+        started = time.perf_counter()
+        groups = {}
+        for job in batch:
+            job.started = started
+            groups.setdefault(id(job.model), []).append(job)
+        failed = 0
+        for jobs in groups.values():
+            try:
+                probabilities = self.score_batch([job.observation for job in jobs], jobs[0].model)
+            except Exception as e:
+                failed += len(jobs)
+                for job in jobs:
+                    job.future.set_exception(e)
+                continue
+            for job, probability in zip(jobs, probabilities):
+                job.future.set_result(probability)
+        seconds = time.perf_counter() - started
+        with self.lock:
+            self.batches += 1
+            self.jobs += len(batch)
+            self.failed += failed
+            self.sizes[len(batch)] = self.sizes.get(len(batch), 0) + 1
+            for job in batch:
+                wait = started - job.queued
+                self.waits[bisect.bisect_left(BUCKETS, wait)] += 1
+                self.wait_seconds += wait
+                self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self.score_seconds += seconds
+
+    def close(self):
+        # Scores the jobs already queued, then stops the batcher thread
+        with self.lock:
+            thread = self.thread
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put(STOP)
+        thread.join()
+
+    def stats(self):
+        with self.lock:
+            bounds = [repr(bound) for bound in BUCKETS] + ['+Inf']
+            return {'enabled': self.enabled,
+                    'max_batch_size': self.max_batch_size,
+                    'max_wait': self.max_wait,
+                    'queue_depth': self.queue.qsize(),
+                    'batches': self.batches,
+                    'jobs': self.jobs,
+                    'failed': self.failed,
+                    'mean_batch_size': self.jobs / self.batches if self.batches else None,
+                    'batch_sizes': {str(size): count for size, count in sorted(self.sizes.items())},
+                    'queue_wait_seconds': dict(zip(bounds, self.waits)),
+                    'mean_queue_wait_seconds': self.wait_seconds / self.jobs if self.jobs else None,
+                    'max_queue_wait_seconds': self.max_wait_seconds,
+                    'mean_score_seconds': self.score_seconds / self.batches if self.batches else None}
@@ -0,0 +1,109 @@
+import os
+import time
+import threading
+
+
+ARTIFACTS = ['pipeline.pickle', 'dtypes.pickle', 'columns.json']
+DEFAULT = 'default'
+POINTER = 'ACTIVE'
+
+
+class LoadedModel:
+    # Everything needed to validate and score an observation with one model
+    # version. Requests take the active LoadedModel once and use it until they
+    # respond, so a swap never mixes the schema of a version with the
+    # pipeline of another
+
+    def __init__(self, name, version, path, columns, dtypes, pipeline, validator, scorer):
+        self.name = name
+        self.version = version
+        self.path = path
+        self.columns = columns
+        self.dtypes = dtypes
+        self.pipeline = pipeline
+        self.validator = validator
+        self.scorer = scorer
+        self.loaded_at = time.time()
+
+    def describe(self):
+        return {'name': self.name,
+                'version': self.version,
+                'path': self.path,
+                'fast_scorer': self.scorer is not None,
+                'loaded_at': self.loaded_at}
+
+
+class ModelRegistry:
+    # Model versions are the subdirectories of `root` that hold pipeline.pickle,
+    # dtypes.pickle and columns.json; the files in `default_path` are the
+    # `default` version. The `ACTIVE` file in `root` names the version workers
+    # should serve: it is written once a version is loaded, and `poll` lets
+    # the other workers notice it changed
+
+    def __init__(self, root='models', default_path='.', poll_interval=5):
+        self.root = root
+        self.default_path = default_path
+        self.poll_interval = poll_interval
+        self.pointer = os.path.join(root, POINTER)
+        self.lock = threading.Lock()
+        self.pointer_stat = self.stat_pointer()
+        self.polled_at = time.monotonic()
+
+    def versions(self):
+        versions = [DEFAULT]
+        if os.path.isdir(self.root):
+            for name in sorted(os.listdir(self.root)):
+                path = os.path.join(self.root, name)
+                if all(os.path.exists(os.path.join(path, artifact)) for artifact in ARTIFACTS):
+                    versions.append(name)
+        return versions
+
+    def path(self, name):
+        # Only listed versions are accepted, so names cannot point elsewhere
+        if name not in self.versions():
+            raise ValueError("Unknown model version: '{}'".format(name))
+        if name == DEFAULT:
+            return self.default_path
+        return os.path.join(self.root, name)
+
+    def active_name(self):
+        try:
+            with open(self.pointer) as fh:
+                name = fh.read().strip()
+        except FileNotFoundError:
+            return DEFAULT
+        return name or DEFAULT
+
+    def set_active(self, name):
+        # Written to a temporary file then renamed, so readers never see a
+        # partial name
+        os.makedirs(self.root, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.pointer, os.getpid())
+        with open(tmp, 'w') as fh:
+            fh.write(name + '\n')
+        os.replace(tmp, self.pointer)
+        with self.lock:
+            self.pointer_stat = self.stat_pointer()
+
+    def stat_pointer(self):
+        try:
+            stat = os.stat(self.pointer)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def poll(self):
+        # The version named by the pointer if it changed since the last poll,
+        # checked at most every `poll_interval` seconds
+        if self.poll_interval <= 0:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            if now - self.polled_at < self.poll_interval:
+                return None
+            self.polled_at = now
+            stat = self.stat_pointer()
+            if stat == self.pointer_stat:
+                return None
+            self.pointer_stat = stat
+        return self.active_name()
@@ -0,0 +1,91 @@
+import time
+import queue
+import threading
+
+from loguru import logger
+
+
+END = 'end'
+
+
+class LineTooLong:
+    # Stands for an input line longer than `max_line` bytes, which is skipped
+    # without being held in memory
+
+    def __init__(self, max_line):
+        self.max_line = max_line
+
+
+class NDJSONBatches:
+    # Reads the lines of a request body (`wsgi.input`) from a background
+    # thread into a queue of at most `queue_size` lines, and yields them in
+    # batches: a batch starts with the next line available and takes the lines
+    # that arrive within `max_wait` seconds, up to `batch_size`. Lines sent
+    # while the previous batch is scored are batched together, and a client
+    # sending one line at a time gets an answer without waiting for more.
+    #
+    # Memory stays bounded by `queue_size` lines of at most `max_line` bytes
+    # whatever the size of the body. When the consumer is slow (e.g. the
+    # client does not read the responses) the queue fills up and the reader
+    # stops reading, so the client's sends block on TCP flow control
+
+    def __init__(self, stream, batch_size=64, max_wait=0.005, max_line=1 << 20, queue_size=None):
+        self.stream = stream
+        self.batch_size = max(batch_size, 1)
+        self.max_wait = max_wait
+        self.max_line = max_line
+        self.queue = queue.Queue(maxsize=queue_size or 2 * self.batch_size)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='ndjson-reader', daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        # Waits for room in the queue until the batches are closed
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        try:
+            while not self.closed.is_set():
+                line = self.stream.readline(self.max_line + 1)
+                if not line:
+                    break
+                if len(line) > self.max_line:
+                    # Skip the rest of the line
+                    while line and not line.endswith(b'\n'):
+                        line = self.stream.readline(self.max_line)
+                    line = LineTooLong(self.max_line)
+                elif not line.strip():
+                    continue
+                if not self.put(line):
+                    return
+        except Exception as e:
+            # The client went away: the batches end with what was read
+            logger.warning("Reading the request body failed: {}".format(e))
+        self.put(END)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is END:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is END:
+                    yield batch
+                    return
+                batch.append(item)
+            yield batch
+
+    def close(self):
+        self.closed.set()
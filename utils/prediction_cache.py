@@ -0,0 +1,68 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class PredictionCache:
+    # Bounded LRU cache of model probabilities with a time to live. Keys are
+    # built from the validated observation and the model version, so entries
+    # of a previous model are never returned
+
+    def __init__(self, max_size=10000, ttl=3600, excluded=('admission_id', 'patient_id')):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.excluded = set(excluded)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def key(self, observation, columns, model_version):
+        features = [[col, observation.get(col)] for col in columns if col not in self.excluded]
+        payload = json.dumps([model_version, features], separators=(',', ':'), default=str)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries),
+                    'max_size': self.max_size,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else None}
@@ -0,0 +1,204 @@
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import functools
+import itertools
+import threading
+from collections import Counter
+
+
+MODES = ('cprofile', 'sampler')
+
+
+def collapse(frame):
+    # One line of a collapsed stack file (flamegraph.pl, speedscope): the
+    # functions from the outermost frame to `frame`, separated by `;`
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    # Statistical profiler: while threads are registered, a background thread
+    # reads their stack every `interval` seconds and counts the collapsed
+    # stacks. Unlike cProfile it does not slow down the profiled code, only
+    # takes the GIL `1 / interval` times per second
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.threads = set()
+        self.stacks = Counter()
+        self.samples = 0
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def start(self, thread_id):
+        with self.lock:
+            self.threads.add(thread_id)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='profile-sampler', daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+    def stop(self, thread_id):
+        with self.lock:
+            self.threads.discard(thread_id)
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            with self.lock:
+                threads = list(self.threads)
+                if not threads:
+                    self.wakeup.clear()
+                    continue
+            frames = sys._current_frames()
+            stacks = [collapse(frames[thread_id]) for thread_id in threads if thread_id in frames]
+            with self.lock:
+                self.stacks.update(stacks)
+                self.samples += len(stacks)
+            time.sleep(self.interval)
+
+    def clear(self):
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+
+
+class RequestProfiler:
+    # Profiles 1 in `sample_every` calls of the wrapped views, and the calls
+    # with the `header` request header when `allow_header` is set, with
+    # cProfile (aggregated in one pstats.Stats) or the StackSampler (collapsed
+    # stacks). When it is disabled a wrapped view only costs one attribute
+    # test. Profiles stay in the memory of each process until dumped
+    #
+    # `header_allowed(request)` decides whether a request asking for a
+    # profile through the header gets one
+
+    def __init__(self, sample_every=0, mode='cprofile', allow_header=False, header='X-Profile',
+                 interval=0.001, header_allowed=None):
+        self.lock = threading.Lock()
+        self.header = header
+        self.header_allowed = header_allowed
+        self.sampler = StackSampler(interval)
+        self.configure(sample_every=sample_every, mode=mode, allow_header=allow_header)
+        self.clear()
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        # Each worker profiles its own requests, and the sampler thread does
+        # not survive the fork
+        self.lock = threading.Lock()
+        self.sampler = StackSampler(self.sampler.interval)
+        self.clear()
+
+    def configure(self, sample_every=None, mode=None, allow_header=None):
+        if sample_every is not None:
+            sample_every = int(sample_every)
+            if sample_every < 0:
+                raise ValueError("sample_every must be 0 (off) or a positive integer: {}".format(sample_every))
+            self.sample_every = sample_every
+            self.calls = itertools.count(1)
+        if mode is not None:
+            if mode not in MODES:
+                raise ValueError("Unknown profiler mode: '{}', expected one of {}".format(mode, ', '.join(MODES)))
+            self.mode = mode
+        if allow_header is not None:
+            self.allow_header = bool(allow_header)
+        self.enabled = self.sample_every > 0 or self.allow_header
+
+    def clear(self):
+        with self.lock:
+            self.stats = None
+            self.profiled = Counter()
+            self.seconds = 0.0
+        self.sampler.clear()
+
+    def should_profile(self, request):
+        if self.sample_every and next(self.calls) % self.sample_every == 0:
+            return True
+        if self.allow_header and request.headers.get(self.header):
+            return self.header_allowed is None or self.header_allowed(request)
+        return False
+
+    def wrap(self, view, request):
+        @functools.wraps(view)
+        def profiled_view(*args, **kwargs):
+            if not self.enabled or not self.should_profile(request):
+                return view(*args, **kwargs)
+            return self.profile(view.__name__, view, *args, **kwargs)
+        return profiled_view
+
+    def profile(self, name, function, *args, **kwargs):
+        mode = self.mode
+        start = time.perf_counter()
+        if mode == 'cprofile':
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(function, *args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start, profile)
+        thread_id = threading.get_ident()
+        self.sampler.start(thread_id)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.sampler.stop(thread_id)
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, profile=None):
+        with self.lock:
+            self.profiled[name] += 1
+            self.seconds += seconds
+            if profile is None:
+                return
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def stats_report(self, limit=40, sort='cumulative'):
+        with self.lock:
+            if self.stats is None:
+                return ''
+            stream = io.StringIO()
+            self.stats.stream = stream
+            self.stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def collapsed(self):
+        with self.sampler.lock:
+            stacks = list(self.sampler.stacks.items())
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(stacks))
+
+    def dump(self, directory='.'):
+        # Writes what was profiled so far: a pstats file (`python -m pstats`,
+        # snakeviz) and a collapsed stack file (flamegraph.pl, speedscope)
+        os.makedirs(directory, exist_ok=True)
+        prefix = os.path.join(directory, 'profile-{}-{}'.format(os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        names = []
+        with self.lock:
+            if self.stats is not None:
+                self.stats.dump_stats(prefix + '.pstats')
+                names.append(prefix + '.pstats')
+        collapsed = self.collapsed()
+        if collapsed:
+            with open(prefix + '.collapsed', 'w') as fh:
+                fh.write(collapsed)
+            names.append(prefix + '.collapsed')
+        return names
+
+    def status(self):
+        with self.lock:
+            profiled = dict(self.profiled)
+            seconds = self.seconds
+        return {'enabled': self.enabled, 'mode': self.mode, 'sample_every': self.sample_every,
+                'allow_header': self.allow_header, 'header': self.header, 'pid': os.getpid(),
+                'profiled': profiled, 'profiled_seconds': seconds, 'stack_samples': self.sampler.samples}
@@ -0,0 +1,79 @@
+import math
+
+
+BUCKETS = 100
+
+
+def is_positive(label):
+    return label.strip().lower() == 'yes'
+
+
+def is_label(label):
+    return label is not None and label.strip().lower() in ('yes', 'no')
+
+
+def bucket(probability):
+    # Scores are counted in BUCKETS equal-width bins of probability
+    return min(max(int(math.floor(probability * BUCKETS)), 0), BUCKETS - 1)
+
+
+def counter_deltas(prediction, probability, old_label, new_label):
+    # Changes to the counters of one prediction when its true class goes from
+    # `old_label` to `new_label`; labels that are not yes/no are not counted
+    deltas = {}
+    for label, delta in [(old_label, -1), (new_label, 1)]:
+        if not is_label(label):
+            continue
+        positive = is_positive(label)
+        predicted = is_positive(prediction)
+        cell = ('t' if positive == predicted else 'f') + ('p' if predicted else 'n')
+        histogram = '{}:{}'.format('pos' if positive else 'neg', bucket(probability))
+        for name in (cell, histogram):
+            deltas[name] = deltas.get(name, 0) + delta
+    return {name: delta for name, delta in deltas.items() if delta}
+
+
+def ratio(numerator, denominator):
+    return numerator / denominator if denominator else None
+
+
+def summarize(counts):
+    # Metrics from summed counters: the confusion matrix at the served
+    # threshold, and ROC and precision/recall curves with one point per bucket
+    # edge, where scores in the bucket and above count as positive
+    tp, fp, tn, fn = [counts.get(cell, 0) for cell in ('tp', 'fp', 'tn', 'fn')]
+    positives = [counts.get('pos:{}'.format(k), 0) for k in range(BUCKETS)]
+    negatives = [counts.get('neg:{}'.format(k), 0) for k in range(BUCKETS)]
+    n_positive = sum(positives)
+    n_negative = sum(negatives)
+
+    roc = []
+    pr = []
+    true_positives = false_positives = 0
+    for k in reversed(range(BUCKETS)):
+        true_positives += positives[k]
+        false_positives += negatives[k]
+        threshold = k / BUCKETS
+        roc.append({'threshold': threshold,
+                    'tpr': ratio(true_positives, n_positive),
+                    'fpr': ratio(false_positives, n_negative)})
+        pr.append({'threshold': threshold,
+                   'precision': ratio(true_positives, true_positives + false_positives),
+                   'recall': ratio(true_positives, n_positive)})
+
+    auc = None
+    if n_positive and n_negative:
+        auc = 0.0
+        previous = (0.0, 0.0)
+        for point in roc:
+            auc += (point['fpr'] - previous[0]) * (point['tpr'] + previous[1]) / 2
+            previous = (point['fpr'], point['tpr'])
+
+    return {'labelled': tp + fp + tn + fn,
+            'confusion': {'tp': tp, 'fp': fp, 'tn': tn, 'fn': fn},
+            'accuracy': ratio(tp + tn, tp + fp + tn + fn),
+            'precision': ratio(tp, tp + fp),
+            'recall': ratio(tp, tp + fn),
+            'roc_auc': auc,
+            'roc': roc[::-1],
+            'pr': pr[::-1]}
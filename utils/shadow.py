@@ -0,0 +1,203 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from loguru import logger
+
+
+def lower_priority(niceness):
+    # Runs in each shadow process as it starts: the request path gets the CPU
+    # first when both want it
+    if niceness:
+        os.nice(niceness)
+
+
+def timed(score, items, key):
+    start = time.perf_counter()
+    result = score(items, key)
+    return result, time.perf_counter() - start
+
+
+class ShadowScorer:
+    # Runs `score(items, key)` in a pool of `max_workers` processes, for work
+    # the response does not wait for (scoring with a candidate model), and
+    # `save(result)` with its result in the calling process, on the thread
+    # that collects the results. Scoring in other processes keeps it off the
+    # GIL of the request threads, and `niceness` lowers their CPU priority.
+    #
+    # Items wait in a buffer until there are `batch_size` of them or the
+    # oldest has waited `max_wait` seconds, then go together, one job per key,
+    # to an idle process (each one has one job at a time), so that the cost of
+    # a job in the caller is shared by many items. An item that finds
+    # `max_pending` items already waiting is dropped and counted, so a slow
+    # candidate never backs up onto the request path.
+    #
+    # The processes are forked with what the caller has loaded when the first
+    # items are submitted, or by `start`, which should run before the caller
+    # starts other threads
+
+    def __init__(self, score, save, max_workers=1, max_pending=1000, batch_size=50, max_wait=0.5, niceness=10):
+        self.score = score
+        self.save = save
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.niceness = niceness
+        self.lock = threading.Lock()
+        self.executor = None
+        self.clear()
+        # The processes belong to the process that started them, each worker
+        # starts its own
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.clear()
+
+    def clear(self):
+        self.waiting = []
+        self.waiting_since = None
+        self.running = 0
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.jobs = 0
+        self.score_seconds = 0.0
+        self.max_score_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self.max_workers > 0 and self.max_pending > 0
+
+    def new_executor(self):
+        executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('fork'),
+                                       initializer=lower_priority, initargs=(self.niceness,))
+        # Forks all the processes now
+        executor.submit(int).result()
+        return executor
+
+    def start(self):
+        with self.lock:
+            if self.enabled and self.executor is None:
+                self.executor = self.new_executor()
+
+    def submit(self, items, key=None):
+        # Returns the number of items dropped
+        timer = None
+        with self.lock:
+            room = max(self.max_pending - len(self.waiting), 0)
+            dropped = max(len(items) - room, 0)
+            self.dropped += dropped
+            self.submitted += len(items) - dropped
+            if room and items and not self.waiting:
+                self.waiting_since = time.monotonic()
+                timer = threading.Timer(self.max_wait, self.flush)
+                timer.daemon = True
+            self.waiting.extend((key, item) for item in items[:room])
+            jobs = self.take_jobs()
+        if timer is not None:
+            timer.start()
+        self.run(jobs)
+        return dropped
+
+    def flush(self):
+        with self.lock:
+            jobs = self.take_jobs(force=True)
+        self.run(jobs)
+
+    def take_jobs(self, force=False):
+        # The waiting items, grouped by key into jobs for an idle process, if
+        # they are due. Called with the lock held
+        if not self.waiting or self.running >= self.max_workers:
+            return []
+        if not (force or len(self.waiting) >= self.batch_size
+                or time.monotonic() - self.waiting_since >= self.max_wait):
+            return []
+        if self.executor is None:
+            self.executor = self.new_executor()
+        groups = {}
+        for key, item in self.waiting:
+            groups.setdefault(key, []).append(item)
+        self.waiting = []
+        jobs = [(self.executor, key, items) for key, items in groups.items()]
+        self.running += 1
+        self.jobs += len(jobs)
+        return jobs
+
+    def run(self, jobs):
+        if not jobs:
+            return
+        remaining = [len(jobs)]
+        for executor, key, items in jobs:
+            try:
+                future = executor.submit(timed, self.score, items, key)
+            except (BrokenProcessPool, RuntimeError) as e:
+                self.done(executor, items, remaining, error=e)
+                continue
+            future.add_done_callback(lambda future, executor=executor, items=items:
+                                     self.done(executor, items, remaining, future=future))
+
+    def done(self, executor, items, remaining, future=None, error=None):
+        seconds = 0.0
+        if error is None:
+            try:
+                result, seconds = future.result()
+                self.save(result)
+            except Exception as e:
+                error = e
+        if error is not None:
+            logger.warning("Shadow scoring failed: {}".format(error))
+        with self.lock:
+            if error is None:
+                self.completed += len(items)
+            else:
+                self.failed += len(items)
+            if isinstance(error, BrokenProcessPool) and self.executor is executor:
+                # A shadow process died: the next job starts a new pool
+                self.executor = None
+            self.score_seconds += seconds
+            self.max_score_seconds = max(self.max_score_seconds, seconds)
+            remaining[0] -= 1
+            jobs = []
+            if remaining[0] == 0:
+                # The process is free for what arrived in the meantime
+                self.running -= 1
+                jobs = self.take_jobs()
+        self.run(jobs)
+
+    def close(self, wait=True):
+        # With `wait`, the items already submitted are scored and saved first
+        while wait:
+            self.flush()
+            with self.lock:
+                if not self.waiting and self.running == 0:
+                    break
+            time.sleep(0.01)
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self.lock:
+            return {'max_workers': self.max_workers,
+                    'max_pending': self.max_pending,
+                    'batch_size': self.batch_size,
+                    'max_wait': self.max_wait,
+                    'niceness': self.niceness,
+                    'waiting': len(self.waiting),
+                    'running': self.running,
+                    'submitted': self.submitted,
+                    'completed': self.completed,
+                    'dropped': self.dropped,
+                    'failed': self.failed,
+                    'jobs': self.jobs,
+                    'mean_job_size': (self.completed + self.failed) / self.jobs if self.jobs else None,
+                    'mean_score_seconds': self.score_seconds / self.jobs if self.jobs else None,
+                    'max_score_seconds': self.max_score_seconds}
@@ -0,0 +1,131 @@
+import sys
+
+import numpy as np
+
+
+class TreeEnsemble:
+    # Binary gradient boosting model flattened into contiguous arrays. The
+    # nodes of all trees are concatenated: `roots` holds the index of each
+    # tree's root, `left` and `right` are absolute node indices (-1 for
+    # leaves) and `value` holds the leaf values. Scoring only uses NumPy
+
+    chunk_size = 4096
+    fields = ['roots', 'feature', 'threshold', 'left', 'right', 'value', 'init', 'learning_rate', 'n_features', 'max_depth']
+
+    def __init__(self, roots, feature, threshold, left, right, value, init, learning_rate, n_features, max_depth):
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.feature = np.asarray(feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.init = float(init)
+        self.learning_rate = float(learning_rate)
+        self.n_features = int(n_features)
+        self.max_depth = int(max_depth)
+
+        # Leaves point to themselves, so every row can take `max_depth` steps
+        leaves = self.left < 0
+        nodes = np.arange(len(self.left), dtype=np.int32)
+        self.next_left = np.where(leaves, nodes, self.left)
+        self.next_right = np.where(leaves, nodes, self.right)
+        self.scaled_value = self.learning_rate * self.value
+
+    def raw_predict(self, X):
+        # Like sklearn, features are compared as float32 against float64
+        # thresholds, and the trees are added one after the other to the prior
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[1] != self.n_features:
+            raise ValueError("Expected {} features, got {}".format(self.n_features, X.shape[1]))
+
+        raw = np.empty(X.shape[0], dtype=np.float64)
+        for start in range(0, X.shape[0], self.chunk_size):
+            raw[start:start + self.chunk_size] = self._raw_predict_chunk(X[start:start + self.chunk_size])
+        return raw
+
+    def _raw_predict_chunk(self, X):
+        # Rows are walked in chunks so the (rows x trees) index arrays stay in
+        # cache, and features are read from the flattened chunk
+        flat = np.ascontiguousarray(X).ravel()
+        offsets = (np.arange(X.shape[0]) * self.n_features)[:, None]
+        nodes = np.broadcast_to(self.roots, (X.shape[0], len(self.roots)))
+        for _ in range(self.max_depth):
+            go_left = flat[offsets + self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.next_left[nodes], self.next_right[nodes])
+
+        stages = np.empty((X.shape[0], len(self.roots) + 1), dtype=np.float64)
+        stages[:, 0] = self.init
+        stages[:, 1:] = self.scaled_value[nodes]
+        return np.cumsum(stages, axis=1)[:, -1]
+
+    def predict_proba(self, X):
+        raw = self.raw_predict(X)
+        proba = np.ones((raw.shape[0], 2), dtype=np.float64)
+        proba[:, 1] = 1.0 / (1.0 + np.exp(-raw))
+        proba[:, 0] -= proba[:, 1]
+        return proba
+
+    def save(self, path):
+        np.savez_compressed(path, **{name: getattr(self, name) for name in self.fields})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in cls.fields})
+
+
+def export_trees(model):
+    # Flattens a fitted binary GradientBoostingClassifier
+    from sklearn.ensemble import GradientBoostingClassifier
+
+    if not isinstance(model, GradientBoostingClassifier):
+        raise ValueError("Expected a GradientBoostingClassifier, got {}".format(type(model).__name__))
+    if model.n_classes_ != 2 or model.loss not in ('deviance', 'log_loss'):
+        raise ValueError("Only binary classifiers with the deviance loss can be exported")
+
+    n_features = model.n_features_in_
+    # The prior does not depend on X for the supported init estimators
+    init = model._raw_predict_init(np.zeros((2, n_features), dtype=np.float32))
+    if init[0, 0] != init[1, 0]:
+        raise ValueError("Unsupported init estimator: {}".format(model.init_))
+
+    roots, feature, threshold, left, right, value = [], [], [], [], [], []
+    offset = 0
+    max_depth = 0
+    for estimator in model.estimators_[:, 0]:
+        tree = estimator.tree_
+        leaves = tree.children_left < 0
+        roots.append(offset)
+        feature.append(np.where(leaves, 0, tree.feature))
+        threshold.append(np.where(leaves, 0.0, tree.threshold))
+        left.append(np.where(leaves, -1, tree.children_left + offset))
+        right.append(np.where(leaves, -1, tree.children_right + offset))
+        value.append(tree.value[:, 0, 0])
+        offset += tree.node_count
+        max_depth = max(max_depth, tree.max_depth)
+
+    return TreeEnsemble(roots=roots,
+                        feature=np.concatenate(feature),
+                        threshold=np.concatenate(threshold),
+                        left=np.concatenate(left),
+                        right=np.concatenate(right),
+                        value=np.concatenate(value),
+                        init=init[0, 0],
+                        learning_rate=model.learning_rate,
+                        n_features=n_features,
+                        max_depth=max_depth)
+
+
+if __name__ == "__main__":
+    # python -m utils.tree_export [pipeline.pickle] [model_trees.npz]
+    import joblib
+
+    source = sys.argv[1] if len(sys.argv) > 1 else 'pipeline.pickle'
+    target = sys.argv[2] if len(sys.argv) > 2 else 'model_trees.npz'
+    model = joblib.load(source)
+    if hasattr(model, 'steps'):
+        model = model.steps[-1][1]
+    export_trees(model).save(target)
+    print("Exported {} trees to {}".format(len(model.estimators_), target))
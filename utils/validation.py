@@ -0,0 +1,261 @@
+import math
+
+
+# Value rules of the /predict fields, in the order they are checked. The set of
+# expected fields and their allowed types come from columns.json and
+# dtypes.pickle, see `build_schema`
+FIELD_RULES = [
+    ('patient_id', {'kind': 'integer'}),
+    ('age', {'kind': 'text'}),
+    ('weight', {'kind': 'text'}),
+    # Errors on race have always reported the type of gender
+    ('race', {'kind': 'text', 'error_type_field': 'gender'}),
+    ('diag_1', {'kind': 'text'}),
+    ('diag_2', {'kind': 'text'}),
+    ('diag_3', {'kind': 'text'}),
+    ('gender', {'kind': 'text'}),
+    ('payer_code', {'kind': 'text'}),
+    ('complete_vaccination_status', {'kind': 'text'}),
+    ('medical_specialty', {'kind': 'text'}),
+    ('admission_type_code', {'kind': 'code'}),
+    ('admission_source_code', {'kind': 'code'}),
+    ('discharge_disposition_code', {'kind': 'code'}),
+    ('time_in_hospital', {'kind': 'code', 'non_negative': True}),
+    ('num_lab_procedures', {'kind': 'count', 'non_negative': True}),
+    ('num_medications', {'kind': 'count', 'non_negative': True}),
+    ('num_procedures', {'kind': 'count', 'non_negative': True}),
+    ('number_outpatient', {'kind': 'count', 'non_negative': True}),
+    ('number_emergency', {'kind': 'count', 'non_negative': True}),
+    ('number_inpatient', {'kind': 'count', 'non_negative': True}),
+    # Negative values of number_diagnoses have always been reported as number_inpatient
+    ('number_diagnoses', {'kind': 'count', 'non_negative': True, 'negative_error_name': 'number_inpatient'}),
+    ('blood_type', {'kind': 'choice', 'values': [None,"","?","o+","a+","b+","o-","a-","ab+","b-","ab-"]}),
+    ('hemoglobin_level', {'kind': 'range', 'min': 0, 'max': 100}),
+    ('max_glu_serum', {'kind': 'choice', 'values': [None,"none","norm",">200",">300"]}),
+    ('A1Cresult', {'kind': 'choice', 'values': [None,"none","norm",">8",">7"]}),
+    ('diuretics', {'kind': 'choice', 'values': [None,"yes","no"]}),
+    ('insulin', {'kind': 'choice', 'values': [None,"yes","no"]}),
+    ('diabetesMed', {'kind': 'choice', 'values': [None,"yes","no"]}),
+    ('change', {'kind': 'choice', 'values': [None,"ch","no"]}),
+    ('has_prosthesis', {'kind': 'binary'}),
+    ('blood_transfusion', {'kind': 'binary'}),
+]
+
+# Allowed types by column dtype, and the fields that differ from them. The
+# order is the one listed in type error messages
+DTYPE_TYPES = {'int64': [int, float], 'float64': [int, float, type(None)], 'object': [str, float, type(None)]}
+FIELD_TYPES = {'admission_type_code': [float, int, type(None)],
+               'discharge_disposition_code': [float, int, type(None)],
+               'admission_source_code': [float, int, type(None)],
+               'num_lab_procedures': [float, int, type(None)],
+               'hemoglobin_level': [float, int, type(None)],
+               'has_prosthesis': [bool, int, float, type(None)],
+               'blood_transfusion': [bool, int, float, type(None)]}
+
+ID_FIELD = 'admission_id'
+
+
+def type_error(field, value, target):
+    return "Invalid datatype provided for '{}': '{}'. Transformation to '{}' is not possible".format(
+        field, type(value).__name__, target.__name__)
+
+
+def negative_error(field, value):
+    return "Invalid value provided for '{}': '{}'. Value cannot be negative".format(field, value)
+
+
+def is_nan(value):
+    return math.isnan(value)
+
+
+def compile_integer(field, options):
+    def check(observation):
+        value = observation[field]
+        if type(value) is not int:
+            if value.is_integer():
+                observation[field] = int(value)
+            else:
+                return type_error(field, value, int)
+    return check
+
+
+def compile_text(field, options):
+    error_type_field = options.get('error_type_field', field)
+    def check(observation):
+        value = observation[field]
+        if value:
+            if type(value) is str:
+                observation[field] = value.strip()
+            elif type(value) is float:
+                if is_nan(value):
+                    observation[field] = None
+                else:
+                    return type_error(field, observation[error_type_field], type(None))
+    return check
+
+
+def compile_number(field, options, cast):
+    non_negative = options.get('non_negative', False)
+    negative_error_name = options.get('negative_error_name', field)
+    strict = options['kind'] == 'code'
+    def check(observation):
+        value = observation[field]
+        if value:
+            if type(value) is int:
+                value = cast(value)
+            elif type(value) is float:
+                if value.is_integer():
+                    value = cast(value)
+                elif is_nan(value):
+                    value = None
+                else:
+                    return type_error(field, value, int)
+            elif strict:
+                return type_error(field, value, int)
+            observation[field] = value
+        if non_negative and value and value < 0:
+            return negative_error(negative_error_name, value)
+    return check
+
+
+def compile_choice(field, options):
+    valid_values = set(options['values'])
+    allowed = ",".join(["'{}'".format(v) for v in options['values']])
+    def check(observation):
+        value = observation[field]
+        if value:
+            if type(value) is str:
+                normalized = value.strip().lower()
+                if normalized not in valid_values:
+                    return "Invalid value provided for '{}': '{}'. Allowed values are: {}".format(field, value, allowed)
+                observation[field] = normalized
+            elif type(value) is float:
+                if is_nan(value):
+                    observation[field] = None
+                else:
+                    return type_error(field, value, type(None))
+    return check
+
+
+def compile_range(field, options):
+    minimum, maximum = options['min'], options['max']
+    def check(observation):
+        value = observation[field]
+        if value:
+            if value < minimum or value > maximum:
+                return "Invalid value provided for '{}': '{}'. Value outside expected range".format(field, value)
+    return check
+
+
+def compile_binary(field, options):
+    def check(observation):
+        value = observation[field]
+        if value:
+            if type(value) is int:
+                value = int(value)
+            elif type(value) is float:
+                if value.is_integer():
+                    value = int(value)
+                elif is_nan(value):
+                    value = None
+                else:
+                    return type_error(field, value, int)
+            if value in (True,1):
+                observation[field] = "1"
+            elif value in (False,0):
+                observation[field] = "0"
+            else:
+                observation[field] = "other"
+    return check
+
+
+COMPILERS = {'integer': compile_integer,
+             'text': compile_text,
+             'code': lambda field, options: compile_number(field, options, float),
+             'count': lambda field, options: compile_number(field, options, int),
+             'choice': compile_choice,
+             'range': compile_range,
+             'binary': compile_binary}
+
+
+def build_schema(columns, dtypes, target='readmitted'):
+    # Ordered list of (field, allowed types, value rule) for every input column
+    rules = dict(FIELD_RULES)
+    schema = []
+    for col in columns:
+        if col == target:
+            continue
+        types = FIELD_TYPES.get(col, DTYPE_TYPES[str(dtypes[col])])
+        schema.append((col, types, rules.get(col)))
+    return schema
+
+
+class ObservationValidator:
+    # Validates and coerces /predict observations in place. The schema is
+    # compiled once into per-field checks; every check of a stage runs and all
+    # of its errors are collected, the response reports the first one
+
+    def __init__(self, columns, dtypes, target='readmitted'):
+        self.schema = build_schema(columns, dtypes, target)
+        self.valid_columns = set(col for col, _, _ in self.schema)
+        self.column_types = [(col, frozenset(types), ",".join(["'{}'".format(t.__name__) for t in types]))
+                             for col, types, _ in self.schema]
+        by_field = {col: rule for col, _, rule in self.schema}
+        self.checks = [COMPILERS[rule['kind']](field, rule) for field, rule in FIELD_RULES if by_field.get(field) is not None]
+        self.checks.insert(0, compile_integer(ID_FIELD, {'kind': 'integer'}))
+
+    def check_types(self, observation):
+        errors = []
+        for col, types, allowed in self.column_types:
+            if col in observation:
+                value = observation[col]
+                if type(value) not in types:
+                    errors.append("Invalid datatype provided for '{}': '{}'. Allowed datatypes are: {}".format(
+                        col, type(value).__name__, allowed))
+        return errors
+
+    def validate(self, observation):
+        # Returns (ok, error response, warning description, errors)
+        warning_description = ""
+
+        if not isinstance(observation, dict):
+            error_description = "Observation must be a JSON object: {}".format(observation)
+            return False, {'id': None, 'error': error_description}, warning_description, [error_description]
+
+        if ID_FIELD not in observation:
+            error_description = "Field `{}` missing from request: {}".format(ID_FIELD, observation)
+            return False, {'id': None, 'error': error_description}, warning_description, [error_description]
+
+        keys = set(observation.keys())
+        missing = self.valid_columns - keys
+        if len(missing) > 0:
+            error_description = "Missing columns: {}".format(missing)
+            return False, {'admission_id': observation[ID_FIELD], 'error': error_description}, warning_description, [error_description]
+
+        extra = keys - self.valid_columns
+        if len(extra) > 0:
+            warning_description = "Unrecognized columns provided: {}".format(extra)
+
+        errors = self.check_types(observation)
+        if errors:
+            return False, {'admission_id': observation[ID_FIELD], 'error': errors[0]}, warning_description, errors
+
+        id_error = self.checks[0](observation)
+        if id_error:
+            return False, {'admission_id': observation[ID_FIELD], 'error': id_error}, warning_description, [id_error]
+
+        # Once a check fails the remaining ones run on a copy, so the observation
+        # is left as it was when the first error was found
+        for check in self.checks[1:]:
+            error = check(observation)
+            if error:
+                if not errors:
+                    observation = dict(observation)
+                errors.append(error)
+        if errors:
+            return False, {'admission_id': observation[ID_FIELD], 'error': errors[0]}, warning_description, errors
+
+        return True, {}, warning_description, errors
+
+    def validate_many(self, observations):
+        return [self.validate(observation) for observation in observations]
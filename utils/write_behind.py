@@ -0,0 +1,267 @@
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+from peewee import IntegrityError, chunked
+from loguru import logger
+
+
+FLUSH = 'flush'
+STOP = 'stop'
+
+
+class Receipt:
+    # Lets the caller of `store` wait for its rows: `written[i]` becomes True
+    # once row i is inserted, False if a constraint rejected it, or the
+    # exception of the last attempt if the flush failed
+
+    def __init__(self, count):
+        self.written = [None] * count
+        self.remaining = count
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        if not count:
+            self.done.set()
+
+    def record(self, index, written):
+        with self.lock:
+            self.written[index] = written
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.done.set()
+
+
+class WriteBehindQueue:
+    # Buffers rows in a bounded queue and inserts them from a background thread,
+    # one transaction per batch. A batch is written once it has `batch_size`
+    # rows or its oldest row is `flush_interval` seconds old. When the queue is
+    # full the caller writes its row itself, so memory stays bounded.
+    #
+    # Rows given to `put` are written behind the caller's back. Rows given to
+    # `store` are the ones a response acknowledges: the caller waits for them,
+    # and so that it does not wait for `flush_interval`, a batch with such
+    # rows is written as soon as the queue is empty. The rows queued during a
+    # write go together into the next one (group commit).
+    #
+    # Keys (admission ids) are reserved until their row is written, which lets
+    # the app reject duplicates that are still waiting in this queue. Only the
+    # database sees the rows of other processes, so a row it rejects is
+    # reported to the caller of `store`
+
+    def __init__(self, db, max_size=10000, batch_size=100, flush_interval=0.5,
+                 put_timeout=0.1, retries=3):
+        self.db = db
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.queue = queue.Queue(maxsize=max(max_size, 1))
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.thread = None
+        self.enqueued = 0
+        self.written = 0
+        self.flushes = 0
+        self.rejected = 0
+        self.failed = 0
+        self.overflows = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = None
+        self.max_flush_seconds = 0.0
+        # Threads do not survive a fork, so each worker process starts its own
+        # writer with an empty queue
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max(self.max_size, 1))
+        self.pending = set()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+            self.thread.start()
+
+    def reserve(self, key):
+        # False if a row with this key is already waiting to be written
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+            return True
+
+    def release(self, key):
+        with self.lock:
+            self.pending.discard(key)
+
+    def is_pending(self, key):
+        with self.lock:
+            return key in self.pending
+
+    def put(self, model, row, key=None, receipt=None):
+        self.start()
+        item = (model, row, key, receipt)
+        try:
+            self.queue.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            with self.lock:
+                self.overflows += 1
+            self.write([item])
+            return
+        with self.lock:
+            self.enqueued += 1
+
+    def store(self, model, rows, keys=None):
+        # Queues the rows and waits until they are written. Returns for each
+        # row True if it was inserted, False if a constraint rejected it
+        receipt = Receipt(len(rows))
+        for index, row in enumerate(rows):
+            self.put(model, row, keys[index] if keys else None, (receipt, index))
+        receipt.done.wait()
+        for written in receipt.written:
+            if isinstance(written, Exception):
+                raise written
+        return receipt.written
+
+    def flush(self, timeout=None):
+        # Blocks until every row queued before the call is written
+        if self.thread is None or not self.thread.is_alive():
+            return True
+        done = threading.Event()
+        self.queue.put((FLUSH, done, None, None))
+        return done.wait(timeout)
+
+    def close(self, timeout=30):
+        if self.thread is None or not self.thread.is_alive():
+            return True
+        done = threading.Event()
+        self.queue.put((STOP, done, None, None))
+        finished = done.wait(timeout)
+        self.thread.join(timeout)
+        return finished
+
+    def run(self):
+        batch = []
+        deadline = None
+        awaited = False
+        while True:
+            timeout = None if not batch else max(deadline - time.monotonic(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self.write(batch)
+                batch = []
+                continue
+
+            if item[0] in (FLUSH, STOP):
+                self.write(batch)
+                batch = []
+                item[1].set()
+                if item[0] == STOP:
+                    return
+                continue
+
+            if not batch:
+                deadline = time.monotonic() + self.flush_interval
+                awaited = False
+            batch.append(item)
+            awaited = awaited or item[3] is not None
+            if len(batch) >= self.batch_size or (awaited and self.queue.empty()):
+                self.write(batch)
+                batch = []
+
+    def write(self, items):
+        if not items:
+            return
+        start = time.perf_counter()
+        for attempt in range(self.retries):
+            try:
+                # The connection is only held during the flush, so it goes back
+                # to the pool in between
+                opened = self.db.connect(reuse_if_open=True)
+                try:
+                    written = self.insert(items)
+                finally:
+                    if opened:
+                        self.db.close()
+                break
+            except Exception as e:
+                error = e
+                logger.warning("Write-behind flush of {} rows failed (attempt {}): {}".format(len(items), attempt + 1, e))
+                time.sleep(0.1 * 2 ** attempt)
+        else:
+            logger.error("Dropping {} rows after {} failed flushes: {}".format(len(items), self.retries, items))
+            written = [error] * len(items)
+
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            for _, _, key, _ in items:
+                if key is not None:
+                    self.pending.discard(key)
+            self.written += written.count(True)
+            self.rejected += written.count(False)
+            self.failed += len(items) - written.count(True) - written.count(False)
+            self.flushes += 1
+            self.flush_seconds += elapsed
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        # The waiting callers only hear back once the counts are up to date
+        for (_, _, _, receipt), item_written in zip(items, written):
+            if receipt is not None:
+                receipt[0].record(receipt[1], item_written)
+
+    def insert(self, items):
+        # Returns for each row True if it was inserted, False if a constraint
+        # rejected it
+        batches = OrderedDict()
+        for model, row, _, _ in items:
+            batches.setdefault(model, []).append(row)
+        try:
+            with self.db.atomic():
+                for model, rows in batches.items():
+                    for rows_chunk in chunked(rows, 100):
+                        model.insert_many(rows_chunk).execute()
+            return [True] * len(items)
+        except IntegrityError:
+            pass
+
+        # Another writer got one of the keys first: insert row by row so that
+        # only the conflicting rows are rejected
+        written = []
+        with self.db.atomic():
+            for model, row, _, _ in items:
+                try:
+                    with self.db.atomic():
+                        model.insert(row).execute()
+                    written.append(True)
+                except IntegrityError:
+                    written.append(False)
+        return written
+
+    def stats(self):
+        with self.lock:
+            return {'enabled': self.enabled,
+                    'queue_depth': self.queue.qsize(),
+                    'max_size': self.max_size,
+                    'batch_size': self.batch_size,
+                    'flush_interval': self.flush_interval,
+                    'pending_keys': len(self.pending),
+                    'enqueued': self.enqueued,
+                    'written': self.written,
+                    'rejected': self.rejected,
+                    'failed': self.failed,
+                    'overflows': self.overflows,
+                    'flushes': self.flushes,
+                    'last_flush_seconds': self.last_flush_seconds,
+                    'avg_flush_seconds': self.flush_seconds / self.flushes if self.flushes else None,
+                    'max_flush_seconds': self.max_flush_seconds}